@@ -0,0 +1,303 @@
+import sys
+import cv2
+import traceback
+
+import numpy as np
+
+import os
+
+import json
+
+import time
+
+from collections import deque
+
+from os.path import isdir
+from os import makedirs
+
+from PIL import Image
+
+from frame_io import open_frame_source, VideoFrameWriter
+from annotation_store import ANNOTATION_FORMATS, open_annotations
+from pipeline import ALPRPipeline, WPOD_NET_PATH
+from roi import RegionOfInterest
+from motion_gate import MotionGate
+from tracker import VehicleTracker
+from plate_tracker import PlateTracker
+from post_processing import StreamingPostProcessor
+from rendering import load_fonts, draw_annotations
+
+import argparse
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(
+        description="Run vehicle detection, license plate detection and OCR "
+        "in a single pass, without writing intermediate files.")
+
+    parser.add_argument(
+        'input',
+        help="The folder containing the original input images, or a video "
+        "file.")
+
+    parser.add_argument(
+        'output_dir',
+        help="The folder where annotations are written.")
+
+    parser.add_argument(
+        '--lp_detector', choices=['simple', 'wpod'], default='simple',
+        help="The license plate detector to use.")
+
+    parser.add_argument(
+        '--wpod_net', default=WPOD_NET_PATH,
+        help="Path to Keras LP detector model (used only with "
+        "`--lp_detector wpod`).")
+
+    parser.add_argument(
+        '--vehicle_threshold', type=float, default=0.5)
+
+    parser.add_argument(
+        '--lp_threshold', type=float, default=0.5)
+
+    parser.add_argument(
+        '--ocr_threshold', type=float, default=0.4)
+
+    parser.add_argument(
+        '--roi',
+        help="JSON file with the region of interest of the camera (see "
+        "`roi.RegionOfInterest.from_file`): vehicles are searched only in "
+        "that region.")
+
+    parser.add_argument(
+        '--motion_gate', action='store_true',
+        help="Skip vehicle detection on frames without motion (or exact "
+        "duplicates of the previous one), reusing the vehicles detected in "
+        "the previous frame.")
+
+    parser.add_argument(
+        '--motion_threshold', type=float, default=0.002,
+        help="Fraction of changed pixels above which a frame is considered "
+        "moving (see `--motion_gate`).")
+
+    parser.add_argument(
+        '--max_skip', type=int, default=25,
+        help="Maximum number of consecutive frames skipped by the motion "
+        "gate.")
+
+    parser.add_argument(
+        '--keyframe_interval', type=int,
+        help="If set, vehicles are tracked across frames and detected only "
+        "once every this number of frames (or when a track is not reliable, "
+        "e.g. a new vehicle or one at the border of the frame); their boxes "
+        "are predicted on the other frames, and annotations include a "
+        "track id.")
+
+    parser.add_argument(
+        '--plate_interval', type=int,
+        help="If set (with `--lp_detector wpod` and `--keyframe_interval`), "
+        "plates of tracked vehicles are predicted from the last detection, "
+        "and WPOD-NET runs on a vehicle only once every this number of "
+        "frames, or when the predicted plate does not match the detected one "
+        "(see `--plate_similarity`).")
+
+    parser.add_argument(
+        '--plate_similarity', type=float, default=0.6,
+        help="Minimum correlation between a predicted plate and the last "
+        "detected one to accept the prediction.")
+
+    parser.add_argument(
+        '--window',
+        type=int,
+        help="If set, post-process annotations while frames are detected, "
+        "using this number of frames before and after each one. Corrected "
+        "annotations are written to *_annotations_unique.json and used for "
+        "the output video.")
+
+    parser.add_argument(
+        '--assignment',
+        choices=['greedy', 'optimal'],
+        default='greedy',
+        help="How license plates are assigned to vehicles when "
+        "post-processing (see `--window`).")
+
+    parser.add_argument(
+        '--format',
+        choices=ANNOTATION_FORMATS,
+        default='json',
+        help="How annotations are written: one JSON file per frame, or a "
+        "columnar store ('annotations' and 'annotations_unique' folders "
+        "inside output_dir), which requires numbered frames.")
+
+    parser.add_argument(
+        '--output_video',
+        help="If set, annotated frames are written to this video file.")
+
+    parser.add_argument(
+        '--fps',
+        type=float,
+        help="Frame rate of the output video (default: the one of the input "
+        "video, or 25 for a folder of images).")
+
+    return parser.parse_args()
+
+
+def render_frame(I, annotations, font, font_large):
+    """
+    Draw annotations on a BGR frame, returning a new BGR frame.
+    """
+
+    img = Image.fromarray(cv2.cvtColor(I, cv2.COLOR_BGR2RGB))
+    draw_annotations(img, annotations, font, font_large)
+
+    return cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+
+
+if __name__ == '__main__':
+
+    try:
+
+        args = parse_args()
+
+        alpr = ALPRPipeline(
+            lp_detector=args.lp_detector,
+            vehicle_threshold=args.vehicle_threshold,
+            lp_threshold=args.lp_threshold,
+            ocr_threshold=args.ocr_threshold,
+            wpod_net_path=args.wpod_net,
+            roi=RegionOfInterest.from_file(args.roi) if args.roi else None,
+            motion_gate=MotionGate(
+                min_changed_fraction=args.motion_threshold,
+                max_skip=args.max_skip) if args.motion_gate else None,
+            tracker=VehicleTracker(
+                keyframe_interval=args.keyframe_interval)
+            if args.keyframe_interval is not None else None,
+            plate_tracker=PlateTracker(
+                redetect_interval=args.plate_interval,
+                min_similarity=args.plate_similarity)
+            if args.plate_interval is not None else None)
+
+        frames = open_frame_source(args.input)
+
+        if not isdir(args.output_dir):
+            makedirs(args.output_dir)
+
+        video_writer = None
+
+        if args.output_video is not None:
+
+            font, font_large = load_fonts()
+
+            fps = args.fps or getattr(frames, 'fps', None) or 25
+            video_writer = VideoFrameWriter(args.output_video, fps)
+
+        store = store_unique = None
+
+        if args.format == 'columnar':
+
+            store = open_annotations(
+                args.output_dir, 'annotations', args.format, 'w')
+
+            if args.window is not None:
+                store_unique = open_annotations(
+                    args.output_dir, 'annotations_unique', args.format, 'w')
+
+        post_processor = None
+
+        if args.window is not None:
+
+            post_processor = StreamingPostProcessor(
+                args.window, assignment=args.assignment)
+
+            # Frames waiting for their corrected annotations (images are kept
+            # only if they have to be written to the output video)
+            pending_frames = deque(maxlen=args.window+1)
+
+        for frame in frames:
+
+            print('\tScanning %s' % frame.name)
+
+            tic = time.time()
+
+            annotations = alpr.process_frame(frame.image, frame.number)
+
+            if store is not None:
+
+                if frame.number is None:
+                    raise ValueError(
+                        "Cannot get the frame number of {}".format(frame.name))
+
+                store.append(frame.number, annotations)
+
+            else:
+
+                with open(
+                        os.path.join(
+                            args.output_dir,
+                            "{}_annotations.json".format(frame.name)),
+                        'w') as jf:
+
+                    json.dump(annotations, jf, indent=4)
+
+            toc = time.time()
+
+            if post_processor is None:
+
+                if video_writer is not None:
+                    video_writer.write(render_frame(
+                        frame.image, annotations, font, font_large))
+
+            else:
+
+                pending_frames.append((
+                    frame.name, frame.number,
+                    frame.image if video_writer is not None else None))
+
+                result = post_processor.push(annotations)
+
+                if result is not None:
+
+                    # The oldest pending frame is the one just corrected
+                    name, number, image = pending_frames[0]
+                    _, annotations_unique = result
+
+                    if store_unique is not None:
+
+                        store_unique.append(number, annotations_unique)
+
+                    else:
+
+                        with open(
+                                os.path.join(
+                                    args.output_dir,
+                                    "{}_annotations_unique.json".format(
+                                        name)),
+                                'w') as jf:
+
+                            json.dump(annotations_unique, jf, indent=4)
+
+                    if video_writer is not None:
+                        video_writer.write(render_frame(
+                            image, annotations_unique, font, font_large))
+
+            print('\t\t%d vehicles found, elapsed time = %f' % (
+                len(annotations['cars']), toc-tic))
+
+        if alpr.motion_gate is not None:
+            print(alpr.motion_gate.summary())
+
+        if alpr.plate_tracker is not None:
+            print(alpr.plate_tracker.summary())
+
+        if video_writer is not None:
+            video_writer.close()
+
+        for writer in [store, store_unique]:
+            if writer is not None:
+                writer.close()
+
+    except:
+        traceback.print_exc()
+        sys.exit(1)
+
+    sys.exit(0)
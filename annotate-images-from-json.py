@@ -2,22 +2,27 @@ import argparse
 
 import os
 
-from PIL import Image, ImageDraw, ImageFont
+import cv2
 
-# from glob import glob
+import numpy as np
 
-# Module which contains functions to draw annotations on image
-from annotation_utils import draw_corners, annotate_object
+from PIL import Image
 
-import json
+# from glob import glob
 
 import time
 
-from utils import guess_last_frame
+from collections import deque
+
+from multiprocessing import Pool
+
+from utils import guess_last_frame, print_worker_summary
+
+from annotation_store import ANNOTATION_FORMATS, open_annotations
 
-# Import parameters such as symbols and colors from separate file
-from constants import (
-    LINE_WIDTH, VEHICLE_SYMBOLS, VEHICLE_COLORS, TEXT_FG_COLOR, SCALE)
+from frame_io import FFmpegWriter, VideoFrameWriter
+
+from rendering import load_fonts, draw_annotations
 
 
 def parse_args():
@@ -51,6 +56,45 @@ def parse_args():
         default=5,
         help="The number of frame to use to improve plates detection")
 
+    parser.add_argument(
+        '--format',
+        choices=ANNOTATION_FORMATS,
+        default='json',
+        help="How post-processed annotations have been written: one JSON "
+        "file per frame, or a columnar store.")
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of processes used to render frames.")
+
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        help="Number of consecutive frames given to a worker at a time "
+        "(default: the number of frames divided by 4 times the number of "
+        "workers). Ignored with --output_video, where frames are sent one "
+        "at a time.")
+
+    parser.add_argument(
+        '--output_video',
+        help="If set, annotated frames are encoded into this video file "
+        "instead of being saved as PNG files in aux_folder/results.")
+
+    parser.add_argument(
+        '--fps',
+        type=float,
+        default=25,
+        help="Frame rate of the output video.")
+
+    parser.add_argument(
+        '--encoder',
+        choices=['ffmpeg', 'opencv'],
+        default='ffmpeg',
+        help="How the output video is encoded: raw frames piped to an ffmpeg "
+        "process (H.264), or an OpenCV VideoWriter.")
+
     args = parser.parse_args()
     if args.end_frame is None:
         args.end_frame = guess_last_frame(args.input_folder)
@@ -62,20 +106,17 @@ def parse_args():
     return args
 
 
-def outline_bounding_box(x, y, w, h, pil_draw, color):
+def render_image(img_path, annotations, font, font_large):
     """
-    Draw an outline for a bounding box
+    Load an input image and draw its annotations, returning the PIL image.
     """
 
-    # Determine which is the shorter side
-    min_len = min(h, h)
+    # Load the entire image
+    img_full = Image.open(img_path)
 
-    # Determine segment length
-    segment_length = min(min_len/3, 50)
+    draw_annotations(img_full, annotations, font, font_large)
 
-    # Draw corners
-    draw_corners(x, y, w, h, segment_length, pil_draw, color=color,
-                 width=LINE_WIDTH)
+    return img_full
 
 
 def annotate_image(img_path, annotations, font, font_large, args):
@@ -88,103 +129,163 @@ def annotate_image(img_path, annotations, font, font_large, args):
     # Extract filename
     base_image_name = os.path.basename(img_path)
 
-    # Load the entire image
-    img_full = Image.open(img_path)
+    img_full = render_image(img_path, annotations, font, font_large)
 
-    # pil_draw = ImageDraw.Draw(img_full)
-    pil_draw = ImageDraw.Draw(img_full, mode='RGBA')
+    # Save the image with bb
+    img_full.save(
+        os.path.join(
+            args.aux_folder,
+            'results',
+            base_image_name[:-4]+"_output.png"),
+        "PNG")
 
-    tic = time.time()
+    return
 
-    for car in annotations['cars']:
 
-        # Unpack coordinates for bounding box
-        car_crop_x, car_crop_y, car_crop_w, car_crop_h = car['bounding_box']
+# Arguments and fonts, set once in each worker process
+_worker_context = dict()
 
-        vehicle_category = car['category']
 
-        # Draw a cool outline of the vehicle
-        outline_bounding_box(
-            car_crop_x, car_crop_y, car_crop_w, car_crop_h,
-            pil_draw, (255, 255, 255))
+def init_worker(args):
 
-        for lp in car['plates']:
+    _worker_context['args'] = args
 
-            # Beautify license plate text
-            lp_text = lp['plate_text']
+    # Fonts are loaded once per worker, not once per frame
+    _worker_context['fonts'] = load_fonts()
 
-            lp_crop_x_absolute, lp_crop_y_absolute, lp_crop_w, lp_crop_h = \
-                lp['bounding_box']
 
-            # Actually annotate object
-            annotate_object(
-                lp_crop_x_absolute, lp_crop_y_absolute,
-                lp_crop_w, lp_crop_h, lp_text, pil_draw,
-                font,
-                10,  # padding
-                0.15,  # segment_ratio
-                0.4,  # line_length_ratio
-                LINE_WIDTH,
-                VEHICLE_COLORS[vehicle_category],  # outline color
-                TEXT_FG_COLOR,  # text color
-                (255, 255, 255),  # bg color
-                SCALE,
-                object_symbol=VEHICLE_SYMBOLS[vehicle_category],
-                font_symbol=font_large,
-                bg_color_symbol=VEHICLE_COLORS[vehicle_category])
+def run_task(task):
+    """
+    Render one frame in a worker. The frame is saved as a PNG file, or
+    returned if it has to be written to the output video.
+
+    Returns
+    -------
+
+    tuple
+        `(t, pid, elapsed, frame)`, where `frame` is the rendered RGB frame or
+        `None` if it has been saved.
+    """
+
+    t, annotations = task
+
+    args = _worker_context['args']
+    font, font_large = _worker_context['fonts']
+
+    tic = time.time()
+
+    img_path = os.path.join(
+        args.input_folder,
+        "frame{:05d}.png".format(t))
+
+    frame = None
+
+    if args.output_video is not None:
+        frame = np.asarray(render_image(
+            img_path, annotations, font, font_large).convert('RGB'))
+    else:
+        annotate_image(img_path, annotations, font, font_large, args)
 
     toc = time.time()
 
-    print("Done, elapsed time = {}".format(toc-tic))
-    print("Done, writing image")
+    return t, os.getpid(), toc-tic, frame
 
-    # Save the image with bb
-    img_full.save(
-        os.path.join(
-            args.aux_folder,
-            'results',
-            base_image_name[:-4]+"_output.png"),
-        "PNG")
 
-    return
+def imap_bounded(pool, func, tasks, max_pending):
+    """
+    Like `pool.imap(func, tasks, 1)`, but with at most `max_pending` tasks
+    submitted and not yet consumed, so that results (e.g. rendered frames)
+    do not pile up in memory when the consumer is slower than the workers.
+    """
+
+    pending = deque()
+
+    for task in tasks:
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+        pending.append(pool.apply_async(func, (task,)))
+
+    while pending:
+        yield pending.popleft().get()
 
 
 def main():
 
     args = parse_args()
 
-    font_filename = \
-        "OpenSans-Regular.ttf"
+    annotations_unique = open_annotations(
+        args.aux_folder, 'annotations_unique', args.format)
 
-    font_icons_filename = \
-        "DejaVu Sans Mono Nerd Font Complete Mono.ttf"
+    # Annotations are read here and sent to workers along with the frame
+    # number
+    tasks = (
+        (t, annotations_unique.read(t))
+        for t in range(args.start_frame, args.end_frame+1))
 
-    # Load the font used to write license plates text above actual recognized
-    # plates.
-    font = ImageFont.truetype(
-        os.path.join('data', 'fonts', font_filename), size=SCALE*30)
+    n_frames = max(0, args.end_frame - args.start_frame + 1)
 
-    # Load a second copy of the font for symbols
-    font_large = ImageFont.truetype(
-        os.path.join('data', 'fonts', font_icons_filename), size=SCALE*40)
+    chunk_size = args.chunk_size or max(1, n_frames // (4 * args.workers))
 
-    for t in range(args.start_frame, args.end_frame+1):
+    pool = None
 
-        annotations_file = os.path.join(
-            args.aux_folder,
-            "frame{:05d}_annotations_unique.json".format(t))
+    if args.workers > 1:
+        pool = Pool(args.workers, init_worker, (args,))
 
-        img_path = os.path.join(
-            args.input_folder,
-            "frame{:05d}.png".format(t))
+        if args.output_video is not None:
+            # Each result is a whole frame: send tasks one at a time and keep
+            # only a few frames in flight, rather than pickling chunks of
+            # frames and queueing them faster than they are encoded
+            results = imap_bounded(pool, run_task, tasks, 2 * args.workers)
+        else:
+            results = pool.imap(run_task, tasks, chunk_size)
+    else:
+        init_worker(args)
+        results = map(run_task, tasks)
 
-        # Load annotations from json file
-        with open(annotations_file, 'r') as jf:
-            annotations = json.load(jf)
+    video_writer = None
 
-        print("Annotating image {}".format(os.path.basename(img_path)))
+    if args.output_video is not None:
+        # The video starts from the first frame which has been
+        # post-processed, i.e. `start_frame` corrected by the window
+        if args.encoder == 'ffmpeg':
+            video_writer = FFmpegWriter(
+                args.output_video, args.fps, pix_fmt='rgb24')
+        else:
+            video_writer = VideoFrameWriter(args.output_video, args.fps)
 
-        annotate_image(img_path, annotations, font, font_large, args)
+    # Number of frames and time spent by each worker
+    worker_stats = dict()
+
+    tic = time.time()
+
+    try:
+        # Frames are done in order
+        for t, pid, elapsed, frame in results:
+
+            print("Annotated image frame{:05d}.png".format(t))
+
+            if video_writer is not None:
+
+                if args.encoder == 'opencv':
+                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+                video_writer.write(frame)
+
+            n, busy = worker_stats.get(pid, (0, 0.))
+            worker_stats[pid] = (n + 1, busy + elapsed)
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if video_writer is not None:
+            video_writer.close()
+        annotations_unique.close()
+
+    toc = time.time()
+
+    print_worker_summary(worker_stats, args.workers, toc-tic)
 
 
 if __name__ == "__main__":
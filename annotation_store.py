@@ -0,0 +1,507 @@
+import os
+
+import json
+
+from bisect import bisect_left
+
+import numpy as np
+
+
+# Version of the on-disk layout of columnar stores (version 1 stores have no
+# frame index, version 2 stores have no track ids, they can still be read)
+STORE_VERSION = 3
+READABLE_VERSIONS = (1, 2, 3)
+
+# Maximum length (in bytes, UTF-8 encoded) of text fields
+CATEGORY_LENGTH = 16
+PLATE_TEXT_LENGTH = 16
+
+# One row per vehicle; `car` is the index of the vehicle in its frame,
+# `track_id` is -1 if vehicles have not been tracked
+CAR_DTYPE = np.dtype([
+    ('frame', '<i4'),
+    ('car', '<i4'),
+    ('category', 'S{}'.format(CATEGORY_LENGTH)),
+    ('bounding_box', '<f8', (4,)),
+    ('track_id', '<i4'),
+])
+
+# Vehicles in stores before version 3
+CAR_DTYPE_V2 = np.dtype([
+    ('frame', '<i4'),
+    ('car', '<i4'),
+    ('category', 'S{}'.format(CATEGORY_LENGTH)),
+    ('bounding_box', '<f8', (4,)),
+])
+
+# One row per license plate, linked to its vehicle by `(frame, car)`
+PLATE_DTYPE = np.dtype([
+    ('frame', '<i4'),
+    ('car', '<i4'),
+    ('bounding_box', '<f8', (4,)),
+    ('plate_text', 'S{}'.format(PLATE_TEXT_LENGTH)),
+    ('has_text', '?'),
+    ('valid_plate', '?'),
+])
+
+# One row per frame (also those with no vehicles), with the position of its
+# records in the other two tables
+FRAME_DTYPE = np.dtype([
+    ('frame', '<i4'),
+    ('car_start', '<i8'),
+    ('car_count', '<i4'),
+    ('plate_start', '<i8'),
+    ('plate_count', '<i4'),
+])
+
+META_FILENAME = 'meta.json'
+CARS_FILENAME = 'cars.bin'
+PLATES_FILENAME = 'plates.bin'
+FRAMES_FILENAME = 'frames.bin'
+
+ANNOTATION_FORMATS = ['json', 'columnar']
+
+
+def _encode(text, length, field):
+
+    if text is None:
+        return b''
+
+    encoded = text.encode('utf-8')
+
+    # Text comes from detectors (e.g. the OCR), so an unexpected value is
+    # truncated rather than aborting the whole run
+    if len(encoded) > length:
+        encoded = encoded[:length].decode('utf-8', 'ignore').encode('utf-8')
+        print("Warning: {} '{}' is longer than {} bytes, truncated to "
+              "'{}'".format(field, text, length, _decode(encoded)))
+
+    return encoded
+
+
+def _decode(raw):
+    return raw.decode('utf-8')
+
+
+def _load_table(path, dtype):
+    """
+    Memory-map a table of records, ignoring a trailing incomplete record (e.g.
+    left by a writer which has been interrupted).
+    """
+
+    n = os.path.getsize(path) // dtype.itemsize if os.path.isfile(path) else 0
+
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+
+    # Plain ndarray view of the map, which is cheaper to index
+    return np.memmap(path, dtype=dtype, mode='r', shape=(n,)).view(np.ndarray)
+
+
+class AnnotationStoreWriter(object):
+    """
+    Append the annotations of frames to a columnar store, i.e. a folder with
+    two binary tables (one for vehicles, one for license plates) of
+    fixed-size records, sorted by frame number, and a frame index with the
+    offset of the records of each frame in those tables.
+
+    Parameters
+    ----------
+
+    path : str
+        The folder of the store.
+
+    append : bool, optional
+        Whether to append frames to the store, if it already exists, instead
+        of replacing its content. Default to `False`.
+    """
+
+    def __init__(self, path, append=False):
+
+        self.path = path
+
+        meta_path = os.path.join(path, META_FILENAME)
+
+        if append and os.path.isfile(meta_path):
+            if _check_meta(meta_path) != STORE_VERSION:
+                raise ValueError(
+                    "Cannot append to the old annotation store in {}".format(
+                        path))
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+            with open(meta_path, 'w') as mf:
+                json.dump({
+                    'version': STORE_VERSION,
+                    'cars': CAR_DTYPE.descr,
+                    'plates': PLATE_DTYPE.descr,
+                    'frames': FRAME_DTYPE.descr}, mf, indent=4)
+
+        self._files = dict()
+        self.last_frame = None
+
+        frames = _load_table(os.path.join(path, FRAMES_FILENAME), FRAME_DTYPE) \
+            if append else np.zeros(0, dtype=FRAME_DTYPE)
+
+        if len(frames):
+            last = frames[-1]
+            self.last_frame = int(last['frame'])
+            ends = {
+                CARS_FILENAME: int(last['car_start'] + last['car_count']),
+                PLATES_FILENAME: int(last['plate_start'] +
+                                     last['plate_count']),
+                FRAMES_FILENAME: len(frames)}
+        else:
+            ends = {
+                CARS_FILENAME: 0, PLATES_FILENAME: 0, FRAMES_FILENAME: 0}
+
+        del frames
+
+        self._n_records = dict()
+
+        for filename, dtype in [
+                (CARS_FILENAME, CAR_DTYPE), (PLATES_FILENAME, PLATE_DTYPE),
+                (FRAMES_FILENAME, FRAME_DTYPE)]:
+
+            f = open(os.path.join(path, filename), 'ab' if append else 'wb')
+
+            # Drop records written after the last frame in the index (e.g. by
+            # a writer which has been interrupted)
+            f.truncate(ends[filename] * dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+
+            self._files[filename] = f
+            self._n_records[filename] = ends[filename]
+
+    def append(self, frame, annotations):
+        """
+        Append the annotations of a frame.
+
+        Parameters
+        ----------
+
+        frame : int
+            The frame number, which must be greater than the one of all frames
+            already in the store.
+
+        annotations : dict
+            The annotations for the frame, in the same format written to JSON
+            files.
+        """
+
+        if self.last_frame is not None and frame <= self.last_frame:
+            raise ValueError(
+                "Frame {} appended after frame {}".format(
+                    frame, self.last_frame))
+
+        cars = annotations['cars']
+
+        car_rows = np.zeros(len(cars), dtype=CAR_DTYPE)
+        plate_rows = np.zeros(
+            sum(len(car['plates']) for car in cars), dtype=PLATE_DTYPE)
+
+        k = 0
+
+        for ic, car in enumerate(cars):
+
+            car_rows[ic] = (
+                frame, ic,
+                _encode(car['category'], CATEGORY_LENGTH, 'Category'),
+                car['bounding_box'],
+                car.get('track_id', -1))
+
+            for plate in car['plates']:
+
+                plate_rows[k] = (
+                    frame, ic, plate['bounding_box'],
+                    _encode(plate['plate_text'], PLATE_TEXT_LENGTH,
+                            'Plate text'),
+                    plate['plate_text'] is not None,
+                    plate['valid_plate'])
+
+                k += 1
+
+        frame_row = np.array([(
+            frame,
+            self._n_records[CARS_FILENAME], len(car_rows),
+            self._n_records[PLATES_FILENAME], len(plate_rows))],
+            dtype=FRAME_DTYPE)
+
+        # The index is written last, so that a frame is visible only once
+        # all its records have been written
+        for filename, rows in [
+                (CARS_FILENAME, car_rows), (PLATES_FILENAME, plate_rows),
+                (FRAMES_FILENAME, frame_row)]:
+
+            self._files[filename].write(rows.tobytes())
+            self._n_records[filename] += len(rows)
+
+        self.last_frame = frame
+
+    def close(self):
+
+        for f in self._files.values():
+            f.close()
+
+        self._files = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AnnotationStore(object):
+    """
+    Read annotations from a columnar store written by `AnnotationStoreWriter`.
+
+    Tables are memory-mapped, and only the records of the frames which are
+    requested are read: their position is taken from the frame index (or,
+    for stores without an index, found with a binary search on the frame
+    column).
+
+    Parameters
+    ----------
+
+    path : str
+        The folder of the store.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        version = _check_meta(os.path.join(path, META_FILENAME))
+
+        self.cars = _load_table(
+            os.path.join(path, CARS_FILENAME),
+            CAR_DTYPE if version >= 3 else CAR_DTYPE_V2)
+        self.plates = _load_table(
+            os.path.join(path, PLATES_FILENAME), PLATE_DTYPE)
+
+        self.index = None
+
+        if version >= 2:
+            self.index = _load_table(
+                os.path.join(path, FRAMES_FILENAME), FRAME_DTYPE)
+
+            # With consecutive frame numbers (the usual case) the row of a
+            # frame in the index is found with a subtraction
+            self._first_frame = int(self.index['frame'][0]) \
+                if len(self.index) else 0
+            self._consecutive = len(self.index) == 0 or \
+                int(self.index['frame'][-1]) - self._first_frame == \
+                len(self.index) - 1
+
+    def frames(self):
+        """
+        The numbers of the frames in the store, in order.
+        """
+
+        if self.index is None:
+            return sorted(set(self.cars['frame'].tolist()))
+
+        return self.index['frame'].tolist()
+
+    def _record_bounds(self, first, last):
+        """
+        Position of the records of frames `first, ..., last` in the tables of
+        vehicles and of plates, as `((c0, c1), (p0, p1))`.
+        """
+
+        if self.index is None:
+            return (_frame_bounds(self.cars, first, last),
+                    _frame_bounds(self.plates, first, last))
+
+        n = len(self.index)
+
+        if self._consecutive:
+            r0 = min(max(first - self._first_frame, 0), n)
+            r1 = min(max(last + 1 - self._first_frame, r0), n)
+        else:
+            r0, r1 = _frame_bounds(self.index, first, last)
+
+        if r0 == r1:
+            return (0, 0), (0, 0)
+
+        head = self.index[r0]
+        tail = self.index[r1-1]
+
+        return (
+            (int(head['car_start']),
+             int(tail['car_start'] + tail['car_count'])),
+            (int(head['plate_start']),
+             int(tail['plate_start'] + tail['plate_count'])))
+
+    def read(self, frame):
+        """
+        Return the annotations of a single frame (with no vehicles if the
+        frame is not in the store).
+        """
+        return self.read_range(frame, frame)[0]
+
+    def read_range(self, first, last):
+        """
+        Return the annotations of frames `first, ..., last` (inclusive), as a
+        list of dictionaries in the same format written to JSON files.
+        """
+
+        out = [{'cars': list()} for _ in range(first, last+1)]
+
+        (c0, c1), (p0, p1) = self._record_bounds(first, last)
+
+        cars = self.cars[c0:c1]
+        plates = self.plates[p0:p1]
+
+        track_ids = cars['track_id'].tolist() \
+            if 'track_id' in cars.dtype.names else [-1]*len(cars)
+
+        for frame, category, bb, track_id in zip(
+                cars['frame'].tolist(), cars['category'].tolist(),
+                cars['bounding_box'].tolist(), track_ids):
+
+            car = {
+                'category': _decode(category) if category else None,
+                'bounding_box': bb,
+                'plates': list()}
+
+            if track_id >= 0:
+                car['track_id'] = track_id
+
+            out[frame - first]['cars'].append(car)
+
+        for frame, ic, bb, text, has_text, valid in zip(
+                plates['frame'].tolist(), plates['car'].tolist(),
+                plates['bounding_box'].tolist(),
+                plates['plate_text'].tolist(), plates['has_text'].tolist(),
+                plates['valid_plate'].tolist()):
+
+            out[frame - first]['cars'][ic]['plates'].append({
+                'bounding_box': bb,
+                'plate_text': _decode(text) if has_text else None,
+                'valid_plate': valid})
+
+        return out
+
+    def close(self):
+
+        self.cars = None
+        self.plates = None
+        self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _frame_bounds(table, first, last):
+    """
+    Indexes of the first record of frame `first` and of the one after the
+    last record of frame `last`.
+
+    A binary search is done directly on the (memory-mapped) frame column, so
+    that only a few pages are read (`np.searchsorted` would copy the whole
+    column, since it is not contiguous).
+    """
+
+    frames = table['frame']
+
+    start = bisect_left(frames, first)
+    end = bisect_left(frames, last+1, start)
+
+    return start, end
+
+
+def _check_meta(meta_path):
+    """
+    Check that the store can be read, returning the version of its layout.
+    """
+
+    with open(meta_path, 'r') as mf:
+        meta = json.load(mf)
+
+    if meta.get('version') not in READABLE_VERSIONS:
+        raise ValueError(
+            "Unsupported annotation store version {} in {}".format(
+                meta.get('version'), meta_path))
+
+    return meta['version']
+
+
+class JSONAnnotationFiles(object):
+    """
+    Read and write annotations as one JSON file per frame, named
+    'frameNNNNN_<name>.json', with the same interface as the columnar store.
+    """
+
+    def __init__(self, folder, name):
+
+        self.folder = folder
+        self.name = name
+
+    def _path(self, frame):
+        return os.path.join(
+            self.folder, "frame{:05d}_{}.json".format(frame, self.name))
+
+    def append(self, frame, annotations):
+
+        with open(self._path(frame), 'w') as jf:
+            json.dump(annotations, jf, indent=4)
+
+    def read(self, frame):
+
+        with open(self._path(frame), 'r') as jf:
+            return json.load(jf)
+
+    def read_range(self, first, last):
+        return [self.read(t) for t in range(first, last+1)]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_annotations(folder, name, fmt='json', mode='r'):
+    """
+    Open the annotations called `name` (e.g. 'annotations' or
+    'annotations_unique') in `folder`.
+
+    Parameters
+    ----------
+
+    folder : str
+        The folder containing auxiliary files generated by the pipeline.
+
+    name : str
+        The kind of annotations. With the 'json' format it is the suffix of
+        the per-frame files, with the 'columnar' format it is the name of the
+        folder of the store.
+
+    fmt : str, optional
+        Either 'json' (one file per frame) or 'columnar'. Default to 'json'.
+
+    mode : str, optional
+        'r' to read annotations, 'w' to write them (replacing the existing
+        ones) or 'a' to append them. Default to 'r'.
+    """
+
+    if fmt == 'json':
+        return JSONAnnotationFiles(folder, name)
+    elif fmt != 'columnar':
+        raise ValueError("Unknown annotation format: {}".format(fmt))
+
+    path = os.path.join(folder, name)
+
+    if mode in ('w', 'a'):
+        return AnnotationStoreWriter(path, append=(mode == 'a'))
+
+    return AnnotationStore(path)
@@ -2,10 +2,20 @@
 
 FRAMES_FOLDER=$1
 
+# Number of the first annotated frame (the first frames of the sequence are
+# skipped by post-processing, depending on the window used)
+first_frame=$(ls "${FRAMES_FOLDER}" | grep -E '^frame[0-9]+_output\.png$' | sort | head -n 1)
+
+if [ -z "$first_frame" ]; then
+    echo "No annotated frames found in ${FRAMES_FOLDER}"
+    exit 1
+fi
+
+start_number=$(echo "$first_frame" | sed -E 's/^frame0*([0-9]+)_output\.png$/\1/')
+
 # Create video starting from annotated frames
 ffmpeg -r 25 \
-    -start_number 26 \
+    -start_number $start_number \
     -i "${FRAMES_FOLDER}/frame%05d_output.png" -c:v \
     libx264 -vf fps=25 -pix_fmt yuv420p \
     "${FRAMES_FOLDER}/output_$(date +%Y%m%d_%H%M).mp4"
-
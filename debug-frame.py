@@ -1,12 +1,29 @@
-import os
-
 import argparse
 
-import json
+import copy
+
+from annotation_store import ANNOTATION_FORMATS, open_annotations
 
 from post_processing import process_annotations
 
 
+def frame_list(value):
+    """
+    Parse a target frame ('42') or an inclusive range of frames ('40-50').
+    """
+
+    try:
+        if '-' in value:
+            first, last = value.split('-', 1)
+            return list(range(int(first), int(last)+1))
+
+        return [int(value)]
+
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Invalid frame or range of frames: {}".format(value))
+
+
 def parse_args():
 
     parser = argparse.ArgumentParser()
@@ -17,9 +34,11 @@ def parse_args():
         "pipeline.")
 
     parser.add_argument(
-        'target_frame',
-        type=int,
-        help="The target frame to debug.")
+        'target_frames',
+        type=frame_list,
+        nargs='+',
+        help="The target frames to debug, either single frames or inclusive "
+        "ranges (e.g. '100-120').")
 
     parser.add_argument(
         '--window',
@@ -27,45 +46,60 @@ def parse_args():
         default=25,
         help="Number of frames before and after to use to correct detections.")
 
+    parser.add_argument(
+        '--format',
+        choices=ANNOTATION_FORMATS,
+        default='json',
+        help="How raw annotations have been written: one JSON file per "
+        "frame, or a columnar store.")
+
     args = parser.parse_args()
 
-    # Manually set start and end frame
-    args.start_frame = args.target_frame - args.window
-    args.end_frame = args.target_frame + args.window
+    args.target_frames = sorted(
+        set(t for frames in args.target_frames for t in frames))
 
     return args
 
 
-def main():
+def group_targets(targets, window):
+    """
+    Group (sorted) target frames whose windows overlap, so that the
+    annotations needed by each group are read only once.
 
-    args = parse_args()
+    Returns
+    -------
+
+    list
+        A list of `(start_frame, end_frame, targets)` tuples.
+    """
+
+    groups = list()
 
-    # Keep track of previous frames
-    annotations_history = list()
+    for t in targets:
 
-    # First create a list of detections in all frames, in order to be able in a
-    # second passage to fill in missing detections/correct them.
-    for t in range(args.start_frame, args.end_frame+1):
+        if groups and t - window <= groups[-1][1] + 1:
+            groups[-1][1] = t + window
+            groups[-1][2].append(t)
+        else:
+            groups.append([t - window, t + window, [t]])
 
-        annotations_file = os.path.join(
-            args.aux_folder,
-            "frame{:05d}_annotations.json".format(t))
+    return [tuple(g) for g in groups]
 
-        # Load annotations from json file
-        with open(annotations_file, 'r') as jf:
-            annotations = json.load(jf)
 
-        # Save annotations for a given frame
-        annotations_history.append(annotations)
+def debug_frame(annotations_window, start_frame, target_frame, window):
 
-    # Then, try to fill in gaps using information from surrounding frames
-    i = args.window
+    print("Processing frame {}".format(target_frame))
 
-    print("Processing frame {}".format(args.target_frame))
+    # The window of frames around the target one. Annotations are copied, so
+    # that each target frame is processed as if it was the only one.
+    i = target_frame - start_frame
+
+    annotations_history = copy.deepcopy(
+        annotations_window[i-window:i+window+1])
 
     # Process annotations
     annotations_unique = process_annotations(
-        annotations_history, i, args.window)
+        annotations_history, window, window)
 
     # sad
     print(60*"=")
@@ -76,15 +110,24 @@ def main():
 
     # print(annotations_unique)
 
-    return
 
-    annotations_unique_file = os.path.join(
-        args.aux_folder,
-        "frame{:05d}_annotations_unique.json".format(args.target_frame))
+def main():
+
+    args = parse_args()
+
+    annotations = open_annotations(args.aux_folder, 'annotations', args.format)
+
+    for start_frame, end_frame, targets in group_targets(
+            args.target_frames, args.window):
+
+        # Annotations of all frames needed by this group of target frames,
+        # read once
+        annotations_window = annotations.read_range(start_frame, end_frame)
+
+        for t in targets:
+            debug_frame(annotations_window, start_frame, t, args.window)
 
-    # Load annotations from json file
-    with open(annotations_unique_file, 'w') as jf:
-        annotations = json.dump(annotations_unique, jf, indent=4)
+    annotations.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+import os
+
+import json
+
+import pickle
+
+import hashlib
+
+import numpy as np
+
+
+# Hashes of the model files read so far, by path
+_file_hashes = dict()
+
+
+def file_hash(path):
+    """
+    SHA-1 of the content of a file (e.g. network weights), computed once per
+    process.
+    """
+
+    if isinstance(path, bytes):
+        path = path.decode('utf-8')
+
+    if path not in _file_hashes:
+
+        h = hashlib.sha1()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+
+        _file_hashes[path] = h.hexdigest()
+
+    return _file_hashes[path]
+
+
+class DetectionCache(object):
+    """
+    On-disk cache of the results of a detection stage, so that frames which
+    have already been processed with the same models and parameters are not
+    processed again.
+
+    Results are keyed by the SHA-1 of the content of the image passed to the
+    network, the hashes of the model files and the parameters of the stage,
+    and are stored as pickle files in `<cache_dir>/<stage>`. When the size of
+    that folder exceeds `max_size`, the least recently used results are
+    removed.
+
+    Parameters
+    ----------
+
+    cache_dir : str
+        The root folder of the cache, shared by all stages.
+
+    stage : str
+        The name of the stage (e.g. 'vehicles'), used as sub-folder.
+
+    model_files : list
+        Paths of the files defining the model (weights, configuration, ...).
+
+    params : dict, optional
+        Any other parameter affecting the results (e.g. thresholds). Must be
+        serializable as JSON.
+
+    max_size : int, optional
+        Maximum size of the cache of the stage, in bytes. Default to no limit.
+    """
+
+    def __init__(self, cache_dir, stage, model_files, params=None,
+                 max_size=None):
+
+        self.folder = os.path.join(cache_dir, stage)
+        self.max_size = max_size
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+        model = hashlib.sha1()
+        for path in model_files:
+            model.update(file_hash(path).encode('ascii'))
+        model.update(json.dumps(params or {}, sort_keys=True).encode('utf-8'))
+
+        self._model_key = model.digest()
+
+        self.size = sum(size for _, _, size in self._entries())
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, I):
+        """
+        The key of the results for image `I`.
+        """
+
+        I = np.ascontiguousarray(I)
+
+        h = hashlib.sha1(self._model_key)
+        h.update(str((I.shape, I.dtype.str)).encode('ascii'))
+        h.update(I.data)
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key + '.pkl')
+
+    def get(self, key):
+        """
+        The results stored for `key`, or `None` if there are none.
+        """
+
+        path = self._path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+
+        return value
+
+    def put(self, key, value):
+        """
+        Store the results for `key`, evicting old results if needed.
+        """
+
+        path = self._path(key)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        # Write to a temporary file first, so that readers never see a
+        # partially written entry
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+
+        # An existing entry (e.g. written meanwhile by another process
+        # sharing the cache) is replaced, not added
+        try:
+            self.size -= os.stat(path).st_size
+        except OSError:
+            pass
+
+        self.size += os.path.getsize(tmp_path)
+
+        os.replace(tmp_path, path)
+
+        if self.max_size is not None and self.size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        """
+        `(mtime, path, size)` for each entry of the cache.
+        """
+
+        entries = list()
+
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith('.pkl'):
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    entries.append((st.st_mtime, path, st.st_size))
+
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache takes at most
+        90% of `max_size`, so that eviction does not run on every `put`.
+        """
+
+        entries = sorted(self._entries())
+
+        self.size = sum(size for _, _, size in entries)
+
+        for _, path, size in entries:
+
+            if self.size <= 0.9 * self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process
+                pass
+
+            self.size -= size
+
+    def summary(self):
+        return "{}: {} hits, {} misses, {:.1f} MB".format(
+            os.path.basename(self.folder), self.hits, self.misses,
+            self.size / 2.**20)
+
+
+def open_cache(cache_dir, stage, model_files, params=None, max_size_mb=None):
+    """
+    Open the cache of a stage, or return `None` if `cache_dir` is not set
+    (i.e. caching is disabled).
+    """
+
+    if cache_dir is None:
+        return None
+
+    max_size = None if max_size_mb is None else int(max_size_mb * 2**20)
+
+    return DetectionCache(cache_dir, stage, model_files, params, max_size)
+
+
+def cached(cache, I, detect):
+    """
+    Return `detect(I)`, taking it from `cache` when possible and storing it
+    otherwise. With no cache, `detect` is always called.
+    """
+
+    if cache is None:
+        return detect(I)
+
+    key = cache.key(I)
+
+    value = cache.get(key)
+
+    if value is None:
+        value = detect(I)
+        cache.put(key, value)
+
+    return value
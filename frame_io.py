@@ -0,0 +1,367 @@
+import os
+
+import re
+
+import sys
+
+import subprocess
+
+from glob import glob
+
+import cv2
+
+import numpy as np
+
+from src.utils import image_files_from_folder
+
+
+FRAME_NAME_PATTERN = re.compile(r"^frame(\d+)$")
+
+# Formats of the crops (vehicles, license plates) passed between stages
+CROP_FORMATS = ['png', 'jpg', 'ppm', 'npy']
+
+
+class Frame(object):
+    """
+    A frame decoded in memory, shared by all stages that need its pixels.
+
+    Parameters
+    ----------
+
+    name : str
+        The base name of the frame (e.g. 'frame00042'), used to name output
+        files.
+
+    image : numpy.ndarray
+        The decoded frame, as a BGR uint8 array.
+
+    number : int, optional
+        The frame number, if known.
+    """
+
+    def __init__(self, name, image, number=None):
+
+        self.name = name
+        self.image = image
+        self.number = number
+
+    @property
+    def size(self):
+        """
+        The size of the frame, as `(width, height)`.
+        """
+        return self.image.shape[1], self.image.shape[0]
+
+
+class ImageFolderSource(object):
+    """
+    Iterate over the images in a folder (sorted by name), decoding each of
+    them exactly once.
+
+    Frame numbers are taken from names such as 'frame00042.png'.
+
+    Parameters
+    ----------
+
+    folder : str
+        The folder containing the images.
+
+    paths : list, optional
+        The files to read, in any of the formats supported by `read_crop`.
+        Default to all JPEG and PNG images in `folder`.
+    """
+
+    def __init__(self, folder, paths=None):
+
+        self.folder = folder
+
+        self.paths = image_files_from_folder(folder) if paths is None \
+            else list(paths)
+        self.paths.sort()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+
+        for path in self.paths:
+
+            name = os.path.splitext(os.path.basename(path))[0]
+
+            match = FRAME_NAME_PATTERN.match(name)
+            number = int(match.group(1)) if match else None
+
+            image = read_crop(path)
+
+            if image is None:
+                print("Could not decode {}, skipping".format(path))
+                continue
+
+            yield Frame(name, image, number)
+
+
+class VideoSource(object):
+    """
+    Decode frames from a video file (anything OpenCV `VideoCapture` can
+    read) one at a time, without extracting them to disk.
+
+    Frames are named 'frameNNNNN' (numbering starts from `start_frame`), so
+    that the output files have the same names they would have if frames
+    were extracted with ffmpeg.
+    """
+
+    def __init__(self, path, start_frame=1):
+
+        self.path = path
+        self.start_frame = start_frame
+
+        cap = cv2.VideoCapture(path)
+
+        if not cap.isOpened():
+            raise IOError("Could not open video {}".format(path))
+
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        self.n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        cap.release()
+
+    def __len__(self):
+        return self.n_frames
+
+    def __iter__(self):
+
+        cap = cv2.VideoCapture(self.path)
+
+        try:
+            number = self.start_frame
+
+            while True:
+
+                ok, image = cap.read()
+
+                if not ok:
+                    break
+
+                yield Frame("frame{:05d}".format(number), image, number)
+
+                number += 1
+
+        finally:
+            cap.release()
+
+
+def open_frame_source(path):
+    """
+    Return the frame source for `path`: a folder of images or a video file.
+    """
+
+    if os.path.isdir(path):
+        return ImageFolderSource(path)
+
+    return VideoSource(path)
+
+
+def write_crop(path, image, fmt='png', jpeg_quality=95):
+    """
+    Write a crop in one of `CROP_FORMATS`.
+
+    'npy' files are uncompressed and can be memory-mapped when read back,
+    'ppm' files are uncompressed images, 'jpg' files are compressed (lossy)
+    with the given quality; all of them are faster to write than 'png'.
+
+    Parameters
+    ----------
+
+    path : str
+        The path of the file, without extension (which is added according to
+        the format).
+
+    image : numpy.ndarray
+        The crop, as a BGR image. Float images are expected in the 0-255
+        range, and are rounded to uint8.
+
+    Returns
+    -------
+
+    str
+        The path of the file written.
+    """
+
+    if fmt not in CROP_FORMATS:
+        raise ValueError("Unknown crop format: {}".format(fmt))
+
+    if image.dtype != np.uint8:
+        image = np.clip(np.round(image), 0, 255).astype(np.uint8)
+
+    path = '{}.{}'.format(path, fmt)
+
+    if fmt == 'npy':
+        np.save(path, image)
+    elif fmt == 'jpg':
+        cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    else:
+        cv2.imwrite(path, image)
+
+    return path
+
+
+def read_crop(path):
+    """
+    Read a crop written by `write_crop` (any format), as a BGR uint8 image.
+    '.npy' files are memory-mapped. Return `None` if the file cannot be
+    decoded.
+    """
+
+    if path.endswith('.npy'):
+        # A truncated or corrupt file raises, where cv2.imread returns None
+        try:
+            return np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+
+    return cv2.imread(path)
+
+
+def crop_files(folder, pattern):
+    """
+    The (sorted) paths of the crops in `folder` whose name without
+    extension matches the glob `pattern`, in any of `CROP_FORMATS`.
+    """
+
+    paths = list()
+
+    for fmt in CROP_FORMATS:
+        paths += glob(os.path.join(folder, '{}.{}'.format(pattern, fmt)))
+
+    return sorted(paths)
+
+
+class VideoFrameWriter(object):
+    """
+    Write BGR frames straight into a video file using OpenCV `VideoWriter`.
+
+    The size of the video is taken from the first frame written.
+    """
+
+    def __init__(self, path, fps=25, fourcc='mp4v'):
+
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+
+        self._writer = None
+
+    def write(self, image):
+
+        if self._writer is None:
+            h, w = image.shape[:2]
+            self._writer = cv2.VideoWriter(
+                self.path, cv2.VideoWriter_fourcc(*self.fourcc),
+                self.fps, (w, h))
+
+        self._writer.write(image)
+
+    def close(self):
+
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FFmpegWriter(object):
+    """
+    Encode frames into a video file by writing them, as raw video, to the
+    standard input of an `ffmpeg` process.
+
+    The size of the video is taken from the first frame written; all frames
+    must have the same size.
+
+    Parameters
+    ----------
+
+    path : str
+        The output video file.
+
+    fps : float, optional
+        The frame rate of the video. Default to 25.
+
+    pix_fmt : str, optional
+        The pixel format of the frames written, 'bgr24' (OpenCV images) or
+        'rgb24' (PIL images). Default to 'bgr24'.
+
+    codec : str, optional
+        The video codec. Default to 'libx264'.
+
+    ffmpeg : str, optional
+        The ffmpeg executable. Default to 'ffmpeg'.
+    """
+
+    def __init__(self, path, fps=25, pix_fmt='bgr24', codec='libx264',
+                 ffmpeg='ffmpeg'):
+
+        self.path = path
+        self.fps = fps
+        self.pix_fmt = pix_fmt
+        self.codec = codec
+        self.ffmpeg = ffmpeg
+
+        self._process = None
+        self._shape = None
+
+    def write(self, image):
+
+        if self._process is None:
+
+            self._shape = image.shape
+            h, w = image.shape[:2]
+
+            self._process = subprocess.Popen([
+                self.ffmpeg, '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', self.pix_fmt,
+                '-s', '{}x{}'.format(w, h), '-r', str(self.fps),
+                '-i', '-',
+                '-c:v', self.codec, '-pix_fmt', 'yuv420p',
+                self.path], stdin=subprocess.PIPE)
+
+        if image.shape != self._shape:
+            raise ValueError(
+                "Frame of shape {} written to a video of shape {}".format(
+                    image.shape, self._shape))
+
+        self._process.stdin.write(image.astype('uint8', copy=False).tobytes())
+
+    def close(self):
+        """
+        Finish the video, raising `IOError` if ffmpeg failed. When called
+        while an exception is propagating (e.g. from a `finally` block after
+        a write failed because ffmpeg died), the exit status is not raised,
+        so that it does not mask the original error.
+        """
+
+        if self._process is not None:
+
+            try:
+                self._process.stdin.close()
+            except (IOError, OSError):
+                # Broken pipe, ffmpeg has exited: reported by its status
+                pass
+
+            returncode = self._process.wait()
+            self._process = None
+
+            if returncode != 0 and sys.exc_info()[0] is None:
+                raise IOError(
+                    "ffmpeg exited with status {} writing {}".format(
+                        returncode, self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,9 +3,9 @@
 #VIDEO=$1
 FRAMES_FOLDER=$1
 
-# Create images with detections
+# Create images with detections, encoding annotated frames straight into the
+# video (use create-video-from-frames.sh to make a video from PNG files)
 #./run-simple.sh -i $FRAMES_FOLDER -o "${FRAMES_FOLDER}_out" -d
-./run-simple.sh -i $FRAMES_FOLDER -d
-
-# Create video starting from annotated frames
-./create-video-from-frames.sh "${FRAMES_FOLDER}_out/results"
+mkdir -p "${FRAMES_FOLDER}_out/results"
+./run-simple.sh -i $FRAMES_FOLDER -d \
+    -v "${FRAMES_FOLDER}_out/results/output_$(date +%Y%m%d_%H%M).mp4"
@@ -6,22 +6,25 @@ from PIL import Image
 
 from src.utils import image_files_from_folder
 
-import pandas as pd
+from src.label import lread_arrays
+
+from utils import validate_lp_text, print_worker_summary
+
+from frame_io import FRAME_NAME_PATTERN
+
+from annotation_store import ANNOTATION_FORMATS, open_annotations
 
 import time
 
 import json
 
+from multiprocessing import Pool
+
 # Import parameters such as symbols and colors from separate file
 # from constants import (
     # LINE_WIDTH, VEHICLE_SYMBOLS, VEHICLE_COLORS,  # noqa
     # TEXT_FG_COLOR, SCALE)  # noqa
 
-# TODO move somewhere else
-import re
-
-LP_PATTERN = re.compile("^[A-FZ][A-Z][\d]{3}[A-Z]{2}$")  # noqa
-
 
 def parse_args():
 
@@ -46,187 +49,302 @@ def parse_args():
         type=int,
         help="The height of the original image")
 
-    return parser.parse_args()
+    parser.add_argument(
+        '--format',
+        choices=ANNOTATION_FORMATS,
+        default='json',
+        help="How annotations are written: one JSON file per frame, or a "
+        "single columnar store (the 'annotations' folder inside aux_folder), "
+        "which requires images to be named 'frameNNNNN'.")
 
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of processes used to generate annotations.")
 
-def validate_lp_text(lp_text):
-    """
-    Optional step to validate license plate
-    E.g.: italian ones should be two letters, three digits and two letters
-    """
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        help="Number of consecutive frames given to a worker at a time "
+        "(default: the number of frames divided by 4 times the number of "
+        "workers).")
 
-    return LP_PATTERN.match(lp_text) is not None
+    return parser.parse_args()
 
 
-def get_annotations_from_car_crop(car_id, car_row, base_image_name,
-                                  w, h, args):
+def get_annotations_from_car_crop(car_id, car_ccwh, vehicle_category,
+                                  base_name, w, h, aux_files, args,
+                                  track_id=None):
     """
+    car_ccwh : numpy.ndarray
+        Center and size of the vehicle, relative to the original image.
+
+    track_id : int, optional
+        The id of the track of the vehicle, if vehicles have been tracked.
+
     w, h : int
         Size of original image (needed to compute absolute coordinates)
+
+    aux_files : set
+        The names of the files in the aux folder.
     """
 
     # Prepare dictionary for output
     out = dict()
 
     # Reconstruct crop coordinates and size
-    car_crop_w = car_row.w * w
-    car_crop_h = car_row.h * h
-
-    car_crop_x = car_row.x * w - car_crop_w/2
-    car_crop_y = car_row.y * h - car_crop_h/2
+    car_crop_w = car_ccwh[2] * w
+    car_crop_h = car_ccwh[3] * h
 
-    # Extract category of the vehicle
-    vehicle_category = car_row.category
+    car_crop_x = car_ccwh[0] * w - car_crop_w/2
+    car_crop_y = car_ccwh[1] * h - car_crop_h/2
 
     # Save category and bounding box
     out['category'] = vehicle_category
     out['bounding_box'] = (car_crop_x, car_crop_y, car_crop_w, car_crop_h)
 
+    if track_id is not None:
+        out['track_id'] = track_id
+
     # Initialize list to save recognized plates
     out['plates'] = list()
 
     # Look for all detected licence plates for that car (most of the time
     # it's just one)
-    try:
-        car_lp_detections_file = os.path.join(
-            args.aux_folder,
-            "{}_car_{}_lp.txt".format(base_image_name[:-4], car_id))
-
-        lp_df = pd.read_csv(
-            car_lp_detections_file,
-            header=None, sep=' ',
-            names=['cc', 'x', 'y', 'w', 'h'])
-
-        for lp_id, lp_row in lp_df.iterrows():
-
-            # Compute coordinates of lp crop (these are with respect to the car
-            # crop)
-            lp_crop_w = lp_row.w * car_crop_w
-            lp_crop_h = lp_row.h * car_crop_h
+    car_lp_detections_file = "{}_car_{}_lp.txt".format(base_name, car_id)
 
-            lp_crop_x = lp_row.x * car_crop_w - lp_crop_w/2
-            lp_crop_y = lp_row.y * car_crop_h - lp_crop_h/2
+    if car_lp_detections_file not in aux_files:
+        return out
 
-            # Compute absolute coordinates of the lp crop
-            lp_crop_x_absolute = lp_crop_x + car_crop_x
-            lp_crop_y_absolute = lp_crop_y + car_crop_y
+    # A malformed file (e.g. corners of a plate written by WPOD-NET, rather
+    # than labels) only loses the plates of this vehicle
+    try:
+        _, lp_ccwh, _ = lread_arrays(
+            os.path.join(args.aux_folder, car_lp_detections_file))
+    except Exception as e:
+        print("Cannot read {}: {}".format(car_lp_detections_file, e))
+        return out
 
-            # Create dictionary for license plate data
-            lp_dict = dict()
+    # Compute coordinates of lp crops (these are with respect to the car
+    # crop), for all plates at once
+    lp_crop_w = lp_ccwh[:, 2] * car_crop_w
+    lp_crop_h = lp_ccwh[:, 3] * car_crop_h
 
-            # Save coordinates of the bounding box of the licencse plate
-            plate_bounding_box = (
-                lp_crop_x_absolute, lp_crop_y_absolute,
-                lp_crop_w, lp_crop_h)
+    lp_crop_x = lp_ccwh[:, 0] * car_crop_w - lp_crop_w/2
+    lp_crop_y = lp_ccwh[:, 1] * car_crop_h - lp_crop_h/2
 
-            lp_dict['bounding_box'] = plate_bounding_box
+    # Compute absolute coordinates of the lp crops
+    lp_crop_x_absolute = lp_crop_x + car_crop_x
+    lp_crop_y_absolute = lp_crop_y + car_crop_y
 
-            # Fill fields with invalid values, will be replaced by valid ones
-            lp_dict['plate_text'] = None
-            lp_dict['valid_plate'] = False
+    for lp_id, plate_bounding_box in enumerate(zip(
+            lp_crop_x_absolute.tolist(), lp_crop_y_absolute.tolist(),
+            lp_crop_w.tolist(), lp_crop_h.tolist())):
 
-            try:
+        # Create dictionary for license plate data
+        lp_dict = dict()
 
-                car_lp_ocrout_file = os.path.join(
-                    args.aux_folder,
-                    "{}_car_{}_{}_lp_str.txt".format(
-                        base_image_name[:-4], car_id, lp_id))
+        # Save coordinates of the bounding box of the licencse plate
+        lp_dict['bounding_box'] = plate_bounding_box
 
-                with open(car_lp_ocrout_file, 'r') as lp_ocr_f:
-                    lp_text = lp_ocr_f.read().strip()
+        # Fill fields with invalid values, will be replaced by valid ones
+        lp_dict['plate_text'] = None
+        lp_dict['valid_plate'] = False
 
-                # If there was recognized plate_text, save it in the dictionary
-                lp_dict['plate_text'] = lp_text
+        car_lp_ocrout_file = "{}_car_{}_{}_lp_str.txt".format(
+            base_name, car_id, lp_id)
 
-                if validate_lp_text(lp_text):
+        if car_lp_ocrout_file in aux_files:
 
-                    # Plate number has been recognized as valid
-                    lp_dict['valid_plate'] = True
+            with open(
+                    os.path.join(args.aux_folder, car_lp_ocrout_file),
+                    'r') as lp_ocr_f:
+                lp_text = lp_ocr_f.read().strip()
 
+            # If there was recognized plate_text, save it in the dictionary
+            lp_dict['plate_text'] = lp_text
 
-            except Exception as e:  # noqa
-                # print(e)
-                pass
+            if validate_lp_text(lp_text):
 
-            # List Add the license plate to the list of recognized ones
-            out['plates'].append(lp_dict)
+                # Plate number has been recognized as valid
+                lp_dict['valid_plate'] = True
 
-    except Exception as e:  # noqa
-        # print(e)
-        pass
+        # List Add the license plate to the list of recognized ones
+        out['plates'].append(lp_dict)
 
     return out
 
 
-def process_image(img_path, args):
+def process_image(img_path, args, aux_files):
     """
     Take as input the path of one input image and the arguments passed to the
     script and proceeds to retrieving all required information to display the
     license plate number close to the car.
+
+    Returns
+    -------
+
+    tuple
+        The base name of the image and its annotations.
     """
 
     # Extract filename
     base_image_name = os.path.basename(img_path)
+    base_name = base_image_name[:-4]
 
     # In case width and height are not specified, retrieve from image
     if args.width is None or args.height is None:
-        # Load the entire image
-        img_full = Image.open(img_path)
-        w, h = img_full.size
+        # Only the header is read here, pixels are not decoded
+        with Image.open(img_path) as img_full:
+            w, h = img_full.size
     else:
         w, h = args.width, args.height
 
-    tic = time.time()
-
     # Prepare output dictionary
     annotations = dict()
     annotations['cars'] = list()
 
-    try:
+    # First get the list of cars
+    cars_file = "{}_cars.txt".format(base_name)
 
-        # First get the list of cars
-        cars_df = pd.read_csv(
-            os.path.join(
-                args.aux_folder, "{}_cars.txt".format(base_image_name[:-4])),
-            header=None, sep=' ',
-            names=['cc', 'x', 'y', 'w', 'h', 'category'])
+    if cars_file in aux_files:
 
-        # for car_id, car_row in enumerate(cars_df.iterrows()):
-        for car_id, car_row in cars_df.iterrows():
+        try:
 
-            car_annotations = get_annotations_from_car_crop(
-                car_id, car_row, base_image_name, w, h, args)
+            _, cars_ccwh, extra = lread_arrays(
+                os.path.join(args.aux_folder, cars_file))
 
-            annotations['cars'].append(car_annotations)
+            for car_id, (car_ccwh, car_extra) in enumerate(
+                    zip(cars_ccwh, extra)):
 
-    except Exception as e:  # noqa
-        pass
+                # Extract category and track id of the vehicle
+                vehicle_category = car_extra[0] if len(car_extra) else None
+                track_id = int(car_extra[1]) if len(car_extra) > 1 else None
 
-    with open(
-            os.path.join(
-                args.aux_folder,
-                "{}_annotations.json".format(base_image_name[:-4])),
-            'w') as jf:
+                car_annotations = get_annotations_from_car_crop(
+                    car_id, car_ccwh.tolist(), vehicle_category, base_name,
+                    w, h, aux_files, args, track_id)
 
-        json.dump(annotations, jf, indent=4)
+                annotations['cars'].append(car_annotations)
 
-    toc = time.time()
+        except Exception as e:
+            # The frame is written without vehicles, the run goes on
+            print("Cannot read the vehicles of {}: {}".format(base_name, e))
+            annotations['cars'] = list()
+
+    return base_name, annotations
 
-    print("Done, elapsed time = {}".format(toc-tic))
 
-    return
+# Arguments and content of the aux folder, set once in each worker process
+_worker_context = dict()
+
+
+def init_worker(args, aux_files):
+    _worker_context['args'] = args
+    _worker_context['aux_files'] = aux_files
+
+
+def run_task(img_path):
+    """
+    Process one image in a worker. With the JSON format annotations are
+    written here (files of different frames are independent), otherwise they
+    are returned so that they can be appended to the store in order.
+
+    Returns
+    -------
+
+    tuple
+        `(base_name, annotations, pid, elapsed)`, where `annotations` is
+        `None` if they have already been written.
+    """
+
+    args = _worker_context['args']
+
+    tic = time.time()
+
+    base_name, annotations = process_image(
+        img_path, args, _worker_context['aux_files'])
+
+    if args.format == 'json':
+
+        with open(
+                os.path.join(
+                    args.aux_folder,
+                    "{}_annotations.json".format(base_name)),
+                'w') as jf:
+
+            json.dump(annotations, jf, indent=4)
+
+        annotations = None
+
+    toc = time.time()
+
+    return base_name, annotations, os.getpid(), toc-tic
 
 
 def main():
 
     args = parse_args()
 
-    # Retrieve the names of the input images
+    # Retrieve the names of the input images (sorted, since frames are
+    # appended to the columnar store in order)
     imgs_paths = image_files_from_folder(args.input_folder)
+    imgs_paths.sort()
+
+    # List the aux folder once, instead of probing for the files of each
+    # vehicle and plate
+    aux_files = set(os.listdir(args.aux_folder))
+
+    store = None
+
+    if args.format == 'columnar':
+        store = open_annotations(
+            args.aux_folder, 'annotations', args.format, 'w')
+
+    chunk_size = args.chunk_size or \
+        max(1, len(imgs_paths) // (4 * args.workers))
+
+    pool = None
+
+    if args.workers > 1:
+        pool = Pool(args.workers, init_worker, (args, aux_files))
+        results = pool.imap(run_task, imgs_paths, chunk_size)
+    else:
+        init_worker(args, aux_files)
+        results = map(run_task, imgs_paths)
+
+    # Number of frames and time spent by each worker
+    worker_stats = dict()
+
+    tic = time.time()
+
+    try:
+        # Results come in the same order as images
+        for base_name, annotations, pid, elapsed in results:
+
+            if store is not None:
+
+                match = FRAME_NAME_PATTERN.match(base_name)
+
+                if match is None:
+                    raise ValueError(
+                        "Cannot get the frame number of {}".format(base_name))
+
+                store.append(int(match.group(1)), annotations)
+
+            n, busy = worker_stats.get(pid, (0, 0.))
+            worker_stats[pid] = (n + 1, busy + elapsed)
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if store is not None:
+            store.close()
+
+    toc = time.time()
 
-    for img_path in imgs_paths:
-        # Process each image individually
-        process_image(img_path, args)
+    print_worker_summary(worker_stats, args.workers, toc-tic)
 
 
 if __name__ == "__main__":
@@ -3,10 +3,16 @@ import cv2
 import traceback
 
 from glob import glob
-from os.path import splitext, basename
+from os import remove
+from os.path import splitext, basename, isfile
 from src.utils import im2single
-from src.keras_utils import load_model, detect_lp
-from src.label import Shape, writeShapes
+from src.keras_utils import load_model, detect_lp_batch, get_bound_dim
+from src.label import LabelSet, Shape, writeShapes
+from frame_io import CROP_FORMATS, FRAME_NAME_PATTERN, crop_files, \
+    read_crop, write_crop
+from detection_cache import open_cache
+from manifest import open_manifest, group_crops
+from plate_tracker import PlateTracker
 
 import argparse
 
@@ -15,15 +21,197 @@ def adjust_pts(pts, lroi):
     return pts*lroi.wh().reshape((2, 1)) + lroi.tl().reshape((2, 1))
 
 
+def crop_track_ids(input_dir, frame_name, paths):
+    """
+    The track ids of the vehicles in a list of crops of a frame (-1 if the
+    vehicle is not tracked), read from <frame>_cars.txt.
+    """
+
+    cars_file = '%s/%s_cars.txt' % (input_dir, frame_name)
+
+    track_ids = LabelSet.read(cars_file).track_ids if isfile(cars_file) \
+        else []
+
+    ids = list()
+
+    for path in paths:
+        # Crops are named <frame>_car_<N>, N being the line in <frame>_cars.txt
+        i = int(splitext(basename(path))[0].split('_car_')[1])
+        ids.append(int(track_ids[i]) if i < len(track_ids) else -1)
+
+    return ids
+
+
+def write_plate(output_dir, bname, pts, Ilp, crop_format, jpeg_quality):
+    """
+    Write the crop and the corners of the plate found in a vehicle crop.
+    """
+
+    Ilp = cv2.cvtColor(Ilp, cv2.COLOR_BGR2GRAY)
+    Ilp = cv2.cvtColor(Ilp, cv2.COLOR_GRAY2BGR)
+
+    write_crop(
+        '%s/%s_lp' % (output_dir, bname), Ilp*255., crop_format, jpeg_quality)
+    writeShapes('%s/%s_lp.txt' % (output_dir, bname), [Shape(pts)])
+
+
+def process_batch(wpod_net, Ivehicles, lp_threshold, cache=None):
+    """
+    Detect license plates in a batch of vehicle crops, with a single call to
+    the network for the crops not found in the cache.
+
+    Returns
+    -------
+
+    list
+        For each crop, the labels and the images of the plates found (at
+        most one).
+    """
+
+    results = [None]*len(Ivehicles)
+
+    if cache is not None:
+        keys = [cache.key(Ivehicle) for Ivehicle in Ivehicles]
+        results = [cache.get(key) for key in keys]
+
+    # Only crops not found in the cache go through the network
+    todo = [i for i, r in enumerate(results) if r is None]
+
+    elapsed = 0.
+
+    if len(todo):
+        batch_results, elapsed = detect_lp_batch(
+            wpod_net, [im2single(Ivehicles[i]) for i in todo],
+            [get_bound_dim(Ivehicles[i]) for i in todo],
+            2**4, (240, 80),
+            lp_threshold)
+
+        for i, (Llp, LlpImgs) in zip(todo, batch_results):
+            # Only the first plate is used
+            results[i] = (Llp[:1], LlpImgs[:1])
+            if cache is not None:
+                cache.put(keys[i], results[i])
+
+    print('\t Processed %d crops (%d cached), elapsed time = %f' % (
+        len(Ivehicles), len(Ivehicles) - len(todo), elapsed))
+
+    return results
+
+
+def flush_queue(queue, queued_frames, manifest, wpod_net, lp_threshold,
+                cache, plate_tracker, args):
+    """
+    Run WPOD-NET on the queued vehicle crops, given as `(name, track id,
+    image)`, with a single call to the network, and complete the frames they
+    come from. Both lists are emptied.
+
+    Returns
+    -------
+
+    bool
+        Whether the crops have been processed. If not, their frames are
+        marked as failed and the plate tracker is emptied, since it has
+        missed those frames.
+    """
+
+    output_dir = args.input_dir
+
+    try:
+
+        results = process_batch(
+            wpod_net, [Ivehicle for _, _, Ivehicle in queue], lp_threshold,
+            cache)
+
+        for (bname, track_id, _), (Llp, LlpImgs) in zip(queue, results):
+
+            if len(LlpImgs):
+                write_plate(
+                    output_dir, bname, Llp[0].pts, LlpImgs[0],
+                    args.crop_format, args.jpeg_quality)
+
+            if plate_tracker is not None:
+                if len(LlpImgs):
+                    plate_tracker.update(track_id, Llp[0].pts, LlpImgs[0])
+                else:
+                    plate_tracker.update(track_id)
+
+    except Exception as e:
+        for frame_name in queued_frames:
+            manifest.failed(frame_name, e)
+
+        if plate_tracker is not None:
+            plate_tracker.prune([])
+
+        success = False
+
+    else:
+        for frame_name in queued_frames:
+            manifest.done(frame_name)
+
+        success = True
+
+    del queue[:]
+    del queued_frames[:]
+
+    return success
+
+
 def parse_args():
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument('input_dir')
 
+    parser.add_argument(
+        'wpod_net', nargs='?', default='data/lp-detector/wpod-net_update1.h5',
+        help="Path to the Keras WPOD-NET model.")
+
     parser.add_argument(
         '--lp_threshold', type=float, default=0.5)
 
+    parser.add_argument(
+        '--batch_size', type=int, default=32,
+        help="Number of vehicle crops processed with a single call to the "
+        "network.")
+
+    parser.add_argument(
+        '--crop_format', choices=CROP_FORMATS, default='png',
+        help="Format of the crops written for the following stages: png, "
+        "jpg (see --jpeg_quality), ppm or npy (uncompressed, fastest).")
+
+    parser.add_argument(
+        '--jpeg_quality', type=int, default=95,
+        help="Quality of jpg crops (0-100).")
+
+    parser.add_argument(
+        '--cache_dir',
+        help="If set, results are cached in this folder, keyed by the "
+        "content of the images, the models and the thresholds, so that "
+        "images already processed are skipped when running again.")
+
+    parser.add_argument(
+        '--cache_size', type=float, default=2048,
+        help="Maximum size of the cache of this stage, in MB; least recently "
+        "used results are removed first.")
+
+    parser.add_argument(
+        '--plate_interval', type=int,
+        help="If set, plates of tracked vehicles (see `--keyframe_interval` "
+        "in vehicle-detection.py) are predicted from the last detection, and "
+        "WPOD-NET runs on a vehicle only once every this number of frames, "
+        "or when the predicted plate does not match the detected one (see "
+        "`--plate_similarity`).")
+
+    parser.add_argument(
+        '--plate_similarity', type=float, default=0.6,
+        help="Minimum correlation between a predicted plate and the last "
+        "detected one to accept the prediction.")
+
+    parser.add_argument(
+        '--restart', action='store_true',
+        help="Process all frames, ignoring the ones completed by a previous "
+        "run (see `manifest.py`).")
+
     return parser.parse_args()
 
 
@@ -38,39 +226,147 @@ if __name__ == '__main__':
 
         lp_threshold = args.lp_threshold
 
-        wpod_net_path = sys.argv[2]
-        wpod_net = load_model(wpod_net_path)
+        wpod_net = load_model(args.wpod_net)
+
+        wpod_net_name = splitext(args.wpod_net)[0]
+        cache = open_cache(
+            args.cache_dir, 'wpod',
+            ['%s.json' % wpod_net_name, '%s.h5' % wpod_net_name],
+            {'thresh': lp_threshold}, args.cache_size)
+
+        manifest, upstream = open_manifest(
+            output_dir, 'lp-detection',
+            {'lp_detector': 'wpod', 'wpod_net': args.wpod_net,
+             'lp_threshold': lp_threshold, 'crop_format': args.crop_format,
+             'jpeg_quality': args.jpeg_quality,
+             'plate_interval': args.plate_interval,
+             'plate_similarity': args.plate_similarity},
+            'vehicle-detection', args.restart)
+
+        # Vehicle crops are named <frame>_car_<N>, in any format
+        crops = group_crops(crop_files(input_dir, '*_car_*[0-9]'))
+
+        # Frames whose vehicles have been detected since the last run
+        pending = manifest.stale_frames(
+            list(crops) if upstream is None else list(upstream.records),
+            upstream)
 
-        imgs_paths = glob('%s/*car.png' % input_dir)
+        print('%d frames to process' % len(pending))
 
         print('Searching for license plates using WPOD-NET')
 
-        for i, img_path in enumerate(imgs_paths):
+        plate_tracker = None
+        if args.plate_interval is not None:
+            plate_tracker = PlateTracker(
+                redetect_interval=args.plate_interval,
+                min_similarity=args.plate_similarity)
 
-            print('\t Processing %s' % img_path)
+        # Vehicle crops waiting for WPOD-NET, as (name, track id, image), and
+        # the frames they come from
+        queue = list()
+        queued_frames = list()
 
-            bname = splitext(basename(img_path))[0]
-            Ivehicle = cv2.imread(img_path)
+        # Number of the last frame whose plates have been tracked, to detect
+        # gaps in the sequence (e.g. frames already done in a previous run)
+        last_number = None
 
-            ratio = float(max(Ivehicle.shape[:2]))/min(Ivehicle.shape[:2])
-            side = int(ratio*288.)
-            bound_dim = min(side + (side % (2**4)), 608)
-            print("\t\tBound dim: %d, ratio: %f" % (bound_dim, ratio))
+        for frame_name in pending:
 
-            Llp, LlpImgs, _ = detect_lp(
-                wpod_net, im2single(Ivehicle), bound_dim,
-                2**4, (240, 80),
-                lp_threshold)
+            # Remove the outputs of any previous run (even one with other
+            # parameters, or before --restart), which might not be
+            # overwritten
+            for p in glob('%s/%s_car_*lp*' % (output_dir, frame_name)):
+                remove(p)
 
-            if len(LlpImgs):
-                Ilp = LlpImgs[0]
-                Ilp = cv2.cvtColor(Ilp, cv2.COLOR_BGR2GRAY)
-                Ilp = cv2.cvtColor(Ilp, cv2.COLOR_GRAY2BGR)
+            paths = crops.get(frame_name, [])
+            Iframe = [read_crop(img_path) for img_path in paths]
+
+            # A frame with a crop which cannot be decoded fails alone
+            if any(I is None for I in Iframe):
+                manifest.failed(frame_name, "could not decode a crop")
+                continue
+
+            track_ids = [-1]*len(paths)
+
+            if plate_tracker is not None:
+
+                try:
+                    track_ids = crop_track_ids(input_dir, frame_name, paths)
+                except Exception as e:
+                    manifest.failed(frame_name, e)
+                    continue
+
+                match = FRAME_NAME_PATTERN.match(frame_name)
+                number = int(match.group(1)) if match else None
+
+                gap = number is not None and last_number is not None and \
+                    number != last_number + 1
+
+                # Plates are predicted from the previous frames, which must
+                # be complete
+                if gap or set(track_ids) & set(t for _, t, _ in queue) - {-1}:
+                    if not flush_queue(
+                            queue, queued_frames, manifest, wpod_net,
+                            lp_threshold, cache, plate_tracker, args):
+                        last_number = None
+
+                # Plates cannot be predicted across a gap in the frames
+                plate_tracker.prune([] if gap else track_ids)
+
+            n_queued = len(queue)
+
+            try:
+
+                for img_path, track_id, Ivehicle in zip(
+                        paths, track_ids, Iframe):
+
+                    bname = splitext(basename(img_path))[0]
+
+                    plate = None
+                    if plate_tracker is not None:
+                        plate = plate_tracker.predict(
+                            track_id, im2single(Ivehicle))
+
+                    if plate is None:
+                        queue.append((bname, track_id, Ivehicle))
+                    else:
+                        write_plate(
+                            output_dir, bname, plate[0], plate[1],
+                            args.crop_format, args.jpeg_quality)
+
+            except Exception as e:
+                del queue[n_queued:]
+                manifest.failed(frame_name, e)
+                continue
+
+            # A failed frame is a gap for the following one
+            if plate_tracker is not None:
+                last_number = number
+
+            if len(queue) > n_queued:
+                queued_frames.append(frame_name)
+            else:
+                manifest.done(frame_name)
+
+            # The frames of a failed batch are a gap for the following one
+            if len(queue) >= args.batch_size and not flush_queue(
+                    queue, queued_frames, manifest, wpod_net, lp_threshold,
+                    cache, plate_tracker, args):
+                last_number = None
+
+        if len(queue):
+            flush_queue(
+                queue, queued_frames, manifest, wpod_net, lp_threshold, cache,
+                plate_tracker, args)
+
+        if plate_tracker is not None:
+            print(plate_tracker.summary())
 
-                s = Shape(Llp[0].pts)
+        print(manifest.summary())
+        manifest.close()
 
-                cv2.imwrite('%s/%s_lp.png' % (output_dir, bname), Ilp*255.)
-                writeShapes('%s/%s_lp.txt' % (output_dir, bname), [s])
+        if cache is not None:
+            print(cache.summary())
 
     except:
         traceback.print_exc()
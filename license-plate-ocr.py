@@ -1,13 +1,18 @@
 import sys
 import traceback
 
+from glob import glob
+from os import remove
+
 import darknet.python.darknet as dn
 
 from os.path import splitext, basename
-from glob import glob
-from darknet.python.darknet import detect
+from src.darknet_utils import detect_array
 from src.label import dknet_label_conversion
 from src.utils import nms
+from frame_io import crop_files, read_crop
+from detection_cache import open_cache, cached
+from manifest import open_manifest, group_crops
 
 import argparse
 
@@ -21,6 +26,22 @@ def parse_args():
     parser.add_argument(
         '--ocr_threshold', type=float, default=0.4)
 
+    parser.add_argument(
+        '--cache_dir',
+        help="If set, results are cached in this folder, keyed by the "
+        "content of the images, the models and the thresholds, so that "
+        "images already processed are skipped when running again.")
+
+    parser.add_argument(
+        '--cache_size', type=float, default=2048,
+        help="Maximum size of the cache of this stage, in MB; least recently "
+        "used results are removed first.")
+
+    parser.add_argument(
+        '--restart', action='store_true',
+        help="Process all frames, ignoring the ones completed by a previous "
+        "run (see `manifest.py`).")
+
     return parser.parse_args()
 
 
@@ -42,36 +63,83 @@ if __name__ == '__main__':
         ocr_net = dn.load_net(ocr_netcfg, ocr_weights, 0)
         ocr_meta = dn.load_meta(ocr_dataset)
 
-        imgs_paths = sorted(glob('%s/*lp.png' % output_dir))
+        cache = open_cache(
+            args.cache_dir, 'ocr', [ocr_weights, ocr_netcfg, ocr_dataset],
+            {'thresh': ocr_threshold, 'nms': None}, args.cache_size)
+
+        manifest, upstream = open_manifest(
+            output_dir, 'ocr', {'ocr_threshold': ocr_threshold},
+            'lp-detection', args.restart)
+
+        # License plate crops, in any format, by frame
+        crops = group_crops(crop_files(output_dir, '*lp'))
+
+        # Frames whose license plates have been detected since the last run
+        pending = manifest.stale_frames(
+            list(crops) if upstream is None else list(upstream.records),
+            upstream)
+
+        print('%d frames to process' % len(pending))
 
         print('Performing OCR...')
 
-        for i, img_path in enumerate(imgs_paths):
+        for frame_name in pending:
+
+            try:
+
+                # Remove the outputs of any previous run (even one with
+                # other parameters, or before --restart), which might not be
+                # overwritten
+                for p in glob(
+                        '%s/%s_car_*_str.txt' % (output_dir, frame_name)):
+                    remove(p)
+
+                for img_path in crops.get(frame_name, []):
+
+                    print('\tScanning %s' % img_path)
 
-            print('\tScanning %s' % img_path)
+                    bname = basename(splitext(img_path)[0])
 
-            bname = basename(splitext(img_path)[0])
+                    Ilp = read_crop(img_path)
 
-            R, (width, height) = detect(
-                ocr_net, ocr_meta, bytes(img_path, encoding='utf-8'),
-                thresh=ocr_threshold, nms=None)
+                    if Ilp is None:
+                        raise IOError("Could not decode %s" % img_path)
 
-            if len(R):
+                    R, (width, height) = cached(
+                        cache, Ilp, lambda I: detect_array(
+                            ocr_net, ocr_meta, I, thresh=ocr_threshold,
+                            nms=None))
 
-                L = dknet_label_conversion(R, width, height)
-                L = nms(L, .45)
+                    if len(R):
 
-                L.sort(key=lambda x: x.tl()[0])
-                lp_str = ''.join([chr(l.cl()) for l in L])
+                        L = dknet_label_conversion(R, width, height)
+                        L = nms(L, .45)
 
-                with open('%s/%s_str.txt' % (output_dir, bname), 'w') as f:
-                    f.write(lp_str + '\n')
+                        L.sort(key=lambda x: x.tl()[0])
+                        lp_str = ''.join([chr(l.cl()) for l in L])
 
-                print('\t\tLP: %s' % lp_str)
+                        with open(
+                                '%s/%s_str.txt' % (output_dir, bname),
+                                'w') as f:
+                            f.write(lp_str + '\n')
+
+                        print('\t\tLP: %s' % lp_str)
+
+                    else:
+
+                        print('No characters found')
+
+            except Exception as e:
+                manifest.failed(frame_name, e)
 
             else:
+                manifest.done(frame_name)
+
+        print(manifest.summary())
+        manifest.close()
 
-                print('No characters found')
+        if cache is not None:
+            print(cache.summary())
 
     except:
         traceback.print_exc()
@@ -0,0 +1,253 @@
+import os
+
+import json
+
+import time
+
+from collections import OrderedDict
+
+
+MANIFEST_FOLDER = 'manifest'
+
+
+class StageManifest(object):
+    """
+    The frames completed (or failed) by a stage of the pipeline, used to
+    resume an interrupted run without processing finished frames again.
+
+    The manifest is a journal in `<folder>/manifest/<stage>.jsonl`: the
+    first line holds the parameters of the stage, every other line the
+    outcome of a frame, appended (and flushed to disk) as soon as the frame
+    is done, so that a crash loses at most the frame being processed. When
+    the manifest is opened, the journal is compacted to the last outcome of
+    each frame, and replaced atomically.
+
+    If the parameters differ from the ones of the previous run, the
+    manifest starts empty and all frames are processed again.
+
+    Parameters
+    ----------
+
+    folder : str
+        The output folder of the pipeline.
+
+    stage : str
+        The name of the stage.
+
+    params : dict, optional
+        The parameters affecting the output of the stage. Must be
+        serializable as JSON.
+
+    read_only : bool, optional
+        Only read the manifest (e.g. the one of the previous stage),
+        whatever its parameters.
+
+    restart : bool, optional
+        Discard the outcomes of previous runs, so that all frames are
+        processed again.
+    """
+
+    def __init__(self, folder, stage, params=None, read_only=False,
+                 restart=False):
+
+        self.stage = stage
+        self.path = os.path.join(folder, MANIFEST_FOLDER, stage + '.jsonl')
+
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        # Round trip through JSON, so that it compares equal to the stored
+        # one (e.g. tuples become lists)
+        self.params = json.loads(json.dumps(params or {}))
+
+        # Last outcome of each frame, by frame name
+        self.records = OrderedDict() if restart else \
+            self._load(None if read_only else self.params)
+
+        self._fd = None
+
+        if not read_only:
+            self._compact()
+            self._fd = open(self.path, 'a')
+
+    def _load(self, params):
+
+        records = OrderedDict()
+
+        if not os.path.isfile(self.path):
+            return records
+
+        with open(self.path, 'r') as f:
+            lines = f.read().split('\n')
+
+        # The last line is either empty or a partially written record
+        lines = lines[:-1]
+
+        if not lines or (
+                params is not None and
+                json.loads(lines[0]).get('params') != params):
+            return records
+
+        for line in lines[1:]:
+            record = json.loads(line)
+            records[record['frame']] = record
+
+        return records
+
+    def _compact(self):
+
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'params': self.params}) + '\n')
+            for record in self.records.values():
+                f.write(json.dumps(record) + '\n')
+
+        os.replace(tmp_path, self.path)
+
+    def _append(self, record):
+
+        self.records[record['frame']] = record
+
+        self._fd.write(json.dumps(record) + '\n')
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+
+    def done(self, frame):
+        """
+        Record that `frame` has been completed.
+        """
+
+        self._append(
+            {'frame': frame, 'status': 'done', 'time': time.time()})
+
+    def failed(self, frame, error):
+        """
+        Record that `frame` could not be processed (it will be processed
+        again in the next run).
+        """
+
+        print("Frame {} failed in stage {}: {}".format(
+            frame, self.stage, error))
+
+        self._append({
+            'frame': frame, 'status': 'failed', 'time': time.time(),
+            'error': str(error)})
+
+    def done_time(self, frame):
+        """
+        When `frame` has been completed, `None` if it has not.
+        """
+
+        record = self.records.get(frame)
+
+        if record is None or record['status'] != 'done':
+            return None
+
+        return record['time']
+
+    def is_stale(self, frame, since=None):
+        """
+        Whether `frame` has to be processed, i.e. it has not been completed,
+        or it has been completed before `since` (e.g. the time its input has
+        been produced by the previous stage).
+        """
+
+        t = self.done_time(frame)
+
+        return t is None or (since is not None and t < since)
+
+    def stale_frames(self, frames, upstream=None):
+        """
+        The frames to process, among the ones in `frames`.
+
+        Parameters
+        ----------
+
+        frames : list
+            Names of the frames.
+
+        upstream : StageManifest, optional
+            The manifest of the previous stage. If set, only frames completed
+            by it are considered, and frames it has completed again since
+            are stale.
+        """
+
+        if upstream is None:
+            return [f for f in frames if self.is_stale(f)]
+
+        return [
+            f for f in frames
+            if upstream.done_time(f) is not None and
+            self.is_stale(f, upstream.done_time(f))]
+
+    def failures(self):
+        """
+        The frames which failed in the last attempt, with their error.
+        """
+
+        return [(f, r['error']) for f, r in self.records.items()
+                if r['status'] == 'failed']
+
+    def summary(self):
+
+        failures = self.failures()
+
+        return "{}: {} frames done, {} failed{}".format(
+            self.stage, len(self.records) - len(failures), len(failures),
+            ''.join("\n\t{}: {}".format(f, e) for f, e in failures))
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+
+
+def open_manifest(folder, stage, params=None, upstream_stage=None,
+                  restart=False):
+    """
+    Open the manifest of a stage and, if `upstream_stage` is set, the one
+    of the previous stage (read only, `None` if it does not exist, in which
+    case all frames are considered ready for the stage).
+    """
+
+    manifest = StageManifest(folder, stage, params, restart=restart)
+
+    if upstream_stage is None:
+        return manifest, None
+
+    upstream = None
+
+    if os.path.isfile(os.path.join(
+            folder, MANIFEST_FOLDER, upstream_stage + '.jsonl')):
+        upstream = StageManifest(folder, upstream_stage, read_only=True)
+
+    return manifest, upstream
+
+
+def frame_of_crop(crop_name):
+    """
+    The name of the frame a crop comes from, e.g. 'frame00042' for
+    'frame00042_car_3_0_lp'.
+    """
+
+    return crop_name.split('_car_')[0]
+
+
+def group_crops(paths):
+    """
+    Group the paths of crops by the frame they come from.
+
+    Returns
+    -------
+
+    collections.OrderedDict
+        The (sorted) paths of the crops of each frame, by frame name.
+    """
+
+    groups = OrderedDict()
+
+    for path in sorted(paths):
+        name = os.path.splitext(os.path.basename(path))[0]
+        groups.setdefault(frame_of_crop(name), list()).append(path)
+
+    return groups
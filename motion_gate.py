@@ -0,0 +1,135 @@
+import hashlib
+
+from collections import Counter
+
+import cv2
+
+import numpy as np
+
+
+class MotionGate(object):
+    """
+    Cheap test of whether a frame from a fixed camera needs vehicle
+    detection, or the detections of the previous frame can be reused.
+
+    A frame is skipped if it is an exact duplicate of the previous one, or
+    if (once downscaled and converted to grayscale) less than
+    `min_changed_fraction` of its pixels differ by more than
+    `pixel_threshold` from a running average of the previous frames (the
+    background). Detection is run anyway at least once every `max_skip`
+    frames, so that the reused detections never get too old.
+
+    Parameters
+    ----------
+
+    min_changed_fraction : float, optional
+        Fraction of changed pixels above which a frame is considered moving.
+
+    pixel_threshold : int, optional
+        Minimum difference (0-255) of a pixel from the background to be
+        considered changed.
+
+    alpha : float, optional
+        Weight of each frame in the running average of the background.
+
+    width : int, optional
+        Width frames are downscaled to before comparing them.
+
+    max_skip : int, optional
+        Maximum number of consecutive frames skipped.
+    """
+
+    def __init__(self, min_changed_fraction=0.002, pixel_threshold=25,
+                 alpha=0.05, width=160, max_skip=25):
+
+        self.min_changed_fraction = min_changed_fraction
+        self.pixel_threshold = pixel_threshold
+        self.alpha = alpha
+        self.width = width
+        self.max_skip = max_skip
+
+        self._background = None
+        self._last_hash = None
+        self._skipped = 0
+
+        # Number of frames by reason of the decision
+        self.stats = Counter()
+
+    def _small(self, I):
+
+        h, w = I.shape[:2]
+        height = max(1, int(round(h * self.width / float(w))))
+
+        small = cv2.resize(
+            I, (self.width, height), interpolation=cv2.INTER_AREA)
+
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        return small.astype(np.float32)
+
+    def should_detect(self, I):
+        """
+        Whether vehicles have to be detected in frame `I` (BGR), `False` if
+        the detections of the previous frame passed can be reused. Frames
+        must be passed in order, including the skipped ones; frames which are
+        not passed at all (e.g. the ones between the keyframes of a tracker)
+        are ignored, so that `I` is compared with the frames passed before.
+        Call `reset` after a gap in the sequence of frames.
+        """
+
+        frame_hash = hashlib.sha1(np.ascontiguousarray(I).data).digest()
+        duplicate = frame_hash == self._last_hash
+        self._last_hash = frame_hash
+
+        if duplicate:
+            reason = 'duplicate'
+        else:
+            small = self._small(I)
+
+            if self._background is None or \
+                    self._background.shape != small.shape:
+                self._background = small
+                reason = 'first'
+            else:
+                changed = np.count_nonzero(
+                    cv2.absdiff(small, self._background) >
+                    self.pixel_threshold)
+
+                reason = 'motion' if \
+                    changed > self.min_changed_fraction * small.size \
+                    else 'static'
+
+                cv2.accumulateWeighted(small, self._background, self.alpha)
+
+        if reason in ('duplicate', 'static') and \
+                self._skipped >= self.max_skip:
+            reason = 'refresh'
+
+        self.stats[reason] += 1
+
+        if reason in ('duplicate', 'static'):
+            self._skipped += 1
+            return False
+
+        self._skipped = 0
+        return True
+
+    def reset(self):
+        """
+        Forget the previous frames (e.g. after a gap in the sequence of
+        frames), so that the next frame is detected.
+        """
+
+        self._background = None
+        self._last_hash = None
+        self._skipped = 0
+
+    def summary(self):
+
+        total = sum(self.stats.values())
+        skipped = self.stats['duplicate'] + self.stats['static']
+
+        return "Motion gate: {} of {} frames skipped ({} duplicate, {} " \
+            "static)".format(
+                skipped, total, self.stats['duplicate'], self.stats['static'])
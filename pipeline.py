@@ -0,0 +1,403 @@
+import cv2
+
+import numpy as np
+
+import darknet.python.darknet as dn
+
+from src.label import Label, dknet_label_conversion, dknet_label_set
+from src.utils import nms, im2single
+from src.darknet_utils import detect_array
+
+from utils import validate_lp_text
+
+
+# Classes (from the COCO dataset) which are considered vehicles
+VEHICLE_CATEGORIES = [b'car', b'bus', b'truck']
+
+VEHICLE_WEIGHTS = b'data/vehicle-detector/yolov3.weights'
+VEHICLE_NETCFG = b'data/vehicle-detector/yolov3.cfg'
+VEHICLE_DATASET = b'data/vehicle-detector/coco.data'
+
+LP_WEIGHTS = b'data/simple-lp-detector/lapi.weights'
+LP_NETCFG = b'data/simple-lp-detector/yolov3-lp.cfg'
+LP_DATASET = b'data/simple-lp-detector/yolov3-lp.data'
+
+OCR_WEIGHTS = b'data/ocr/ocr-net.weights'
+OCR_NETCFG = b'data/ocr/ocr-net.cfg'
+OCR_DATASET = b'data/ocr/ocr-net.data'
+
+WPOD_NET_PATH = 'data/lp-detector/wpod-net_update1.h5'
+
+
+def label_to_bounding_box(label, w, h, x0=0., y0=0.):
+    """
+    Convert a label with relative coordinates into an absolute bounding box in
+    the format used in annotations, i.e. `(x, y, w, h)`.
+
+    Parameters
+    ----------
+
+    label : Label
+        The label, with coordinates relative to a (w, h) region.
+
+    w, h : float
+        The size of the region the label refers to.
+
+    x0, y0 : float, optional
+        The absolute coordinates of the top left corner of the region.
+    """
+
+    bb_w, bb_h = (label.wh() * np.array([w, h])).tolist()
+    bb_x, bb_y = (label.cc() * np.array([w, h])).tolist()
+
+    return (bb_x - bb_w/2 + x0, bb_y - bb_h/2 + y0, bb_w, bb_h)
+
+
+class ALPRPipeline(object):
+    """
+    Run the vehicle detection, license plate detection and OCR stages in the
+    same process, passing crops from one stage to the next as NumPy arrays.
+
+    Networks are loaded only once, when the object is created.
+
+    Parameters
+    ----------
+
+    lp_detector : str, optional
+        Which license plate detector to use, either 'simple' (YOLO-v3) or
+        'wpod' (WPOD-NET). Default to 'simple'.
+
+    vehicle_threshold, lp_threshold, ocr_threshold : float, optional
+        Detection thresholds for each stage.
+
+    wpod_net_path : str, optional
+        Path to the Keras model, used only if `lp_detector` is 'wpod'.
+
+    roi : roi.RegionOfInterest, optional
+        If set, vehicles are searched only in this region of the frames.
+
+    motion_gate : motion_gate.MotionGate, optional
+        If set, vehicles detected in a frame are reused for the following
+        ones as long as the gate finds no motion.
+
+    tracker : tracker.VehicleTracker, optional
+        If set, vehicles are detected only on the keyframes chosen by the
+        tracker, and predicted on the other frames (frames must then be
+        processed in order).
+
+    plate_tracker : plate_tracker.PlateTracker, optional
+        If set (with WPOD-NET and a tracker), plates of tracked vehicles are
+        predicted from the last detection, and WPOD-NET runs only when the
+        tracker asks for it.
+    """
+
+    def __init__(self, lp_detector='simple',
+                 vehicle_threshold=0.5, lp_threshold=0.5, ocr_threshold=0.4,
+                 wpod_net_path=WPOD_NET_PATH, roi=None, motion_gate=None,
+                 tracker=None, plate_tracker=None):
+
+        self.lp_detector = lp_detector
+        self.roi = roi
+        self.motion_gate = motion_gate
+        self.tracker = tracker
+        self.plate_tracker = plate_tracker if lp_detector == 'wpod' else None
+
+        # Vehicles found in the last frame, and its size
+        self._last_vehicles = None
+
+        # Number of the last frame processed, to detect gaps in the sequence
+        self._last_number = None
+
+        self.vehicle_threshold = vehicle_threshold
+        self.lp_threshold = lp_threshold
+        self.ocr_threshold = ocr_threshold
+
+        self.vehicle_net = dn.load_net(VEHICLE_NETCFG, VEHICLE_WEIGHTS, 0)
+        self.vehicle_meta = dn.load_meta(VEHICLE_DATASET)
+
+        if lp_detector == 'simple':
+            self.lp_net = dn.load_net(LP_NETCFG, LP_WEIGHTS, 0)
+            self.lp_meta = dn.load_meta(LP_DATASET)
+        elif lp_detector == 'wpod':
+            # Import here so that TensorFlow is loaded only when needed
+            from src.keras_utils import load_model
+            self.wpod_net = load_model(wpod_net_path)
+        else:
+            raise ValueError(
+                "Unknown license plate detector: {}".format(lp_detector))
+
+        self.ocr_net = dn.load_net(OCR_NETCFG, OCR_WEIGHTS, 0)
+        self.ocr_meta = dn.load_meta(OCR_DATASET)
+
+    def detect_vehicles(self, I):
+        """
+        Detect vehicles in a BGR image.
+
+        Returns
+        -------
+
+        LabelSet
+            The vehicles found (coordinates relative to the image), with
+            the category (and, with a tracker, the track id) of the vehicle
+            set.
+        """
+
+        if self.tracker is not None and not self.tracker.needs_detection():
+            return self.tracker.step()
+
+        Lcars = self._detect_vehicles(I)
+
+        if self.tracker is not None:
+            Lcars = self.tracker.step(Lcars)
+
+        return Lcars
+
+    def _detect_vehicles(self, I):
+
+        Idet = I if self.roi is None else self.roi.apply(I)
+
+        if self.motion_gate is not None and \
+                not self.motion_gate.should_detect(Idet) and \
+                self._last_vehicles is not None and \
+                self._last_vehicles[1] == I.shape:
+            return self._last_vehicles[0]
+
+        R, (width, height) = detect_array(
+            self.vehicle_net, self.vehicle_meta, Idet,
+            thresh=self.vehicle_threshold)
+
+        R = [r for r in R if r[0] in VEHICLE_CATEGORIES]
+
+        Lcars = dknet_label_set(R, width, height, with_category=True)
+
+        if self.roi is not None:
+            Lcars = self.roi.to_frame(Lcars, I.shape[1], I.shape[0])
+
+        self._last_vehicles = (Lcars, I.shape)
+
+        return Lcars
+
+    def detect_license_plates(self, Icar):
+        """
+        Detect license plates in the crop of a vehicle.
+
+        Returns
+        -------
+
+        list
+            A list of `(label, Ilp)` tuples, where `label` has coordinates
+            relative to the vehicle crop and `Ilp` is the crop of the plate,
+            ready to be passed to the OCR.
+        """
+
+        if self.lp_detector == 'wpod':
+            return self.detect_license_plates_batch([Icar])[0]
+
+        R, (width, height) = detect_array(
+            self.lp_net, self.lp_meta, Icar, thresh=self.lp_threshold)
+
+        # Only get "LP" classes (although there should be only that class)
+        R = [r for r in R if r[0] in [b'LP']]
+
+        Llps = dknet_label_set(R, width, height)
+
+        return list(zip(Llps, Llps.crops(Icar)))
+
+    def detect_license_plates_batch(self, Icars, track_ids=None):
+        """
+        Detect license plates in several vehicle crops at once.
+
+        With WPOD-NET, crops are batched together so that the network is
+        called once per group of crops of similar size. With a plate tracker,
+        `track_ids` (the track id of each vehicle) is used to predict the
+        plates of tracked vehicles instead.
+
+        Returns
+        -------
+
+        list
+            One list per crop, in the format returned by
+            `detect_license_plates`.
+        """
+
+        if self.lp_detector != 'wpod':
+            return [self.detect_license_plates(Icar) for Icar in Icars]
+
+        from src.keras_utils import detect_lp_batch, get_bound_dim
+
+        if track_ids is None or self.plate_tracker is None:
+            track_ids = [-1]*len(Icars)
+        else:
+            self.plate_tracker.prune(track_ids)
+
+        # Corners and image of the plate found in each crop (None if there
+        # is no plate)
+        plates = [None]*len(Icars)
+
+        todo = list()
+
+        for i, (Icar, track_id) in enumerate(zip(Icars, track_ids)):
+
+            if self.plate_tracker is not None:
+                plates[i] = self.plate_tracker.predict(
+                    track_id, im2single(Icar))
+
+            if plates[i] is None:
+                todo.append(i)
+
+        if len(todo):
+
+            results, _ = detect_lp_batch(
+                self.wpod_net, [im2single(Icars[i]) for i in todo],
+                [get_bound_dim(Icars[i]) for i in todo],
+                2**4, (240, 80),
+                self.lp_threshold)
+
+            for i, (Llp, LlpImgs) in zip(todo, results):
+
+                if len(LlpImgs):
+                    plates[i] = (Llp[0].pts, LlpImgs[0])
+
+                if self.plate_tracker is not None:
+                    if plates[i] is not None:
+                        self.plate_tracker.update(track_ids[i], *plates[i])
+                    else:
+                        self.plate_tracker.update(track_ids[i])
+
+        return [self._wpod_plates(plate) for plate in plates]
+
+    def _wpod_plates(self, plate):
+
+        if plate is None:
+            return []
+
+        pts, Ilp = plate
+
+        Ilp = cv2.cvtColor(Ilp, cv2.COLOR_BGR2GRAY)
+        Ilp = cv2.cvtColor(Ilp, cv2.COLOR_GRAY2BGR)
+        Ilp = (Ilp*255.).astype('uint8')
+
+        return [(Label(0, np.amin(pts, 1), np.amax(pts, 1)), Ilp)]
+
+    def read_license_plate(self, Ilp):
+        """
+        Perform OCR on the crop of a license plate.
+
+        Returns
+        -------
+
+        str or None
+            The text read, `None` if no characters have been found.
+        """
+
+        R, (width, height) = detect_array(
+            self.ocr_net, self.ocr_meta, Ilp,
+            thresh=self.ocr_threshold, nms=None)
+
+        if not len(R):
+            return None
+
+        L = dknet_label_conversion(R, width, height)
+        L = nms(L, .45)
+
+        L.sort(key=lambda x: x.tl()[0])
+
+        return ''.join([chr(l.cl()) for l in L])
+
+    def reset(self):
+        """
+        Forget the previous frames (e.g. after a gap in the sequence of
+        frames): tracks, plates and detections reused by the motion gate.
+        """
+
+        self._last_vehicles = None
+
+        for state in [self.tracker, self.motion_gate]:
+            if state is not None:
+                state.reset()
+
+        if self.plate_tracker is not None:
+            self.plate_tracker.prune([])
+
+    def process_frame(self, I, number=None):
+        """
+        Run all stages on a single frame.
+
+        Parameters
+        ----------
+
+        I : numpy.ndarray
+            The frame, as a BGR image.
+
+        number : int, optional
+            The frame number, if known. The state kept from the previous
+            frames is reset when it does not follow the previous one.
+
+        Returns
+        -------
+
+        dict
+            The annotations for the frame, in the same format produced by
+            `generate-raw-annotations.py`.
+        """
+
+        if number is not None and self._last_number is not None and \
+                number != self._last_number + 1:
+            self.reset()
+        self._last_number = number
+
+        h, w = I.shape[:2]
+
+        annotations = dict()
+        annotations['cars'] = list()
+
+        cars = list()
+        Icars = list()
+        car_track_ids = list()
+
+        Lcars = self.detect_vehicles(I)
+
+        for car_label, track_id, Icar in zip(
+                Lcars, Lcars.track_ids.tolist(), Lcars.crops(I, copy=False)):
+
+            car = dict()
+            car['category'] = car_label.category()
+            car['bounding_box'] = label_to_bounding_box(car_label, w, h)
+            car['plates'] = list()
+
+            if track_id >= 0:
+                car['track_id'] = track_id
+
+            annotations['cars'].append(car)
+
+            if Icar is not None:
+                cars.append(car)
+                Icars.append(Icar)
+                car_track_ids.append(track_id)
+
+        for car, car_plates in zip(
+                cars, self.detect_license_plates_batch(Icars, car_track_ids)):
+
+            car_bb = car['bounding_box']
+
+            for lp_label, Ilp in car_plates:
+
+                lp_dict = dict()
+                lp_dict['bounding_box'] = label_to_bounding_box(
+                    lp_label, car_bb[2], car_bb[3], car_bb[0], car_bb[1])
+
+                # Fill fields with invalid values, will be replaced by valid
+                # ones
+                lp_dict['plate_text'] = None
+                lp_dict['valid_plate'] = False
+
+                if Ilp is not None:
+                    lp_text = self.read_license_plate(Ilp)
+
+                    if lp_text is not None:
+                        lp_dict['plate_text'] = lp_text
+                        lp_dict['valid_plate'] = validate_lp_text(lp_text)
+
+                car['plates'].append(lp_dict)
+
+        return annotations
@@ -0,0 +1,148 @@
+from collections import Counter
+
+import cv2
+
+import numpy as np
+
+from src.projection_utils import rectify_plate
+
+
+class PlateTracker(object):
+    """
+    Follow the license plates found by WPOD-NET in tracked vehicles, so that
+    the network runs only once every few frames for each vehicle.
+
+    Once a plate is found in a vehicle, its corners (relative to the crop of
+    the vehicle) are kept: since the crop follows the vehicle, the plate is
+    predicted at the same relative position on the following frames and
+    rectified from the new crop. A prediction is accepted only if the
+    rectified plate still looks like the one found by WPOD-NET (normalized
+    cross-correlation of the grayscale images), otherwise, or once
+    `redetect_interval` frames have passed, WPOD-NET runs again.
+
+    Parameters
+    ----------
+
+    redetect_interval : int, optional
+        Run WPOD-NET on a vehicle at least once every `redetect_interval`
+        frames.
+
+    min_similarity : float, optional
+        Minimum correlation (-1 to 1) between the predicted plate and the
+        last one found by WPOD-NET to accept the prediction.
+
+    out_size : tuple, optional
+        Size `(w, h)` of the rectified plates, as for WPOD-NET.
+    """
+
+    def __init__(self, redetect_interval=5, min_similarity=0.6,
+                 out_size=(240, 80)):
+
+        self.redetect_interval = redetect_interval
+        self.min_similarity = min_similarity
+        self.out_size = tuple(out_size)
+
+        # Corners, template and number of frames since the last detection of
+        # the plate, by track id of the vehicle
+        self._plates = dict()
+
+        # Number of vehicle crops by outcome of the prediction
+        self.stats = Counter()
+
+    def _template(self, Ilp):
+
+        gray = cv2.cvtColor(Ilp.astype(np.float32), cv2.COLOR_BGR2GRAY)
+
+        # Half resolution is enough to compare plates, and less sensitive to
+        # noise and small misalignments
+        return cv2.resize(
+            gray, (self.out_size[0]//2, self.out_size[1]//2),
+            interpolation=cv2.INTER_AREA)
+
+    def predict(self, track_id, Icar):
+        """
+        Predict the plate of a vehicle from the last one found by WPOD-NET.
+
+        Parameters
+        ----------
+
+        track_id : int
+            The track id of the vehicle (-1 if not tracked).
+
+        Icar : numpy.ndarray
+            The crop of the vehicle, as a float BGR image in the 0-1 range.
+
+        Returns
+        -------
+
+        tuple or None
+            The corners of the plate (2x4, relative to the crop) and the
+            rectified plate, or `None` if WPOD-NET has to run on the crop.
+        """
+
+        plate = self._plates.get(track_id) if track_id >= 0 else None
+
+        if plate is None:
+            self.stats['detected'] += 1
+            return None
+
+        if plate['age'] + 1 >= self.redetect_interval:
+            self.stats['interval'] += 1
+            return None
+
+        Ilp = rectify_plate(Icar, plate['pts'], self.out_size)
+
+        similarity = cv2.matchTemplate(
+            self._template(Ilp), plate['template'],
+            cv2.TM_CCOEFF_NORMED)[0, 0]
+
+        # Uniform images give NaN
+        if not similarity >= self.min_similarity:
+            self.stats['rejected'] += 1
+            return None
+
+        plate['age'] += 1
+        self.stats['predicted'] += 1
+
+        return plate['pts'].copy(), Ilp
+
+    def update(self, track_id, pts=None, Ilp=None):
+        """
+        Record the result of WPOD-NET on a vehicle: the corners of the plate
+        (2x4, relative to the crop) and the rectified plate, or `None` if no
+        plate has been found.
+        """
+
+        if track_id < 0:
+            return
+
+        if pts is None:
+            self._plates.pop(track_id, None)
+            return
+
+        self._plates[track_id] = {
+            'pts': np.array(pts, dtype=float),
+            'template': self._template(Ilp),
+            'age': 0}
+
+    def prune(self, track_ids):
+        """
+        Forget the plates of vehicles which are not in `track_ids` (e.g. the
+        ones in the current frame), so that they are detected again if the
+        vehicle comes back.
+        """
+
+        track_ids = set(track_ids)
+
+        for track_id in list(self._plates):
+            if track_id not in track_ids:
+                del self._plates[track_id]
+
+    def summary(self):
+
+        total = sum(self.stats.values())
+
+        return "Plate tracker: {} of {} vehicle crops predicted ({} " \
+            "rejected, {} at the detection interval)".format(
+                self.stats['predicted'], total, self.stats['rejected'],
+                self.stats['interval'])
@@ -1,12 +1,10 @@
-import os
-
 import argparse
 
-import json
-
 from utils import guess_last_frame
 
-from post_processing import process_annotations
+from annotation_store import ANNOTATION_FORMATS, open_annotations
+
+from post_processing import StreamingPostProcessor
 
 def parse_args():
 
@@ -39,6 +37,22 @@ def parse_args():
         default=25,
         help="Number of frames before and after to use to correct detections.")
 
+    parser.add_argument(
+        '--assignment',
+        choices=['greedy', 'optimal'],
+        default='greedy',
+        help="How license plates are assigned to vehicles: 'greedy' (closest "
+        "available vehicle, one plate at a time) or 'optimal' (minimum total "
+        "distance, requires SciPy).")
+
+    parser.add_argument(
+        '--format',
+        choices=ANNOTATION_FORMATS,
+        default='json',
+        help="How annotations are read and written: one JSON file per frame, "
+        "or a columnar store ('annotations' and 'annotations_unique' folders "
+        "inside aux_folder).")
+
     args = parser.parse_args()
     if args.end_frame is None:
         args.end_frame = guess_last_frame(args.input_folder)
@@ -50,50 +64,44 @@ def main():
 
     args = parse_args()
 
-    # Keep track of previous frames
-    annotations_history = list()
-
-    # First create a list of detections in all frames, in order to be able in a
-    # second passage to fill in missing detections/correct them.
-    for t in range(args.start_frame, args.end_frame+1):
+    # Only the annotations of the last 2*window+1 frames are kept in memory:
+    # the corrected annotations for frame t are available as soon as the ones
+    # for frame t+window have been read.
+    post_processor = StreamingPostProcessor(
+        args.window, assignment=args.assignment)
 
-        annotations_file = os.path.join(
-            args.aux_folder,
-            "frame{:05d}_annotations.json".format(t))
+    annotations_raw = open_annotations(
+        args.aux_folder, 'annotations', args.format)
+    annotations_out = open_annotations(
+        args.aux_folder, 'annotations_unique', args.format, 'w')
 
-        # Load annotations from json file
-        with open(annotations_file, 'r') as jf:
-            annotations = json.load(jf)
+    for t in range(args.start_frame, args.end_frame+1):
 
-        # Save annotations for a given frame
-        annotations_history.append(annotations)
+        annotations = annotations_raw.read(t)
 
-    # Then, try to fill in gaps using information from surrounding frames
-    i = 0
+        result = post_processor.push(annotations)
 
-    # Number of frames before and after to use to correct information
-    for t in range(args.start_frame, args.end_frame+1):
+        if result is None:
+            # Skip the first N frames (N = args.window)
+            if t - args.start_frame < args.window:
+                print("Skipping frame {} (out of time window)".format(t))
+            continue
 
-        # Skip the first and last N frames (N = args.window)
-        # TODO check this, there might be a bug!
-        if i >= args.window and i < (args.end_frame - args.window):
-            print("Processing frame {}".format(t))
+        i, annotations_unique = result
 
-            # Process annotations
-            annotations_unique = process_annotations(
-                annotations_history, i, args.window)
+        print("Processing frame {}".format(args.start_frame + i))
 
-            annotations_unique_file = os.path.join(
-                args.aux_folder,
-                "frame{:05d}_annotations_unique.json".format(t))
+        annotations_out.append(args.start_frame + i, annotations_unique)
 
-            # Load annotations from json file
-            with open(annotations_unique_file, 'w') as jf:
-                annotations = json.dump(annotations_unique, jf, indent=4)
-        else:
-            print("Skipping frame {} (out of time window)".format(t))
+    annotations_raw.close()
+    annotations_out.close()
 
-        i += 1
+    # Skip the last N frames (N = args.window)
+    for t in range(
+            max(args.end_frame - args.window + 1,
+                args.start_frame + args.window),
+            args.end_frame+1):
+        print("Skipping frame {} (out of time window)".format(t))
 
 
 if __name__ == "__main__":
@@ -1,9 +1,14 @@
 import numpy as np
 
-from utils import (area, iterative_levenshtein, compute_center_coordinates)
+from collections import deque
 
+from utils import (area, levenshtein_many, compute_center_coordinates)
 
-def process_annotations(annotations_history, i, window, keep_invalid=False):
+from spatial_index import GridIndex
+
+
+def process_annotations(annotations_history, i, window, keep_invalid=False,
+                        assignment='greedy'):
     """
     Process annotation for a given frame trying to correct wrong/missing data
 
@@ -24,13 +29,61 @@ def process_annotations(annotations_history, i, window, keep_invalid=False):
     keep_invalid : bool, optional.
         Whether to keep also invalid plates (that is those not matching the
         regular expression). Default to `False`.
+
+    assignment : str, optional
+        How plates are assigned to vehicles, either 'greedy' or 'optimal'
+        (see `associate_plate_to_vehicle`). Default to 'greedy'.
+    """
+
+    # Index the valid plates seen in surrounding frames. Note that "future"
+    # frames include the current one (see `recover_missing_plates`).
+    plates_past = PlateIndex.from_frames(
+        annotations_history, range(i-window, i))
+    plates_future = PlateIndex.from_frames(
+        annotations_history, range(i, i+window))
+
+    return correct_annotations(
+        annotations_history[i], i, window, plates_past, plates_future,
+        keep_invalid, assignment)
+
+
+def correct_annotations(annotations, i, window, plates_past, plates_future,
+                        keep_invalid=False, assignment='greedy'):
+    """
+    Correct the annotations of a single frame, given the plates seen in the
+    surrounding ones.
+
+    Parameters
+    ----------
+
+    annotations : dict
+        The annotations for current frame.
+
+    i : int
+        The index of current frame.
+
+    window : int
+        The number of frames (before and after the current one) to use to
+        improve the quality of the detections.
+
+    plates_past, plates_future : PlateIndex
+        The plates seen in frames `i-window, ..., i-1` and `i, ..., i+window-1`
+        respectively.
+
+    keep_invalid : bool, optional.
+        Whether to keep also invalid plates (that is those not matching the
+        regular expression). Default to `False`.
+
+    assignment : str, optional
+        How plates are assigned to vehicles, either 'greedy' or 'optimal'.
+        Default to 'greedy'.
     """
 
     # Create a list of all cars and plates detected _in current frame_
     cars = list()
     plates = list()
 
-    for car in annotations_history[i]['cars']:
+    for car in annotations['cars']:
 
         # print(car)
         car_cp = dict(car)
@@ -43,7 +96,7 @@ def process_annotations(annotations_history, i, window, keep_invalid=False):
         plates.extend(car['plates'])
 
     plates = recover_missing_plates(
-        annotations_history, i, plates, window, 3)
+        plates, i, window, 3, plates_past.plates, plates_future.plates)
 
     # print("After recover_missing_plates:")
     # print("# of plates: {}".format(len(plates)))
@@ -61,14 +114,178 @@ def process_annotations(annotations_history, i, window, keep_invalid=False):
 
     # Remove duplicate plates (i.e., those overlapping) by keeping those more
     # likely to be correct
-    plates_unique = remove_duplicate_plates(plates, annotations_history)
+    plates_unique = remove_duplicate_plates(plates)
 
     # Finally asociate plate to vehicle
-    cars = associate_plate_to_vehicle(cars, plates_unique)
+    cars = associate_plate_to_vehicle(cars, plates_unique, assignment)
 
     return {'cars': cars}
 
 
+class PlateIndex(object):
+    """
+    Index of the valid plates seen in a range of frames, keyed by plate text.
+
+    For each plate text, `plates[text]` is a dictionary with keys 'seen_at'
+    (the frames where it has been seen, in increasing order) and 'bb' (the
+    bounding box of the plate in each of those frames).
+
+    Frames must be added in increasing order and removed oldest first, so that
+    the index can be kept up to date as a time window slides over the video at
+    a cost proportional to the number of plates in the frames added/removed.
+    """
+
+    def __init__(self):
+
+        self.plates = dict()
+
+        # Plate texts indexed for each frame, needed to remove it later on
+        # (plates may be modified after they have been indexed)
+        self._frames = dict()
+
+    @classmethod
+    def from_frames(cls, annotations_history, frames):
+
+        index = cls()
+
+        for t in frames:
+            index.add(t, annotations_history[t])
+
+        return index
+
+    def add(self, t, annotations):
+        """
+        Add the valid plates found in the annotations of frame `t`.
+        """
+
+        texts = list()
+
+        for car in annotations['cars']:
+            for plate in car['plates']:
+
+                if not plate['valid_plate']:
+                    continue
+
+                pt = plate['plate_text']
+
+                if pt not in self.plates:
+                    self.plates[pt] = dict()
+                    self.plates[pt]['seen_at'] = deque()
+                    self.plates[pt]['bb'] = {}  # bounding boxes
+
+                self.plates[pt]['seen_at'].append(t)
+                self.plates[pt]['bb'][t] = plate['bounding_box']
+
+                texts.append(pt)
+
+        self._frames[t] = texts
+
+    def remove(self, t):
+        """
+        Remove frame `t`, which must be the oldest one in the index.
+        """
+
+        for pt in self._frames.pop(t, []):
+
+            entry = self.plates[pt]
+            entry['seen_at'].popleft()
+            entry['bb'].pop(t, None)
+
+            if not entry['seen_at']:
+                del self.plates[pt]
+
+
+class StreamingPostProcessor(object):
+    """
+    Streaming version of `process_annotations`, which keeps in memory only
+    the annotations of the last `window+1` frames, plus an index of the plates
+    seen in the previous `window` ones.
+
+    Frames are pushed one at a time, in order; as soon as the annotations of
+    frame `t+window` are available, the corrected annotations of frame `t` are
+    returned. The first and last `window` frames are never returned, like in
+    batch mode.
+
+    Parameters
+    ----------
+
+    window : int
+        The number of frames (before and after the current one) to use to
+        improve the quality of the detections.
+
+    keep_invalid : bool, optional.
+        Whether to keep also invalid plates (that is those not matching the
+        regular expression). Default to `False`.
+
+    assignment : str, optional
+        How plates are assigned to vehicles, either 'greedy' or 'optimal'.
+        Default to 'greedy'.
+    """
+
+    def __init__(self, window, keep_invalid=False, assignment='greedy'):
+
+        self.window = window
+        self.keep_invalid = keep_invalid
+        self.assignment = assignment
+
+        # Annotations of the frame to correct and of the following ones; past
+        # frames are only needed through the index of their plates.
+        self._annotations = deque(maxlen=window+1)
+
+        self._plates_past = PlateIndex()
+        self._plates_future = PlateIndex()
+
+        self._n_frames = 0
+
+    def push(self, annotations):
+        """
+        Add the annotations for the next frame.
+
+        Returns
+        -------
+
+        tuple or None
+            `(i, annotations_unique)`, where `i` is the (0-based) index of the
+            frame whose annotations have been corrected, or `None` if not
+            enough frames have been pushed yet.
+        """
+
+        n = self._n_frames
+        w = self.window
+
+        self._annotations.append(annotations)
+        self._n_frames += 1
+
+        if w > 0:
+            if n < w:
+                # The first frames are never corrected, they are only used as
+                # past frames for the following ones.
+                self._plates_past.add(n, annotations)
+
+            if n - 1 >= w:
+                self._plates_future.add(n - 1, self._annotations[-2])
+
+        # Index of the frame to correct
+        i = n - w
+
+        if i < w:
+            return None
+
+        annotations_unique = correct_annotations(
+            self._annotations[0], i, w,
+            self._plates_past, self._plates_future, self.keep_invalid,
+            self.assignment)
+
+        # Slide the window by one frame. Current frame is moved to the past
+        # after it has been corrected.
+        if w > 0:
+            self._plates_future.remove(i)
+            self._plates_past.add(i, self._annotations[0])
+            self._plates_past.remove(i - w)
+
+        return i, annotations_unique
+
+
 def choose_best_alternative(current_plate, new_plate_code,
                             plates_past, plates_future):
     """
@@ -101,56 +318,29 @@ def choose_best_alternative(current_plate, new_plate_code,
         return new_plate_code
 
 
-def recover_missing_plates(annotations_history, i, plates, window,  # noqa
-                           min_occurrences):
+def recover_missing_plates(plates, i, window, min_occurrences,  # noqa
+                           plates_past, plates_future):
     """
     Use the previous and following N frames to recover plates in current frame
+
+    `plates_past` and `plates_future` are the `plates` dictionaries of the
+    `PlateIndex` objects for frames `i-window, ..., i-1` and
+    `i, ..., i+window-1` respectively.
     """
     # TODO document
 
-    plates_past = dict()
-    plates_future = dict()
+    # The position of missing plates is estimated with respect to the last
+    # frame of the future window, which is the value the loops that used to
+    # build the dictionaries of plates left in `i`. Kept as is in order not to
+    # change results.
+    if window > 0:
+        i = i + window - 1
 
-    # past
-    for i in range(i-window, i):
-        for car in annotations_history[i]['cars']:
-            for plate in car['plates']:
-
-                if not plate['valid_plate']:
-                    continue
-
-                pt = plate['plate_text']
-
-                if pt in plates_past:
-                    plates_past[pt]['seen_at'].append(i)
-                    plates_past[pt]['bb'][i] = plate['bounding_box']
-                else:
-                    plates_past[pt] = dict()
-                    plates_past[pt]['seen_at'] = [i]
-                    plates_past[pt]['bb'] = {}  # bounding boxes
-                    plates_past[pt]['bb'][i] = plate['bounding_box']
-
-    # future
-    for i in range(i+1, i+1+window):
-        for car in annotations_history[i]['cars']:
-            for plate in car['plates']:
-
-                if not plate['valid_plate']:
-                    continue
-
-                pt = plate['plate_text']
-
-                if pt in plates_future:
-                    plates_future[pt]['seen_at'].append(i)
-                    plates_future[pt]['bb'][i] = plate['bounding_box']
-                else:
-                    plates_future[pt] = dict()
-                    plates_future[pt]['seen_at'] = [i]
-                    plates_future[pt]['bb'] = {}  # bounding boxes
-                    plates_future[pt]['bb'][i] = plate['bounding_box']
-
-    # Find plates with a valid code that appear before AND after current frame
-    common_plate_codes = set(plates_future).intersection(set(plates_past))
+    # Find plates with a valid code that appear before AND after current
+    # frame. Sorted, so that results do not depend on the order in which the
+    # indexes have been filled (nor on string hashing).
+    common_plate_codes = sorted(
+        set(plates_future).intersection(set(plates_past)))
 
     # TODO DEBUG
     # print("Plates at current frame:")
@@ -208,8 +398,8 @@ def recover_missing_plates(annotations_history, i, plates, window,  # noqa
 
             # Retrieve the last frame in which the plate was seen in previous
             # frames and the first in which it was seen in future ones.
-            i_past = max(plates_past[plate_code]['seen_at'])
-            i_future = min(plates_future[plate_code]['seen_at'])
+            i_past = plates_past[plate_code]['seen_at'][-1]
+            i_future = plates_future[plate_code]['seen_at'][0]
 
             # Retrieve the bounding boxes for those instants
             bb_past = plates_past[plate_code]['bb'][i_past]
@@ -265,10 +455,13 @@ def remove_invalid_plates(plates):
     return [p for p in plates if p['valid_plate']]
 
 
-def remove_duplicate_plates(plates, annotations_history):
+def remove_duplicate_plates(plates, annotations_history=None):
     # TODO document
 
-    excluded_plates_indexes = list()
+    # Only plates whose bounding boxes overlap can be duplicates
+    index = GridIndex([p['bounding_box'] for p in plates])
+
+    excluded_plates_indexes = set()
     unique_plates_list = list()
 
     for i in range(len(plates)):
@@ -279,30 +472,28 @@ def remove_duplicate_plates(plates, annotations_history):
 
         p1 = plates[i]
 
-        for j in range(i+1, len(plates)):
+        # Colliding plates, in the same order they appear in the list
+        for j in index.overlapping(p1['bounding_box'], min_index=i+1):
 
             p2 = plates[j]
 
-            # Handle collision
-            if area(p1['bounding_box'], p2['bounding_box']) is not None:
-
-                # If they're the same skip the other one
-                if p1['plate_text'] == p2['plate_text']:
-                    excluded_plates_indexes.append(j)
-
-                if p1['valid_plate'] and not p2['valid_plate']:
-                    # If the first one is valid and the second one isn't,
-                    # remove the second one.
-                    excluded_plates_indexes.append(j)
-                elif not p1['valid_plate'] and p2['valid_plate']:
-                    # If the first one is NOT valid and the second one is
-                    # valid, break the inner loop, thus preventing the first
-                    # one to be added (it's the else part of the loop).
-                    break
-                else:
-                    # Choose the one that appeared more frequently in the past
-                    # TODO
-                    excluded_plates_indexes.append(j)
+            # If they're the same skip the other one
+            if p1['plate_text'] == p2['plate_text']:
+                excluded_plates_indexes.add(j)
+
+            if p1['valid_plate'] and not p2['valid_plate']:
+                # If the first one is valid and the second one isn't,
+                # remove the second one.
+                excluded_plates_indexes.add(j)
+            elif not p1['valid_plate'] and p2['valid_plate']:
+                # If the first one is NOT valid and the second one is
+                # valid, break the inner loop, thus preventing the first
+                # one to be added (it's the else part of the loop).
+                break
+            else:
+                # Choose the one that appeared more frequently in the past
+                # TODO
+                excluded_plates_indexes.add(j)
         else:
 
             unique_plates_list.append(p1)
@@ -310,7 +501,7 @@ def remove_duplicate_plates(plates, annotations_history):
     return unique_plates_list
 
 
-def associate_plate_to_vehicle(cars, plates):
+def associate_plate_to_vehicle(cars, plates, method='greedy'):
     """
     Associate each plate to the closest available vehicle.
 
@@ -326,6 +517,12 @@ def associate_plate_to_vehicle(cars, plates):
     plates : list
         The list of license plates detected in a frame.
 
+    method : str, optional
+        Either 'greedy' (default), which assigns plates one at a time, in the
+        order they appear in `plates`, or 'optimal', which minimizes the total
+        distance between plates and vehicles (see
+        `associate_plate_to_vehicle_optimal`).
+
     Returns
     -------
 
@@ -334,27 +531,24 @@ def associate_plate_to_vehicle(cars, plates):
         correct vehicle.
     """
 
+    if method == 'optimal':
+        return associate_plate_to_vehicle_optimal(cars, plates)
+    elif method != 'greedy':
+        raise ValueError("Unknown assignment method: {}".format(method))
+
+    index = GridIndex([car['bounding_box'] for car in cars])
+
     # Keep track of indexes of cars that have already been assigned
-    unavailable_cars_indexes = list()
+    unavailable_cars_indexes = set()
 
     for p in plates:
-        min_dist = np.inf
 
         px, py = compute_center_coordinates(p['bounding_box'])
 
-        for ic, car in enumerate(cars):
-
-            # Skip vehicles that have already been assigned a plate
-            if ic in unavailable_cars_indexes:
-                continue
-
-            # Compute coordinates of the center of the vehicle's bb
-            cx, cy = compute_center_coordinates(car['bounding_box'])
-
-            dist = (cx - px)**2 + (cy - py)**2
-            if dist < min_dist:
-                min_dist = dist
-                min_dist_car_index = ic
+        # Closest vehicle among those which have not been assigned a plate
+        # yet
+        min_dist_car_index, min_dist = index.nearest(
+            px, py, exclude=unavailable_cars_indexes)
 
         # If a suitable car has been found AND there is an overlap between the
         # bounding boux of the license plate and the one of the closest car, do
@@ -367,7 +561,83 @@ def associate_plate_to_vehicle(cars, plates):
             cars[min_dist_car_index]['plates'] = [p]
 
             # Mark car as unavailable
-            unavailable_cars_indexes.append(min_dist_car_index)
+            unavailable_cars_indexes.add(min_dist_car_index)
+
+    return cars
+
+
+def associate_plate_to_vehicle_optimal(cars, plates):
+    """
+    Associate plates to vehicles solving a linear assignment problem.
+
+    The cost of assigning a plate to a vehicle is the squared distance between
+    the centers of their bounding boxes; pairs whose bounding boxes do not
+    overlap (see `utils.area`) cannot be assigned. The number of assigned
+    plates is maximized first, then the total cost is minimized, so that the
+    result does not depend on the order of plates.
+
+    Parameters
+    ----------
+
+    cars : list
+        The list of vehicles without any license plate annotation.
+
+    plates : list
+        The list of license plates detected in a frame.
+
+    Returns
+    -------
+
+    list
+        The list of vehicles updated with license plates associated to the
+        correct vehicle.
+    """
+
+    if not len(cars) or not len(plates):
+        return cars
+
+    # Import here so that SciPy is needed only for this assignment method
+    from scipy.optimize import linear_sum_assignment
+
+    car_boxes = np.array([car['bounding_box'] for car in cars], dtype=float)
+    plate_boxes = np.array([p['bounding_box'] for p in plates], dtype=float)
+
+    # Solve on plates sorted by bounding box (then by text), so that ties are
+    # broken in the same way whatever the order of plates
+    order = np.lexsort((
+        np.array([str(p['plate_text']) for p in plates]),
+        plate_boxes[:, 3], plate_boxes[:, 2],
+        plate_boxes[:, 1], plate_boxes[:, 0]))
+    plate_boxes = plate_boxes[order]
+
+    pb = plate_boxes[:, None, :]
+    cb = car_boxes[None, :, :]
+
+    # Overlap test of `utils.area`, for all pairs at once
+    dx = np.minimum(pb[..., 0] + pb[..., 2], cb[..., 0] + cb[..., 2]) - \
+        np.maximum(pb[..., 0], cb[..., 0])
+    dy = np.minimum(pb[..., 1] + pb[..., 3], cb[..., 1] + cb[..., 3]) - \
+        np.maximum(pb[..., 1], cb[..., 1])
+
+    feasible = (dx >= 0) & (dy >= 0)
+
+    if not feasible.any():
+        return cars
+
+    plate_centers = plate_boxes[:, :2] + plate_boxes[:, 2:]/2
+    car_centers = car_boxes[:, :2] + car_boxes[:, 2:]/2
+
+    cost = ((plate_centers[:, None, :] - car_centers[None, :, :])**2).sum(-1)
+
+    # Infeasible pairs cost more than any set of feasible ones, hence they are
+    # chosen only when there is nothing else left
+    cost[~feasible] = cost[feasible].sum() + 1.
+
+    rows, cols = linear_sum_assignment(cost)
+
+    for r, c in zip(rows, cols):
+        if feasible[r, c]:
+            cars[c]['plates'] = [plates[order[r]]]
 
     return cars
 
@@ -392,15 +662,14 @@ def most_similar_plate(target_plate, plate_list, max_distance=2):
     min_distance = np.inf
     mspi = None
 
-    # TODO catch errors properly
-    try:
-        for i, p in enumerate(plate_list):
-            ld = iterative_levenshtein(target_plate, p['plate_text'])
+    # Plates without a code (nothing read by the OCR) are skipped
+    distances = levenshtein_many(
+        target_plate, [p['plate_text'] for p in plate_list], max_distance)
+
+    for i, ld in enumerate(distances):
 
-            if ld <= max_distance and ld < min_distance:
-                min_distance = ld
-                mspi = i
-    except:  # noqa
-        pass
+        if ld is not None and ld <= max_distance and ld < min_distance:
+            min_distance = ld
+            mspi = i
 
     return mspi
@@ -0,0 +1,115 @@
+import os
+
+from PIL import ImageDraw, ImageFont
+
+# Module which contains functions to draw annotations on image
+from annotation_utils import draw_corners, annotate_object
+
+# Import parameters such as symbols and colors from separate file
+from constants import (
+    LINE_WIDTH, VEHICLE_SYMBOLS, VEHICLE_COLORS, TEXT_FG_COLOR, SCALE)
+
+
+FONT_FILENAME = "OpenSans-Regular.ttf"
+
+FONT_ICONS_FILENAME = "DejaVu Sans Mono Nerd Font Complete Mono.ttf"
+
+
+def load_fonts(fonts_folder=os.path.join('data', 'fonts')):
+    """
+    Load the fonts used to annotate images.
+
+    Returns
+    -------
+
+    tuple
+        The font used to write license plates text and the (larger) one used
+        for vehicle symbols.
+    """
+
+    # Load the font used to write license plates text above actual recognized
+    # plates.
+    font = ImageFont.truetype(
+        os.path.join(fonts_folder, FONT_FILENAME), size=SCALE*30)
+
+    # Load a second copy of the font for symbols
+    font_large = ImageFont.truetype(
+        os.path.join(fonts_folder, FONT_ICONS_FILENAME), size=SCALE*40)
+
+    return font, font_large
+
+
+def outline_bounding_box(x, y, w, h, pil_draw, color):
+    """
+    Draw an outline for a bounding box
+    """
+
+    # Determine which is the shorter side
+    min_len = min(h, h)
+
+    # Determine segment length
+    segment_length = min(min_len/3, 50)
+
+    # Draw corners
+    draw_corners(x, y, w, h, segment_length, pil_draw, color=color,
+                 width=LINE_WIDTH)
+
+
+def draw_annotations(img, annotations, font, font_large):
+    """
+    Draw vehicles and license plates on a PIL image (in place).
+
+    Parameters
+    ----------
+
+    img : PIL.Image.Image
+        The frame to annotate.
+
+    annotations : dict
+        The annotations for the frame.
+
+    font, font_large : PIL.ImageFont.FreeTypeFont
+        The fonts returned by `load_fonts`.
+    """
+
+    # pil_draw = ImageDraw.Draw(img)
+    pil_draw = ImageDraw.Draw(img, mode='RGBA')
+
+    for car in annotations['cars']:
+
+        # Unpack coordinates for bounding box
+        car_crop_x, car_crop_y, car_crop_w, car_crop_h = car['bounding_box']
+
+        vehicle_category = car['category']
+
+        # Draw a cool outline of the vehicle
+        outline_bounding_box(
+            car_crop_x, car_crop_y, car_crop_w, car_crop_h,
+            pil_draw, (255, 255, 255))
+
+        for lp in car['plates']:
+
+            # Beautify license plate text
+            lp_text = lp['plate_text']
+
+            lp_crop_x_absolute, lp_crop_y_absolute, lp_crop_w, lp_crop_h = \
+                lp['bounding_box']
+
+            # Actually annotate object
+            annotate_object(
+                lp_crop_x_absolute, lp_crop_y_absolute,
+                lp_crop_w, lp_crop_h, lp_text, pil_draw,
+                font,
+                10,  # padding
+                0.15,  # segment_ratio
+                0.4,  # line_length_ratio
+                LINE_WIDTH,
+                VEHICLE_COLORS[vehicle_category],  # outline color
+                TEXT_FG_COLOR,  # text color
+                (255, 255, 255),  # bg color
+                SCALE,
+                object_symbol=VEHICLE_SYMBOLS[vehicle_category],
+                font_symbol=font_large,
+                bg_color_symbol=VEHICLE_COLORS[vehicle_category])
+
+    return img
@@ -0,0 +1,158 @@
+import json
+
+import cv2
+
+import numpy as np
+
+from src.label import LabelSet
+
+
+class RegionOfInterest(object):
+    """
+    The region of the frames of a fixed camera where vehicles can be found,
+    described by one or more polygons.
+
+    Frames are cropped to the bounding rectangle of the polygons before
+    vehicle detection and, optionally, pixels outside the polygons are
+    blacked out. Detections are then mapped back to coordinates relative to
+    the whole frame, so that nothing changes for the following stages.
+
+    Parameters
+    ----------
+
+    polygons : list
+        A list of polygons, each a list of `[x, y]` points with coordinates
+        relative to the size of the frame (i.e. in the 0-1 range), so that
+        the same configuration works at any resolution.
+
+    mask : bool, optional
+        Whether to black out the pixels of the cropped region which lie
+        outside the polygons. Default to True.
+    """
+
+    def __init__(self, polygons, mask=True):
+
+        self.polygons = [
+            np.asarray(p, dtype=float).reshape((-1, 2)) for p in polygons]
+
+        if not len(self.polygons) or \
+                any(len(p) < 3 for p in self.polygons):
+            raise ValueError(
+                "A region of interest needs at least a polygon with three "
+                "points")
+
+        if any(((p < 0.) | (p > 1.)).any() for p in self.polygons):
+            raise ValueError(
+                "The coordinates of a region of interest must be relative to "
+                "the size of the frame, in the 0-1 range")
+
+        self.mask = mask
+
+        # Crop rectangle and mask for each frame size seen so far
+        self._regions = dict()
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Read the configuration of a camera from a JSON file such as:
+
+            {
+                "polygons": [[[0.0, 0.4], [1.0, 0.3], [1.0, 1.0], [0.0, 1.0]]],
+                "mask": true
+            }
+
+        A single polygon can also be given with the "polygon" key.
+        """
+
+        with open(path, 'r') as f:
+            config = json.load(f)
+
+        polygons = config['polygons'] if 'polygons' in config \
+            else [config['polygon']]
+
+        return cls(polygons, mask=config.get('mask', True))
+
+    def _region(self, w, h):
+        """
+        The crop rectangle `(x0, y0, x1, y1)` (in pixels) for frames of size
+        `(w, h)`, and the mask of the polygons inside it (`None` if masking
+        is disabled).
+        """
+
+        if (w, h) not in self._regions:
+
+            pts = [np.round(p * [w, h]).astype(np.int32)
+                   for p in self.polygons]
+
+            all_pts = np.concatenate(pts)
+            x0, y0 = np.clip(all_pts.min(0), 0, [w, h])
+            x1, y1 = np.clip(all_pts.max(0) + 1, 0, [w, h])
+
+            if x1 <= x0 or y1 <= y0:
+                raise ValueError(
+                    "The region of interest is empty in a {}x{} "
+                    "frame".format(w, h))
+
+            mask = None
+
+            if self.mask:
+                mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+                cv2.fillPoly(mask, [p - [x0, y0] for p in pts], 255)
+
+            self._regions[(w, h)] = ((x0, y0, x1, y1), mask)
+
+        return self._regions[(w, h)]
+
+    def apply(self, I):
+        """
+        Crop (and mask) a BGR frame.
+
+        Returns
+        -------
+
+        numpy.ndarray
+            The region of interest of the frame. Without masking it is a view
+            of `I`.
+        """
+
+        h, w = I.shape[:2]
+
+        (x0, y0, x1, y1), mask = self._region(w, h)
+
+        Iroi = I[y0:y1, x0:x1]
+
+        if mask is not None:
+            Iroi = cv2.bitwise_and(Iroi, Iroi, mask=mask)
+
+        return Iroi
+
+    def to_frame(self, labels, w, h):
+        """
+        Map labels with coordinates relative to the region of interest
+        (as returned by `apply`) of a `(w, h)` frame to coordinates relative
+        to the whole frame.
+
+        Parameters
+        ----------
+
+        labels : LabelSet
+            The labels found in the region of interest.
+
+        w, h : int
+            The size of the frame.
+
+        Returns
+        -------
+
+        LabelSet
+        """
+
+        (x0, y0, x1, y1), _ = self._region(w, h)
+
+        scale = np.array([x1 - x0, y1 - y0] * 2, dtype=float)
+        offset = np.array([x0, y0] * 2, dtype=float)
+        size = np.array([w, h] * 2, dtype=float)
+
+        return LabelSet(
+            (labels.boxes * scale + offset) / size,
+            labels.cls, labels.probs, labels.categories, labels.track_ids)
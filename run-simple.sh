@@ -32,6 +32,15 @@ fi
 
 lp_model="data/lp-detector/wpod-net_update1.h5"
 debug_mode=false
+single_pass=false
+annotation_format=json
+crop_format=png
+roi_args=''
+cache_args=''
+restart_args=''
+track_args=''
+workers=1
+output_video=''
 input_dir=''
 output_dir=''
 csv_file=''
@@ -49,17 +58,35 @@ usage() {
 	echo "   -c   Output CSV file path"
 	echo "   -l   Path to Keras LP detector model (default = $lp_model)"
     echo "   -d   Debug mode: do not delete tmp folders (default false)"
+	echo "   -s   Single pass: run detection and OCR in one process (default false)"
+	echo "   -b   Store annotations in a binary columnar store instead of JSON files (default false)"
+	echo "   -f   Format of intermediate crops: png, jpg, ppm or npy (default = $crop_format)"
+	echo "   -r   JSON file with the region of interest of the camera (default: whole frame)"
+	echo "   -k   Cache detection results in this folder, so that unchanged frames are not processed again"
+	echo "   -t   Track vehicles, detecting them only once every this number of frames"
+	echo "   -x   Process all frames again, instead of resuming the previous run"
+	echo "   -w   Number of processes used to generate raw annotations and draw outputs (default = $workers)"
+	echo "   -v   Encode annotated frames into this video file instead of saving PNG files"
 	echo "   -h   Print this help information"
 	echo ""
 	exit 1
 }
 
-while getopts 'i:o:c:l:hd' OPTION; do
+while getopts 'i:o:c:l:f:r:k:t:w:v:hdsbx' OPTION; do
 	case $OPTION in
 		i) input_dir=$OPTARG;;
 		#o) output_dir=$OPTARG;;
 		c) csv_file=$OPTARG;;
 		d) debug_mode=true;;
+		s) single_pass=true;;
+		b) annotation_format=columnar;;
+		f) crop_format=$OPTARG;;
+		r) roi_args="--roi $OPTARG";;
+		k) cache_args="--cache_dir $OPTARG";;
+		t) track_args="--keyframe_interval $OPTARG";;
+		x) restart_args="--restart";;
+		w) workers=$OPTARG;;
+		v) output_video=$OPTARG;;
 		l) lp_model=$OPTARG;;
 		h) usage;;
 	esac
@@ -96,64 +123,74 @@ if [ $retval -eq 0 ]; then
     mkdir $output_dir/results
 fi
 
-STAGE=4  # generate raw annotations
-#STAGE=5  # post processing
-
 #PRODUCE_OUTPUT=false
 PRODUCE_OUTPUT=true
 
 # End if any error occur
 set -e
 
-# Detect vehicles
-if [ $STAGE -le 1 ]; then
+# Detection stages keep a manifest of the frames they have completed (in
+# $output_dir/manifest), so that when running again they only process the
+# frames which are new, have failed, or whose input has changed since.
+if [ "$single_pass" = true ]; then
+    # Run the first four stages in a single process, without intermediate
+    # files
+    echo "SINGLE PASS DETECTION AND OCR"
+    python alpr-pipeline.py $input_dir $output_dir --format $annotation_format \
+        $roi_args $track_args
+else
+    # Detect vehicles
     echo "VEHICLE DETECTION"
-    python vehicle-detection.py $input_dir $output_dir
-fi
+    python vehicle-detection.py $input_dir $output_dir \
+        --crop_format $crop_format $roi_args $cache_args $restart_args \
+        $track_args
 
-# Detect license plates
-if [ $STAGE -le 2 ]; then
+    # Detect license plates
     echo "LICENSE PLATE DETECTION"
-    # TODO fix the useless double argument?
-    python simple-license-plate-detection.py $output_dir $output_dir
-fi
+    python simple-license-plate-detection.py $output_dir \
+        --crop_format $crop_format $cache_args $restart_args
 
-# OCR
-if [ $STAGE -le 3 ]; then
+    # OCR
     echo "LICENSE PLATE OCR"
-    python license-plate-ocr.py $output_dir
-fi
+    python license-plate-ocr.py $output_dir $cache_args $restart_args
 
-# Draw output and generate list
+    # Draw output and generate list
 
-#python gen-outputs.py $input_dir $output_dir > $csv_file
-#python gen-outputs-simple.py $input_dir $output_dir
-if [ $STAGE -le 4 ]; then
+    #python gen-outputs.py $input_dir $output_dir > $csv_file
+    #python gen-outputs-simple.py $input_dir $output_dir
     echo "GENERATING RAW ANNOTATIONS"
     python generate-raw-annotations.py $input_dir $output_dir \
-        --width 3840 --height 2160
+        --width 3840 --height 2160 --format $annotation_format \
+        --workers $workers
 fi
 
 # Remove duplicates
-if [ $STAGE -le 5 ]; then
-    echo "PERFORMING POST PROCESSING ON ANNOTATIONS"
-    python post-process-detections.py $input_dir $output_dir --window 25
-fi
+echo "PERFORMING POST PROCESSING ON ANNOTATIONS"
+python post-process-detections.py $input_dir $output_dir --window 25 \
+    --format $annotation_format
 
-#if [ $STAGE -le 6 ]; then
 if [ "$PRODUCE_OUTPUT" = true ] ; then
     echo "DRAWING OUTPUTS"
-    python annotate-images-from-json.py $input_dir $output_dir --window 25
+    if [ -z "$output_video" ]; then
+        python annotate-images-from-json.py $input_dir $output_dir \
+            --window 25 --format $annotation_format --workers $workers
+    else
+        python annotate-images-from-json.py $input_dir $output_dir \
+            --window 25 --format $annotation_format --workers $workers \
+            --output_video $output_video
+    fi
 fi
 
 # Clean files and draw output
 if [ "$debug_mode" = false ] ; then
-    rm $output_dir/*_lp.png
-    rm $output_dir/*car_*.png
-    rm $output_dir/*_cars.txt
-    rm $output_dir/*_lp.txt
-    rm $output_dir/*.json
-    rm $output_dir/*_str.txt
+    rm -f $output_dir/*_lp.{png,jpg,ppm,npy}
+    rm -f $output_dir/*car_*.{png,jpg,ppm,npy}
+    rm -f $output_dir/*_cars.txt
+    rm -f $output_dir/*_lp.txt
+    rm -f $output_dir/*.json
+    rm -rf $output_dir/annotations $output_dir/annotations_unique
+    rm -rf $output_dir/manifest
+    rm -f $output_dir/*_str.txt
 fi
 
 #mv "${output_dir}/"*output.png $output_dir/results
@@ -32,9 +32,12 @@ fi
 
 lp_model="data/lp-detector/wpod-net_update1.h5"
 debug_mode=false
+crop_format=png
 input_dir=''
 output_dir=''
 csv_file=''
+track_args=''
+plate_args=''
 
 
 # Check # of arguments
@@ -49,15 +52,21 @@ usage() {
 	echo "   -c   Output CSV file path"
 	echo "   -l   Path to Keras LP detector model (default = $lp_model)"
     echo "   -d   Debug mode: do not delete tmp folders (default false)"
+	echo "   -f   Format of intermediate crops: png, jpg, ppm or npy (default = $crop_format)"
+	echo "   -t   Track vehicles, detecting them only once every this number of frames"
+	echo "   -p   Track plates of tracked vehicles, running WPOD-NET only once every this number of frames"
 	echo "   -h   Print this help information"
 	echo ""
 	exit 1
 }
 
-while getopts 'i:o:c:l:hd' OPTION; do
+while getopts 'i:o:c:l:f:t:p:hd' OPTION; do
 	case $OPTION in
 		i) input_dir=$OPTARG;;
 		o) output_dir=$OPTARG;;
+		f) crop_format=$OPTARG;;
+		t) track_args="--keyframe_interval $OPTARG";;
+		p) plate_args="--plate_interval $OPTARG";;
 		c) csv_file=$OPTARG;;
 		d) debug_mode=true;;
 		l) lp_model=$OPTARG;;
@@ -91,11 +100,13 @@ set -e
 
 # Detect vehicles
 echo "VEHICLE DETECTION"
-python vehicle-detection.py $input_dir $output_dir
+python vehicle-detection.py $input_dir $output_dir \
+    --crop_format $crop_format $track_args
 
 # Detect license plates
 echo "LICENSE PLATE DETECTION"
-python license-plate-detection.py $output_dir $lp_model
+python license-plate-detection.py $output_dir $lp_model \
+    --crop_format $crop_format $plate_args
 
 # OCR
 echo "LICENSE PLATE OCR"
@@ -107,8 +118,8 @@ python gen-outputs.py $input_dir $output_dir > $csv_file
 
 # Clean files and draw output
 if [ "$debug_mode" = false ] ; then
-    rm $output_dir/*_lp.png
-    rm $output_dir/*car.png
+    rm -f $output_dir/*_lp.{png,jpg,ppm,npy}
+    rm -f $output_dir/*car_*.{png,jpg,ppm,npy}
     rm $output_dir/*_cars.txt
     rm $output_dir/*_lp.txt
     rm $output_dir/*_str.txt
@@ -1,15 +1,17 @@
 import sys
-import cv2
-import numpy as np
 import traceback
 
+from glob import glob
+
 import darknet.python.darknet as dn
 
-from src.label import Label, lwrite
-from os.path import splitext, basename, isdir
-from os import makedirs
-from src.utils import crop_region, image_files_from_folder
-from darknet.python.darknet import detect
+from src.label import dknet_label_set
+from os.path import isdir, splitext, basename
+from os import makedirs, remove
+from src.darknet_utils import detect_array
+from frame_io import CROP_FORMATS, crop_files, read_crop, write_crop
+from detection_cache import open_cache, cached
+from manifest import open_manifest, group_crops
 
 import argparse
 
@@ -23,6 +25,31 @@ def parse_args():
     parser.add_argument(
         '--lp_threshold', type=float, default=0.5)
 
+    parser.add_argument(
+        '--crop_format', choices=CROP_FORMATS, default='png',
+        help="Format of the crops written for the following stages: png, "
+        "jpg (see --jpeg_quality), ppm or npy (uncompressed, fastest).")
+
+    parser.add_argument(
+        '--jpeg_quality', type=int, default=95,
+        help="Quality of jpg crops (0-100).")
+
+    parser.add_argument(
+        '--cache_dir',
+        help="If set, results are cached in this folder, keyed by the "
+        "content of the images, the models and the thresholds, so that "
+        "images already processed are skipped when running again.")
+
+    parser.add_argument(
+        '--cache_size', type=float, default=2048,
+        help="Maximum size of the cache of this stage, in MB; least recently "
+        "used results are removed first.")
+
+    parser.add_argument(
+        '--restart', action='store_true',
+        help="Process all frames, ignoring the ones completed by a previous "
+        "run (see `manifest.py`).")
+
     return parser.parse_args()
 
 
@@ -44,52 +71,89 @@ if __name__ == '__main__':
         lp_net = dn.load_net(lp_netcfg, lp_weights, 0)
         lp_meta = dn.load_meta(lp_dataset)
 
-        imgs_paths = image_files_from_folder(input_dir)
-        # Filter only cropped car images
-        imgs_paths.sort()
+        cache = open_cache(
+            args.cache_dir, 'simple-lp', [lp_weights, lp_netcfg, lp_dataset],
+            {'thresh': lp_threshold}, args.cache_size)
 
         if not isdir(output_dir):
             makedirs(output_dir)
 
+        manifest, upstream = open_manifest(
+            output_dir, 'lp-detection',
+            {'lp_detector': 'simple', 'lp_threshold': lp_threshold,
+             'crop_format': args.crop_format,
+             'jpeg_quality': args.jpeg_quality},
+            'vehicle-detection', args.restart)
+
+        # Vehicle crops (<frame>_car_<N>), in any format, by frame
+        crops = group_crops(crop_files(input_dir, '*_car_*[0-9]'))
+
+        # Frames whose vehicles have been detected since the last run
+        pending = manifest.stale_frames(
+            list(crops) if upstream is None else list(upstream.records),
+            upstream)
+
+        print('%d frames to process' % len(pending))
+
         print('Searching for license plates in cropped cars using YOLO...')
 
-        for i, img_path in enumerate(imgs_paths):
+        for frame_name in pending:
+
+            try:
+
+                # Remove the outputs of any previous run (even one with
+                # other parameters, or before --restart), which might not be
+                # overwritten
+                for p in glob('%s/%s_car_*lp*' % (output_dir, frame_name)):
+                    remove(p)
+
+                for crop_path in crops.get(frame_name, []):
+
+                    bname = splitext(basename(crop_path))[0]
+
+                    print('\tScanning %s' % bname)
+
+                    # Each image is decoded only once and passed to darknet
+                    # from memory
+                    Iorig = read_crop(crop_path)
+
+                    if Iorig is None:
+                        raise IOError("Could not decode %s" % crop_path)
 
-            print('\tScanning %s' % img_path)
+                    R, _ = cached(cache, Iorig, lambda I: detect_array(
+                        lp_net, lp_meta, I, thresh=lp_threshold))
 
-            bname = basename(splitext(img_path)[0])
+                    # Only get "LP" classes (although there should be only
+                    # that class)
+                    R = [r for r in R if r[0] in [b'LP']]
 
-            R, _ = detect(
-                lp_net, lp_meta,
-                bytes(img_path, encoding='utf-8'),
-                thresh=lp_threshold)
+                    print('\t\t%d license plates found' % len(R))
 
-            # Only get "LP" classes (although there should be only that class)
-            R = [r for r in R if r[0] in [b'LP']]
+                    if len(R):
 
-            print('\t\t%d license plates found' % len(R))
+                        Llps = dknet_label_set(
+                            R, Iorig.shape[1], Iorig.shape[0])
 
-            if len(R):
+                        for i, Ilp in enumerate(
+                                Llps.crops(Iorig, copy=False)):
 
-                Iorig = cv2.imread(img_path)
-                WH = np.array(Iorig.shape[1::-1], dtype=float)
-                Lcars = []
+                            write_crop(
+                                '%s/%s_%d_lp' % (output_dir, bname, i), Ilp,
+                                args.crop_format, args.jpeg_quality)
 
-                for i, r in enumerate(R):
+                        Llps.write('%s/%s_lp.txt' % (output_dir, bname))
 
-                    cx, cy, w, h = (
-                        np.array(r[2])/np.concatenate((WH, WH))).tolist()
-                    tl = np.array([cx - w/2., cy - h/2.])
-                    br = np.array([cx + w/2., cy + h/2.])
-                    label = Label(0, tl, br)
-                    Icar = crop_region(Iorig, label)
+            except Exception as e:
+                manifest.failed(frame_name, e)
 
-                    Lcars.append(label)
+            else:
+                manifest.done(frame_name)
 
-                    cv2.imwrite(
-                        '%s/%s_%d_lp.png' % (output_dir, bname, i), Icar)
+        print(manifest.summary())
+        manifest.close()
 
-                lwrite('%s/%s_lp.txt' % (output_dir, bname), Lcars)
+        if cache is not None:
+            print(cache.summary())
 
     except:
         traceback.print_exc()
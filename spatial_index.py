@@ -0,0 +1,168 @@
+import math
+
+from collections import defaultdict
+
+from utils import area, compute_center_coordinates
+
+
+class GridIndex(object):
+    """
+    Uniform grid over a list of bounding boxes, used to answer overlap and
+    nearest-center queries without comparing every pair of boxes.
+
+    Parameters
+    ----------
+
+    boxes : list
+        Bounding boxes, each in the format `[x, y, w, h]`.
+
+    cell_size : float, optional
+        Side of the cells of the grid. Default to the median size of the
+        boxes, which keeps the number of cells touched by each box small.
+    """
+
+    def __init__(self, boxes, cell_size=None):
+
+        self.boxes = list(boxes)
+
+        if cell_size is None:
+            cell_size = _median_size(self.boxes)
+
+        self.cell_size = cell_size
+
+        # Boxes touching each cell
+        self._box_cells = defaultdict(list)
+
+        for i, bb in enumerate(self.boxes):
+            x0, y0, x1, y1 = self._cell_range(bb)
+            for cx in range(x0, x1+1):
+                for cy in range(y0, y1+1):
+                    self._box_cells[(cx, cy)].append(i)
+
+        # Built on first nearest-center query
+        self._centers = None
+        self._center_cells = None
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def _cell_range(self, bb):
+
+        x, y, w, h = bb
+
+        x0, y0 = self._cell(min(x, x + w), min(y, y + h))
+        x1, y1 = self._cell(max(x, x + w), max(y, y + h))
+
+        return x0, y0, x1, y1
+
+    def overlapping(self, bb, min_index=0):
+        """
+        Indexes (sorted) of the boxes which overlap with `bb`, according to
+        `utils.area` (boxes that only touch are considered overlapping).
+
+        Only boxes with index >= `min_index` are returned.
+        """
+
+        x0, y0, x1, y1 = self._cell_range(bb)
+
+        candidates = set()
+        for cx in range(x0, x1+1):
+            for cy in range(y0, y1+1):
+                candidates.update(self._box_cells.get((cx, cy), ()))
+
+        return sorted(
+            i for i in candidates
+            if i >= min_index and area(bb, self.boxes[i]) is not None)
+
+    def _build_center_cells(self):
+
+        self._centers = [compute_center_coordinates(bb) for bb in self.boxes]
+        self._center_cells = defaultdict(list)
+
+        for i, (x, y) in enumerate(self._centers):
+            self._center_cells[self._cell(x, y)].append(i)
+
+        cells = list(self._center_cells)
+        self._center_extent = (
+            min(c[0] for c in cells), min(c[1] for c in cells),
+            max(c[0] for c in cells), max(c[1] for c in cells)) \
+            if cells else None
+
+    def nearest(self, x, y, exclude=()):
+        """
+        Index of the box whose center is closest to point (x, y), skipping
+        indexes in `exclude`. Ties are broken in favour of the lowest index.
+
+        Returns
+        -------
+
+        tuple
+            `(index, squared_distance)`, or `(None, inf)` if no box is
+            available.
+        """
+
+        if self._center_cells is None:
+            self._build_center_cells()
+
+        best, best_dist = None, float('inf')
+
+        if self._center_extent is None:
+            return best, best_dist
+
+        px, py = self._cell(x, y)
+        ex0, ey0, ex1, ey1 = self._center_extent
+
+        # Rings of cells farther than this do not contain any box
+        max_ring = max(px - ex0, ex1 - px, py - ey0, ey1 - py, 0)
+
+        for ring in range(max_ring + 1):
+
+            # Points in rings beyond the current one are at least
+            # `ring * cell_size` far from (x, y)
+            if best is not None and best_dist < (ring - 1) ** 2 * \
+                    self.cell_size ** 2:
+                break
+
+            for cell in _ring_cells(px, py, ring):
+                for i in self._center_cells.get(cell, ()):
+
+                    if i in exclude:
+                        continue
+
+                    cx, cy = self._centers[i]
+                    dist = (cx - x)**2 + (cy - y)**2
+
+                    if dist < best_dist or (
+                            dist == best_dist and i < best):
+                        best, best_dist = i, dist
+
+        return best, best_dist
+
+
+def _ring_cells(px, py, ring):
+    """
+    Cells at Chebyshev distance `ring` from cell (px, py).
+    """
+
+    if ring == 0:
+        yield (px, py)
+        return
+
+    for cx in range(px - ring, px + ring + 1):
+        yield (cx, py - ring)
+        yield (cx, py + ring)
+
+    for cy in range(py - ring + 1, py + ring):
+        yield (px - ring, cy)
+        yield (px + ring, cy)
+
+
+def _median_size(boxes):
+
+    sizes = sorted(max(abs(bb[2]), abs(bb[3])) for bb in boxes)
+
+    if not sizes or sizes[len(sizes)//2] <= 0:
+        return 1.
+
+    return float(sizes[len(sizes)//2])
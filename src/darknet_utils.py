@@ -0,0 +1,47 @@
+
+import numpy as np
+
+from ctypes import c_int, c_float, pointer, POINTER
+
+import darknet.python.darknet as dn
+
+
+def array_to_image(I):
+	'''
+		Wraps a BGR uint8 image (as returned by cv2) into a darknet IMAGE,
+		without going through the filesystem. The float buffer backing the
+		IMAGE is returned as well and must be kept alive while the IMAGE
+		is in use.
+	'''
+	assert(I.dtype == 'uint8')
+	h,w,c = I.shape
+	data = np.ascontiguousarray(I[...,::-1].transpose(2,0,1),dtype='float32')
+	data /= 255.
+	im = dn.IMAGE(w,h,c,data.ctypes.data_as(POINTER(c_float)))
+	return im,data
+
+
+def detect_array(net,meta,I,thresh=.5,hier_thresh=.5,nms=.45):
+	'''
+		Same as darknet.detect, but takes an image already loaded in memory
+		instead of its path.
+	'''
+	im,data = array_to_image(I)
+	num = c_int(0)
+	pnum = pointer(num)
+	dn.predict_image(net,im)
+	dets = dn.get_network_boxes(net,im.w,im.h,thresh,hier_thresh,None,0,pnum)
+	num = pnum[0]
+	if nms:
+		dn.do_nms_obj(dets,num,meta.classes,nms)
+
+	res = []
+	for j in range(num):
+		for i in range(meta.classes):
+			if dets[j].prob[i] > 0:
+				b = dets[j].bbox
+				res.append((meta.names[i],dets[j].prob[i],(b.x,b.y,b.w,b.h)))
+	res = sorted(res,key=lambda x: -x[1])
+	wh = (im.w,im.h)
+	dn.free_detections(dets,num)
+	return res,wh
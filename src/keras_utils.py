@@ -6,8 +6,8 @@ import time
 from os.path import splitext
 
 from src.label import Label
-from src.utils import getWH, nms
-from src.projection_utils import getRectPts, find_T_matrix
+from src.utils import getWH, nms_boxes
+from src.projection_utils import rectify_plate
 
 import tensorflow as tf
 
@@ -19,6 +19,8 @@ from tensorflow.keras.models import model_from_json
 
 class DLabel (Label):
 
+	__slots__ = ('pts',)
+
 	def __init__(self,cl,pts,prob):
 		self.pts = pts
 		tl = np.amin(pts,1)
@@ -52,57 +54,49 @@ def reconstruct(Iorig,I,Y,out_size,threshold=.9):
 
 	Probs = Y[...,0]
 	Affines = Y[...,2:]
-	rx,ry = Y.shape[:2]
-	ywh = Y.shape[1::-1]
-	iwh = np.array(I.shape[1::-1],dtype=float).reshape((2,1))
 
-	xx,yy = np.where(Probs>threshold)
+	yy,xx = np.where(Probs>threshold)
 
 	WH = getWH(I.shape)
 	MN = WH/net_stride
 
 	vxx = vyy = 0.5 #alpha
 
-	base = lambda vx,vy: np.matrix([[-vx,-vy,1.],[vx,-vy,1.],[vx,vy,1.],[-vx,vy,1.]]).T
-	labels = []
-
-	for i in range(len(xx)):
-		y,x = xx[i],yy[i]
-		affine = Affines[y,x]
-		prob = Probs[y,x]
+	base = np.array([[-vxx,-vyy,1.],[vxx,-vyy,1.],[vxx,vyy,1.],[-vxx,vyy,1.]]).T
 
-		mn = np.array([float(x) + .5,float(y) + .5])
+	probs = Probs[yy,xx]
 
-		A = np.reshape(affine,(2,3))
-		A[0,0] = max(A[0,0],0.)
-		A[1,1] = max(A[1,1],0.)
+	A = Affines[yy,xx].reshape((-1,2,3)).astype(float)
+	A[:,0,0] = np.maximum(A[:,0,0],0.)
+	A[:,1,1] = np.maximum(A[:,1,1],0.)
 
-		pts = np.array(A*base(vxx,vyy)) #*alpha
-		pts_MN_center_mn = pts*side
-		pts_MN = pts_MN_center_mn + mn.reshape((2,1))
+	mn = np.stack([xx + .5,yy + .5],1)
 
-		pts_prop = pts_MN/MN.reshape((2,1))
+	pts = np.einsum('nij,jk->nik',A,base) #*alpha
+	pts_MN = pts*side + mn[:,:,np.newaxis]
+	pts_prop = pts_MN/MN.reshape((1,2,1))
 
-		labels.append(DLabel(0,pts_prop,prob))
+	boxes = np.concatenate([pts_prop.min(2),pts_prop.max(2)],1)
 
-	final_labels = nms(labels,.1)
+	# Only labels surviving NMS are materialized
+	final_labels = [DLabel(0,pts_prop[i],probs[i]) for i in nms_boxes(boxes,probs,.1)]
 	TLps = []
 
 	if len(final_labels):
-		final_labels.sort(key=lambda x: x.prob(), reverse=True)
 		for i,label in enumerate(final_labels):
 
-			t_ptsh 	= getRectPts(0,0,out_size[0],out_size[1])
-			ptsh 	= np.concatenate((label.pts*getWH(Iorig.shape).reshape((2,1)),np.ones((1,4))))
-			H 		= find_T_matrix(ptsh,t_ptsh)
-			Ilp 	= cv2.warpPerspective(Iorig,H,out_size,borderValue=.0)
-
-			TLps.append(Ilp)
+			TLps.append(rectify_plate(Iorig,label.pts,out_size))
 
 	return final_labels,TLps
 
 
-def detect_lp(model,I,max_dim,net_step,out_size,threshold):
+def get_bound_dim(I,net_step=2**4,max_dim=608):
+	ratio = float(max(I.shape[:2]))/min(I.shape[:2])
+	side = int(ratio*288.)
+	return min(side + (side % net_step), max_dim)
+
+
+def resize_to_net_step(I,max_dim,net_step):
 
 	min_dim_img = min(I.shape[:2])
 	factor 		= float(max_dim)/min_dim_img
@@ -110,7 +104,12 @@ def detect_lp(model,I,max_dim,net_step,out_size,threshold):
 	w,h = (np.array(I.shape[1::-1],dtype=float)*factor).astype(int).tolist()
 	w += (w%net_step!=0)*(net_step - w%net_step)
 	h += (h%net_step!=0)*(net_step - h%net_step)
-	Iresized = cv2.resize(I,(w,h))
+	return cv2.resize(I,(w,h))
+
+
+def detect_lp(model,I,max_dim,net_step,out_size,threshold):
+
+	Iresized = resize_to_net_step(I,max_dim,net_step)
 
 	T = Iresized.copy()
 	T = T.reshape((1,T.shape[0],T.shape[1],T.shape[2]))
@@ -123,3 +122,56 @@ def detect_lp(model,I,max_dim,net_step,out_size,threshold):
 	L,TLps = reconstruct(I,Iresized,Yr,out_size,threshold)
 
 	return L,TLps,elapsed
+
+
+def detect_lp_batch(model,Is,max_dims,net_step,out_size,threshold,bucket_step=64,max_dim_cap=608):
+	'''
+		Batched version of detect_lp. The max_dim of each image (which is
+		almost unique per vehicle crop) is rounded up to a multiple of
+		bucket_step, capped at max_dim_cap, so that crops fall in a few
+		buckets. Images of a bucket are resized to the same max_dim,
+		zero-padded (bottom/right) to a common size and go through a single
+		model.predict call; each output map is then cropped back to the
+		size of its own image before being decoded.
+
+		Results may differ slightly from detect_lp: crops are upscaled by
+		up to bucket_step pixels more than with their own max_dim, and
+		padding changes the context seen by cells close to the bottom/right
+		border.
+
+		Returns a list of (L,TLps) tuples, one per image, and the total
+		time spent in model.predict.
+	'''
+
+	max_dims = [min(-(-max_dim//bucket_step)*bucket_step,max(max_dim_cap,max_dim)) for max_dim in max_dims]
+
+	Iresized = [resize_to_net_step(I,max_dim,net_step) for I,max_dim in zip(Is,max_dims)]
+
+	buckets = {}
+	for i,max_dim in enumerate(max_dims):
+		buckets.setdefault(max_dim,[]).append(i)
+
+	results = [None]*len(Is)
+	elapsed = 0.
+
+	for max_dim in sorted(buckets):
+
+		idxs = buckets[max_dim]
+		h = max([Iresized[i].shape[0] for i in idxs])
+		w = max([Iresized[i].shape[1] for i in idxs])
+
+		T = np.zeros((len(idxs),h,w,3),dtype='float32')
+		for k,i in enumerate(idxs):
+			hi,wi = Iresized[i].shape[:2]
+			T[k,:hi,:wi] = Iresized[i]
+
+		start 	= time.time()
+		Yr 		= model.predict(T)
+		elapsed += time.time() - start
+
+		for k,i in enumerate(idxs):
+			hi,wi = Iresized[i].shape[:2]
+			Y = Yr[k,:hi//net_step,:wi//net_step]
+			results[i] = reconstruct(Is[i],Iresized[i],Y,out_size,threshold)
+
+	return results,elapsed
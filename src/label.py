@@ -3,8 +3,12 @@ import numpy as np
 
 from os.path import isfile
 
+from src.utils import crop_pixels
+
 class Label:
 
+    __slots__ = ('__box', '__cl', '__prob', '__category')
+
     def __init__(self, cl=-1,
               tl=np.array([0.,0.]), br=np.array([0.,0.]),
               prob=None, category=None):
@@ -13,31 +17,35 @@ class Label:
             A string representing the class
         """
 
-        self.__tl = tl
-        self.__br = br
+        # Top left and bottom right corners are stored in the same array
+        self.__box = np.empty(4)
+        self.__box[:2] = tl
+        self.__box[2:] = br
         self.__cl = cl
         self.__prob = prob
         self.__category = category
 
     def __str__(self):
-        return 'Class: %d, top_left(x:%f,y:%f), bottom_right(x:%f,y:%f)' % (self.__cl, self.__tl[0], self.__tl[1], self.__br[0], self.__br[1])
+        return 'Class: %d, top_left(x:%f,y:%f), bottom_right(x:%f,y:%f)' % (self.__cl, self.__box[0], self.__box[1], self.__box[2], self.__box[3])
 
     def copy(self):
-        return Label(self.__cl,self.__tl,self.__br)
+        return Label(self.__cl,self.tl(),self.br())
 
-    def wh(self): return self.__br-self.__tl
+    def wh(self): return self.__box[2:]-self.__box[:2]
 
-    def cc(self): return self.__tl + self.wh()/2
+    def cc(self): return self.__box[:2] + self.wh()/2
 
     def category(self): return self.__category
 
-    def tl(self): return self.__tl
+    def tl(self): return self.__box[:2]
 
-    def br(self): return self.__br
+    def br(self): return self.__box[2:]
 
-    def tr(self): return np.array([self.__br[0],self.__tl[1]])
+    def tr(self): return self.__box[[2,1]]
 
-    def bl(self): return np.array([self.__tl[0],self.__br[1]])
+    def bl(self): return self.__box[[0,3]]
+
+    def box(self): return self.__box
 
     def cl(self): return self.__cl
 
@@ -49,20 +57,186 @@ class Label:
         self.__cl = cl
 
     def set_tl(self,tl):
-        self.__tl = tl
+        self.__box[:2] = tl
 
     def set_br(self,br):
-        self.__br = br
+        self.__box[2:] = br
 
     def set_wh(self,wh):
         cc = self.cc()
-        self.__tl = cc - .5*wh
-        self.__br = cc + .5*wh
+        self.__box[:2] = cc - .5*wh
+        self.__box[2:] = cc + .5*wh
 
     def set_prob(self,prob):
         self.__prob = prob
 
 
+class LabelSet:
+    """
+    A collection of labels backed by contiguous arrays: an (N,4) float array
+    of boxes (top left and bottom right corners) and one array for each of
+    class, probability (NaN when missing), category and track id (-1 when
+    missing).
+
+    Accessors such as `wh`, `cc` and `area` work on all labels at once.
+    Indexing with an integer returns a `Label`, anything else (slices,
+    boolean masks, index arrays) returns a new `LabelSet`.
+    """
+
+    __slots__ = ('boxes', 'cls', 'probs', 'categories', 'track_ids')
+
+    def __init__(self, boxes=None, cls=None, probs=None, categories=None,
+                 track_ids=None):
+
+        self.boxes = np.zeros((0,4)) if boxes is None else \
+            np.asarray(boxes, dtype=float).reshape((-1,4))
+
+        n = len(self.boxes)
+
+        self.cls = np.full(n, -1, dtype=int) if cls is None else \
+            np.asarray(cls, dtype=int)
+        self.probs = np.full(n, np.nan) if probs is None else \
+            np.asarray(probs, dtype=float)
+        self.categories = np.full(n, None, dtype=object) if categories is None \
+            else np.asarray(categories, dtype=object)
+        self.track_ids = np.full(n, -1, dtype=int) if track_ids is None else \
+            np.asarray(track_ids, dtype=int)
+
+    @classmethod
+    def from_labels(cls, labels):
+        return cls(
+            [l.box() for l in labels],
+            [l.cl() for l in labels],
+            [np.nan if l.prob() is None else l.prob() for l in labels],
+            [l.category() for l in labels])
+
+    def to_labels(self):
+        return [self[i] for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+
+        if isinstance(key, (int, np.integer)):
+            prob = self.probs[key]
+            return Label(
+                int(self.cls[key]), self.boxes[key,:2], self.boxes[key,2:],
+                prob=None if np.isnan(prob) else prob,
+                category=self.categories[key])
+
+        return LabelSet(
+            self.boxes[key], self.cls[key], self.probs[key],
+            self.categories[key], self.track_ids[key])
+
+    def tl(self): return self.boxes[:,:2]
+
+    def br(self): return self.boxes[:,2:]
+
+    def wh(self): return self.boxes[:,2:] - self.boxes[:,:2]
+
+    def cc(self): return self.boxes[:,:2] + self.wh()/2
+
+    def area(self): return np.prod(self.wh(), 1)
+
+    def crops(self, I, bg=0.5, copy=True):
+        """
+        Yield the crop of image `I` for each label (see
+        `src.utils.crop_region`). With `copy=False` crops lying inside the
+        image are views of `I`.
+        """
+
+        wh = np.array(I.shape[1::-1])
+        tls = np.floor(self.tl()*wh).astype(int)
+        brs = np.ceil(self.br()*wh).astype(int)
+
+        for tl, br in zip(tls, brs):
+            yield crop_pixels(I, tl, br, bg, copy)
+
+    def write(self, file_path, write_probs=True, write_category_names=False):
+        """
+        Write labels to file, in the same format as `lwrite`. With category
+        names, the track id (if set) is written as a seventh column.
+        """
+
+        ccs, whs = self.cc(), self.wh()
+
+        with open(file_path,'w') as fd:
+            for cl, cc, wh, prob, category_name, track_id in zip(
+                    self.cls, ccs, whs, self.probs, self.categories,
+                    self.track_ids):
+                if not np.isnan(prob) and write_probs:
+                    fd.write('%d %f %f %f %f %f\n' % (cl,cc[0],cc[1],wh[0],wh[1],prob))
+                elif write_category_names and track_id >= 0:
+                    fd.write('%d %f %f %f %f %s %d\n' % (
+                        cl, cc[0], cc[1], wh[0], wh[1], category_name,
+                        track_id))
+                elif write_category_names:
+                    fd.write('%d %f %f %f %f %s\n' % (
+                        cl, cc[0], cc[1], wh[0], wh[1], category_name))
+                else:
+                    fd.write('%d %f %f %f %f\n' % (cl,cc[0],cc[1],wh[0],wh[1]))
+
+    @classmethod
+    def read(cls, file_path):
+        """
+        Read labels written by `lwrite` (or `LabelSet.write`). The sixth
+        column, if present, is read as a probability when numeric and as a
+        category name otherwise; the seventh, if present, as a track id.
+        """
+
+        classes, ccwh, extra = lread_arrays(file_path)
+
+        if not len(classes):
+            return cls()
+
+        cc, wh = ccwh[:,:2], ccwh[:,2:]
+
+        probs = np.full(len(classes), np.nan)
+        categories = np.full(len(classes), None, dtype=object)
+        track_ids = np.full(len(classes), -1, dtype=int)
+        for i, v in enumerate(extra):
+            if len(v):
+                try:
+                    probs[i] = float(v[0])
+                except ValueError:
+                    categories[i] = v[0]
+            if len(v) > 1:
+                track_ids[i] = int(v[1])
+
+        return cls(
+            np.concatenate((cc - wh/2, cc + wh/2), 1),
+            classes, probs, categories, track_ids)
+
+
+def lread_arrays(file_path):
+    """
+    Read a file in the `lwrite` format into arrays, without creating labels.
+
+    Returns `(cls, ccwh, extra)`: the classes as an `(N,)` int array, centers
+    and sizes as an `(N,4)` float array, and for each row the list of the
+    columns following the size (as strings). A missing file gives no rows.
+    """
+
+    if not isfile(file_path):
+        return np.zeros(0, dtype=int), np.zeros((0,4)), []
+
+    with open(file_path,'r') as fd:
+        rows = [line.split() for line in fd if line.strip()]
+
+    if not len(rows):
+        return np.zeros(0, dtype=int), np.zeros((0,4)), []
+
+    cls = np.array([int(v[0]) for v in rows], dtype=int)
+    ccwh = np.array([v[1:5] for v in rows], dtype=float)
+
+    return cls, ccwh, [v[5:] for v in rows]
+
+
 def lread(file_path,label_type=Label):
 
     if not isfile(file_path):
@@ -110,6 +284,18 @@ def dknet_label_conversion(R,img_width,img_height):
     return L
 
 
+def dknet_label_set(R,img_width,img_height,with_category=False):
+    """
+    Convert darknet detections into a LabelSet with class 0, optionally
+    keeping the detected class name as category.
+    """
+    WH = np.array([img_width,img_height,img_width,img_height],dtype=float)
+    ccwh = np.array([r[2] for r in R],dtype=float).reshape((-1,4))/WH
+    boxes = np.concatenate((ccwh[:,:2] - ccwh[:,2:]/2.,ccwh[:,:2] + ccwh[:,2:]/2.),1)
+    categories = [r[0].decode("utf-8") for r in R] if with_category else None
+    return LabelSet(boxes,np.zeros(len(R),dtype=int),categories=categories)
+
+
 class Shape():
 
     def __init__(self,pts=np.zeros((2,0)),max_sides=4,text=''):
@@ -1,8 +1,11 @@
 
 import numpy as np
+import cv2
 
 from math import sin, cos
 
+from src.utils import getWH
+
 
 def find_T_matrix(pts,t_pts):
 	A = np.zeros((8,9))
@@ -25,6 +28,16 @@ def find_T_matrix(pts,t_pts):
 def getRectPts(tlx,tly,brx,bry):
 	return np.matrix([[tlx,brx,brx,tlx],[tly,tly,bry,bry],[1.,1.,1.,1.]],dtype=float)
 
+def rectify_plate(I,pts,out_size):
+	'''
+		Warp the quadrilateral pts (2x4, relative to the size of I) into an
+		out_size rectangle, as done with the plates found by WPOD-NET.
+	'''
+	t_ptsh 	= getRectPts(0,0,out_size[0],out_size[1])
+	ptsh 	= np.concatenate((pts*getWH(I.shape).reshape((2,1)),np.ones((1,4))))
+	H 		= find_T_matrix(ptsh,t_ptsh)
+	return cv2.warpPerspective(I,H,out_size,borderValue=.0)
+
 def perspective_transform(wh,angles=np.array([0.,0.,0.]),zcop=1000., dpp=1000.):
 	rads = np.deg2rad(angles)
 
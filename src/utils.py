@@ -34,23 +34,63 @@ def IOU_centre_and_dims(cc1,wh1,cc2,wh2):
 	return IOU(cc1-wh1/2.,cc1+wh1/2.,cc2-wh2/2.,cc2+wh2/2.)
 
 
-def nms(Labels,iou_threshold=.5):
+def IOU_matrix(boxes1,boxes2):
+	'''
+		Pairwise IoU between an (N,4) and an (M,4) array of boxes, given as
+		[tlx,tly,brx,bry] rows. Returns an (N,M) array.
+	'''
+	boxes1 = np.asarray(boxes1,dtype=float).reshape((-1,4))
+	boxes2 = np.asarray(boxes2,dtype=float).reshape((-1,4))
+
+	tl = np.maximum(boxes1[:,np.newaxis,:2],boxes2[np.newaxis,:,:2])
+	br = np.minimum(boxes1[:,np.newaxis,2:],boxes2[np.newaxis,:,2:])
+	intersection_area = np.prod(np.maximum(br - tl,0.),2)
+
+	area1 = np.prod(boxes1[:,2:] - boxes1[:,:2],1)
+	area2 = np.prod(boxes2[:,2:] - boxes2[:,:2],1)
+	union_area = area1[:,np.newaxis] + area2[np.newaxis,:] - intersection_area
+
+	with np.errstate(divide='ignore',invalid='ignore'):
+		return intersection_area/union_area
+
+
+def labels2boxes(Labels):
+	return np.array([np.concatenate((l.tl(),l.br())) for l in Labels],dtype=float).reshape((-1,4))
+
+
+def nms_boxes(boxes,scores,iou_threshold=.5):
+	'''
+		Greedy NMS over an (N,4) array of [tlx,tly,brx,bry] boxes with (N,)
+		scores. Returns the indices of the kept boxes, sorted by decreasing
+		score (ties keep the input order).
+
+		Boxes in the (x,y,w,h) format used by the annotations can be
+		converted with boxes[:,2:] += boxes[:,:2].
+	'''
+	boxes  = np.asarray(boxes,dtype=float).reshape((-1,4))
+	scores = np.asarray(scores,dtype=float)
+
+	order = np.argsort(-scores,kind='stable')
+	suppressed = np.zeros(len(boxes),dtype=bool)
+	keep = []
+
+	for i in order:
+		if suppressed[i]:
+			continue
+		keep.append(i)
+		suppressed |= IOU_matrix(boxes[i],boxes)[0] > iou_threshold
 
-	SelectedLabels = []
-	Labels.sort(key=lambda l: l.prob(),reverse=True)
+	return keep
 
-	for label in Labels:
 
-		non_overlap = True
-		for sel_label in SelectedLabels:
-			if IOU_labels(label,sel_label) > iou_threshold:
-				non_overlap = False
-				break
+def nms(Labels,iou_threshold=.5):
+
+	if not len(Labels):
+		return []
 
-		if non_overlap:
-			SelectedLabels.append(label)
+	keep = nms_boxes(labels2boxes(Labels),[l.prob() for l in Labels],iou_threshold)
 
-	return SelectedLabels
+	return [Labels[i] for i in keep]
 
 
 def image_files_from_folder(folder,upper=True):
@@ -67,22 +107,38 @@ def is_inside(ltest,lref):
 	return (ltest.tl() >= lref.tl()).all() and (ltest.br() <= lref.br()).all()
 
 
-def crop_region(I,label,bg=0.5):
+def crop_region(I,label,bg=0.5,copy=True):
 
 	wh = np.array(I.shape[1::-1])
 
-	ch = I.shape[2] if len(I.shape) == 3 else 1
 	tl = np.floor(label.tl()*wh).astype(int)
 	br = np.ceil (label.br()*wh).astype(int)
+
+	return crop_pixels(I,tl,br,bg,copy)
+
+
+def crop_pixels(I,tl,br,bg=0.5,copy=True):
+	'''
+		Crops I between pixel coordinates tl and br, filling with bg the
+		parts outside the image. With copy=False, regions lying entirely
+		inside the image are returned as views of I.
+	'''
+
+	wh = np.array(I.shape[1::-1])
+
+	ch = I.shape[2] if len(I.shape) == 3 else 1
 	outwh = br-tl
 
 	if np.prod(outwh) == 0.:
 		return None
 
+	if not copy and (tl >= 0).all() and (br <= wh).all():
+		return I[tl[1]:br[1],tl[0]:br[0]]
+
 	outsize = (outwh[1],outwh[0],ch) if ch > 1 else (outwh[1],outwh[0])
 	if (np.array(outsize) < 0).any():
 		pause()
-	Iout  = np.zeros(outsize,dtype=I.dtype) + bg
+	Iout  = np.full(outsize,bg,dtype=I.dtype)
 
 	offset 	= np.minimum(tl,0)*(-1)
 	tl 		= np.maximum(tl,0)
@@ -0,0 +1,328 @@
+import os
+
+from glob import glob
+
+import numpy as np
+
+from src.label import LabelSet, lread_arrays
+from src.utils import IOU_matrix
+
+
+class KalmanBoxTrack(object):
+    """
+    A vehicle followed across frames, with a constant velocity Kalman filter
+    on the center and size of its box.
+
+    The state is `[cx, cy, w, h, vx, vy, vw, vh]`, in coordinates relative to
+    the frame; process and measurement noise are proportional to the size of
+    the box.
+
+    Parameters
+    ----------
+
+    track_id : int
+        The id of the track.
+
+    box : numpy.ndarray
+        The first detection, as `[tlx, tly, brx, bry]`.
+
+    category : str
+        The category of the vehicle.
+    """
+
+    # Standard deviation of the measured box, of the change in velocity
+    # between two frames, and of the initial velocity, relative to the size
+    # of the box
+    MEASUREMENT_STD = 0.05
+    ACCELERATION_STD = 0.01
+    VELOCITY_STD = 0.1
+
+    _F = np.eye(8) + np.eye(8, k=4)
+    _H = np.eye(4, 8)
+
+    def __init__(self, track_id, box, category=None):
+
+        self.track_id = track_id
+        self.category = category
+
+        self.x = np.zeros(8)
+        self.x[:4] = _box_to_ccwh(box)
+
+        size = self._size()
+        self.P = np.diag(np.concatenate((
+            (self.MEASUREMENT_STD * size)**2,
+            (self.VELOCITY_STD * size)**2)))
+
+        # Number of detections associated with the track
+        self.hits = 1
+
+        # Number of consecutive detection frames the track has been missed in
+        self.misses = 0
+
+    def _size(self):
+        w, h = np.maximum(self.x[2:4], 1e-3)
+        return np.array([w, h, w, h])
+
+    def box(self):
+        """
+        The current box, as `[tlx, tly, brx, bry]`.
+        """
+        return _ccwh_to_box(self.x[:4])
+
+    def predict(self):
+        """
+        Move the track to the next frame.
+        """
+
+        Q = np.diag(np.concatenate((
+            np.zeros(4), (self.ACCELERATION_STD * self._size())**2)))
+
+        self.x = self._F.dot(self.x)
+        self.x[2:4] = np.maximum(self.x[2:4], 1e-3)
+        self.P = self._F.dot(self.P).dot(self._F.T) + Q
+
+    def update(self, box, category=None):
+        """
+        Correct the track with a detection in the current frame.
+        """
+
+        R = np.diag((self.MEASUREMENT_STD * self._size())**2)
+
+        y = _box_to_ccwh(box) - self._H.dot(self.x)
+        S = self._H.dot(self.P).dot(self._H.T) + R
+        K = self.P.dot(self._H.T).dot(np.linalg.inv(S))
+
+        self.x = self.x + K.dot(y)
+        self.P = (np.eye(8) - K.dot(self._H)).dot(self.P)
+
+        if category is not None:
+            self.category = category
+
+        self.hits += 1
+        self.misses = 0
+
+
+class VehicleTracker(object):
+    """
+    Follow vehicles across the frames of a video, so that the (expensive)
+    vehicle detector runs only on keyframes and vehicle boxes are predicted
+    on the frames in between.
+
+    Frames are passed in order to `step`, with the detections for keyframes
+    and `None` for the other frames; `needs_detection` tells whether the next
+    frame should be a keyframe. On keyframes, detections are associated to
+    the predicted tracks by IoU, and vehicles not associated to any track
+    start a new one.
+
+    Parameters
+    ----------
+
+    keyframe_interval : int, optional
+        Run detection at least once every `keyframe_interval` frames.
+
+    iou_threshold : float, optional
+        Minimum IoU between a detection and a predicted track to associate
+        them.
+
+    max_misses : int, optional
+        Number of consecutive keyframes a track can be missed in before it is
+        dropped. Missed tracks are kept (but not reported) in case the
+        vehicle is detected again.
+
+    border : float, optional
+        A track whose box is closer than this (relative to the frame size)
+        to the border of the frame is entering or leaving the frame, and
+        triggers a detection on the next frame.
+
+    first_id : int, optional
+        The id of the first track. When resuming a run, it must be greater
+        than the ids already written (see `last_track_id`), so that new
+        tracks do not reuse them.
+    """
+
+    def __init__(self, keyframe_interval=5, iou_threshold=0.3, max_misses=1,
+                 border=0.01, first_id=0):
+
+        self.keyframe_interval = keyframe_interval
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.border = border
+
+        self.tracks = list()
+
+        self._next_id = first_id
+        self._since_detection = None
+
+    def needs_detection(self):
+        """
+        Whether the next frame should be a keyframe: either the keyframe
+        interval has elapsed, or some track is not reliable enough to be
+        predicted (it has been seen only once, so its velocity is unknown, or
+        it is at the border of the frame).
+        """
+
+        if self._since_detection is None or \
+                self._since_detection + 1 >= self.keyframe_interval:
+            return True
+
+        for track in self._visible_tracks():
+
+            if track.hits < 2:
+                return True
+
+            box = track.box()
+            if np.any(box[:2] < self.border) or \
+                    np.any(box[2:] > 1. - self.border):
+                return True
+
+        return False
+
+    def reset(self):
+        """
+        Forget all tracks (e.g. after a gap in the sequence of frames), so that
+        the next frame is a keyframe. Track ids are not reused.
+        """
+
+        self.tracks = list()
+        self._since_detection = None
+
+    def _visible_tracks(self):
+        return [t for t in self.tracks if t.misses == 0]
+
+    def step(self, detections=None):
+        """
+        Move to the next frame.
+
+        Parameters
+        ----------
+
+        detections : LabelSet, optional
+            The vehicles detected in the frame (with coordinates relative to
+            the frame and category), if it is a keyframe.
+
+        Returns
+        -------
+
+        LabelSet
+            The vehicles in the frame, with their track id. On keyframes these
+            are the detections themselves, otherwise the predicted boxes of
+            the tracks.
+        """
+
+        for track in self.tracks:
+            track.predict()
+
+        if detections is not None:
+            track_ids = self._associate(detections)
+            self._since_detection = 0
+        else:
+            self._since_detection += 1
+
+        # Drop tracks which have left the frame
+        self.tracks = [
+            t for t in self.tracks
+            if np.all(t.box()[:2] < 1.) and np.all(t.box()[2:] > 0.)]
+
+        if detections is not None:
+            return LabelSet(
+                detections.boxes, detections.cls, detections.probs,
+                detections.categories, track_ids)
+
+        tracks = self._visible_tracks()
+
+        boxes = np.array([np.clip(t.box(), 0., 1.) for t in tracks])
+
+        return LabelSet(
+            boxes, np.zeros(len(tracks), dtype=int),
+            categories=[t.category for t in tracks],
+            track_ids=[t.track_id for t in tracks])
+
+    def _associate(self, detections):
+        """
+        Greedily associate detections to tracks, by decreasing IoU, and
+        return the track id of each detection.
+        """
+
+        track_ids = np.full(len(detections), -1, dtype=int)
+
+        iou = IOU_matrix(
+            [t.box() for t in self.tracks], detections.boxes)
+
+        matched_tracks = set()
+        matched_detections = set()
+
+        if iou.size:
+
+            iou = np.nan_to_num(iou)
+
+            order = np.argsort(-iou, axis=None, kind='stable')
+
+            for it, idet in zip(*np.unravel_index(order, iou.shape)):
+
+                if iou[it, idet] < self.iou_threshold:
+                    break
+
+                if it in matched_tracks or idet in matched_detections:
+                    continue
+
+                self.tracks[it].update(
+                    detections.boxes[idet], detections.categories[idet])
+
+                matched_tracks.add(it)
+                matched_detections.add(idet)
+                track_ids[idet] = self.tracks[it].track_id
+
+        kept = list()
+
+        for it, track in enumerate(self.tracks):
+
+            if it not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+
+            kept.append(track)
+
+        for idet in range(len(detections)):
+
+            if idet not in matched_detections:
+                kept.append(KalmanBoxTrack(
+                    self._next_id, detections.boxes[idet],
+                    detections.categories[idet]))
+                track_ids[idet] = self._next_id
+                self._next_id += 1
+
+        self.tracks = kept
+
+        return track_ids
+
+
+def last_track_id(folder):
+    """
+    The largest track id in the `*_cars.txt` files of `folder`, -1 if there
+    is none.
+    """
+
+    last = -1
+
+    for path in glob(os.path.join(folder, '*_cars.txt')):
+
+        try:
+            _, _, extra = lread_arrays(path)
+            ids = [int(v[1]) for v in extra if len(v) > 1]
+        except ValueError:
+            # Malformed file, processed again by the stage anyway
+            continue
+
+        last = max([last] + ids)
+
+    return last
+
+
+def _box_to_ccwh(box):
+    box = np.asarray(box, dtype=float)
+    return np.concatenate(((box[:2] + box[2:])/2., box[2:] - box[:2]))
+
+
+def _ccwh_to_box(ccwh):
+    return np.concatenate((ccwh[:2] - ccwh[2:]/2., ccwh[:2] + ccwh[2:]/2.))
@@ -1,5 +1,11 @@
 import os
 
+import re
+
+from functools import lru_cache
+
+LP_PATTERN = re.compile("^[A-FZ][A-Z][\d]{3}[A-Z]{2}$")  # noqa
+
 
 def guess_last_frame(input_folder):
 
@@ -14,6 +20,15 @@ def guess_last_frame(input_folder):
     return last_frame
 
 
+def validate_lp_text(lp_text):
+    """
+    Optional step to validate license plate
+    E.g.: italian ones should be two letters, three digits and two letters
+    """
+
+    return LP_PATTERN.match(lp_text) is not None
+
+
 def area(a, b):  # returns None if rectangles don't intersect
 
     ax, ay, aw, ah = a
@@ -63,6 +78,89 @@ def iterative_levenshtein(s, t):
     return dist[row][col]
 
 
+@lru_cache(maxsize=65536)
+def bounded_levenshtein(s, t, max_distance):
+    """
+    Levenshtein distance between strings s and t, computed only as long as it
+    can be at most `max_distance`.
+
+    Only cells of the DP matrix within `max_distance` from the diagonal are
+    computed and the computation stops as soon as all cells of a row exceed
+    the bound. Results are cached, since the same plate codes are compared
+    over and over in consecutive frames.
+
+    Returns
+    -------
+    int
+        The distance between s and t if it is <= max_distance, otherwise
+        max_distance + 1.
+    """
+
+    rows = len(s)+1
+    cols = len(t)+1
+    beyond = max_distance + 1
+
+    # The distance is at least the difference in length
+    if abs(rows - cols) > max_distance:
+        return beyond
+
+    if s == t:
+        return 0
+
+    # Cells outside the band are never better than the bound
+    prev = [col if col <= max_distance else beyond for col in range(cols)]
+
+    for row in range(1, rows):
+
+        cur = [beyond] * cols
+        if row <= max_distance:
+            cur[0] = row
+
+        row_min = cur[0]
+        c = s[row-1]
+
+        for col in range(max(1, row - max_distance),
+                         min(cols - 1, row + max_distance) + 1):
+
+            cost = 0 if c == t[col-1] else 1
+            dist = min(prev[col] + 1,       # deletion
+                       cur[col-1] + 1,      # insertion
+                       prev[col-1] + cost)  # substitution
+
+            if dist > beyond:
+                dist = beyond
+
+            cur[col] = dist
+
+            if dist < row_min:
+                row_min = dist
+
+        # Early exit: no path through this row can stay within the bound
+        if row_min > max_distance:
+            return beyond
+
+        prev = cur
+
+    return min(prev[cols-1], beyond)
+
+
+def levenshtein_many(target, candidates, max_distance):
+    """
+    Bounded Levenshtein distance (see `bounded_levenshtein`) between a target
+    string and each string in a list of candidates.
+
+    Returns
+    -------
+    list
+        One distance per candidate (max_distance + 1 for candidates farther
+        than max_distance), `None` for candidates which are `None`.
+    """
+
+    return [
+        None if c is None else bounded_levenshtein(target, c, max_distance)
+        for c in candidates]
+
+
 def compute_center_coordinates(bb):
     """
     Computes the coordinates of the center of a rectangular region
@@ -74,3 +172,33 @@ def compute_center_coordinates(bb):
     cy = bb[1] + bb[3]/2
 
     return cx, cy
+
+
+def print_worker_summary(worker_stats, n_workers, elapsed):
+    """
+    Print the number of frames processed and the time spent by each worker.
+
+    Parameters
+    ----------
+
+    worker_stats : dict
+        Maps the pid of each worker to the number of frames it processed and
+        the total time spent processing them.
+
+    n_workers : int
+        The number of workers requested.
+
+    elapsed : float
+        The total (wall clock) time, in seconds.
+    """
+
+    n_frames = sum(n for n, _ in worker_stats.values())
+
+    print("Done, {} frames in {:.2f} s ({:.1f} frames/s) with {} "
+          "worker(s)".format(
+              n_frames, elapsed, n_frames / elapsed if elapsed > 0 else 0.,
+              n_workers))
+
+    for pid, (n, busy) in sorted(worker_stats.items()):
+        print("    worker {}: {} frames, busy for {:.2f} s ({:.1f} ms per "
+              "frame)".format(pid, n, busy, 1000. * busy / n))
@@ -1,15 +1,21 @@
 import sys
-import cv2
-import numpy as np
 import traceback
 
+from glob import glob
+
 import darknet.python.darknet as dn
 
-from src.label import Label, lwrite
-from os.path import splitext, basename, isdir
-from os import makedirs
-from src.utils import crop_region, image_files_from_folder
-from darknet.python.darknet import detect
+from src.label import dknet_label_set
+from os.path import isdir, splitext, basename, getmtime
+from os import makedirs, remove
+from src.utils import image_files_from_folder
+from src.darknet_utils import detect_array
+from frame_io import ImageFolderSource, CROP_FORMATS, write_crop
+from roi import RegionOfInterest
+from detection_cache import open_cache, cached
+from manifest import open_manifest
+from motion_gate import MotionGate
+from tracker import VehicleTracker, last_track_id
 
 import argparse
 
@@ -24,6 +30,61 @@ def parse_args():
     parser.add_argument(
         '--vehicle_threshold', type=float, default=0.5)
 
+    parser.add_argument(
+        '--roi',
+        help="JSON file with the region of interest of the camera (see "
+        "`roi.RegionOfInterest.from_file`): vehicles are searched only in "
+        "that region.")
+
+    parser.add_argument(
+        '--motion_gate', action='store_true',
+        help="Skip vehicle detection on frames without motion (or exact "
+        "duplicates of the previous one), reusing the vehicles detected in "
+        "the previous frame.")
+
+    parser.add_argument(
+        '--motion_threshold', type=float, default=0.002,
+        help="Fraction of changed pixels above which a frame is considered "
+        "moving (see `--motion_gate`).")
+
+    parser.add_argument(
+        '--max_skip', type=int, default=25,
+        help="Maximum number of consecutive frames skipped by the motion "
+        "gate.")
+
+    parser.add_argument(
+        '--keyframe_interval', type=int,
+        help="If set, vehicles are tracked across frames and detected only "
+        "once every this number of frames (or when a track is not reliable, "
+        "e.g. a new vehicle or one at the border of the frame); their boxes "
+        "are predicted on the other frames. A track id is written as "
+        "seventh column of *_cars.txt.")
+
+    parser.add_argument(
+        '--crop_format', choices=CROP_FORMATS, default='png',
+        help="Format of the crops written for the following stages: png, "
+        "jpg (see --jpeg_quality), ppm or npy (uncompressed, fastest).")
+
+    parser.add_argument(
+        '--jpeg_quality', type=int, default=95,
+        help="Quality of jpg crops (0-100).")
+
+    parser.add_argument(
+        '--cache_dir',
+        help="If set, results are cached in this folder, keyed by the "
+        "content of the images, the models and the thresholds, so that "
+        "images already processed are skipped when running again.")
+
+    parser.add_argument(
+        '--cache_size', type=float, default=2048,
+        help="Maximum size of the cache of this stage, in MB; least recently "
+        "used results are removed first.")
+
+    parser.add_argument(
+        '--restart', action='store_true',
+        help="Process all frames, ignoring the ones completed by a previous "
+        "run (see `manifest.py`).")
+
     return parser.parse_args()
 
 
@@ -46,55 +107,173 @@ if __name__ == '__main__':
         vehicle_net = dn.load_net(vehicle_netcfg, vehicle_weights, 0)
         vehicle_meta = dn.load_meta(vehicle_dataset)
 
-        imgs_paths = image_files_from_folder(input_dir)
-        imgs_paths.sort()
+        cache = open_cache(
+            args.cache_dir, 'vehicles',
+            [vehicle_weights, vehicle_netcfg, vehicle_dataset],
+            {'thresh': vehicle_threshold}, args.cache_size)
+
+        roi = RegionOfInterest.from_file(args.roi) if args.roi else None
+
+        gate = None
+        if args.motion_gate:
+            gate = MotionGate(
+                min_changed_fraction=args.motion_threshold,
+                max_skip=args.max_skip)
+
+        # Detections of the last frame, reused for static frames
+        last_R = None
+
+        tracker = None
+        if args.keyframe_interval is not None:
+            # Track ids of a resumed run follow the ones already written
+            tracker = VehicleTracker(
+                keyframe_interval=args.keyframe_interval,
+                first_id=last_track_id(output_dir) + 1)
+
+        # Number of the last frame processed, to detect gaps in the sequence
+        last_number = None
+        n_keyframes = 0
 
         if not isdir(output_dir):
             makedirs(output_dir)
 
+        manifest, _ = open_manifest(
+            output_dir, 'vehicle-detection',
+            {'vehicle_threshold': vehicle_threshold, 'roi': args.roi,
+             'crop_format': args.crop_format,
+             'jpeg_quality': args.jpeg_quality,
+             'motion_gate': args.motion_gate,
+             'motion_threshold': args.motion_threshold,
+             'max_skip': args.max_skip,
+             'keyframe_interval': args.keyframe_interval},
+            restart=args.restart)
+
+        # Frames not completed yet, or whose image has changed since
+        paths = dict(
+            (splitext(basename(p))[0], p)
+            for p in image_files_from_folder(input_dir))
+        pending = [
+            name for name in sorted(paths)
+            if manifest.is_stale(name, getmtime(paths[name]))]
+
+        print('%d frames to process, %d already done' % (
+            len(pending), len(paths) - len(pending)))
+
+        frames = ImageFolderSource(input_dir, [paths[n] for n in pending])
+        decoded = set()
+
         print('Searching for vehicles using YOLO...')
 
-        for i, img_path in enumerate(imgs_paths):
+        for frame in frames:
+
+            try:
+
+                print('\tScanning %s' % frame.name)
+
+                bname = frame.name
+                decoded.add(bname)
+
+                # Remove the outputs of any previous run (even one with
+                # other parameters, or before --restart), including the ones
+                # of the following stages, which might not be overwritten
+                for p in glob('%s/%s_car_*' % (output_dir, bname)) + \
+                        glob('%s/%s_cars.txt' % (output_dir, bname)):
+                    remove(p)
+
+                Iorig = frame.image
+
+                # Each image is decoded only once and passed to darknet from
+                # memory, cropped to the region of interest if any
+                Idet = Iorig if roi is None else roi.apply(Iorig)
+
+                # Tracks cannot be predicted, nor detections reused, across
+                # a gap in the frames
+                if frame.number is not None and last_number is not None and \
+                        frame.number != last_number + 1:
+                    last_R = None
+                    if tracker is not None:
+                        tracker.reset()
+                    if gate is not None:
+                        gate.reset()
+                last_number = frame.number
+
+                if tracker is None or tracker.needs_detection():
+
+                    if gate is None or gate.should_detect(Idet) or \
+                            last_R is None:
+                        R, _ = cached(cache, Idet, lambda I: detect_array(
+                            vehicle_net, vehicle_meta, I,
+                            thresh=vehicle_threshold))
+                        last_R = R
+                    else:
+                        # Static frame, vehicles are cropped from this frame
+                        # where they were found in the previous one
+                        print('\t\tNo motion, reusing previous detections')
+                        R = last_R
+
+                    R = [r for r in R if r[0] in [
+                        b'car', b'bus', b'truck']]
+                        # b'car', b'bus', b'truck', b'motorbike']]
+
+                    Lcars = dknet_label_set(
+                        R, Idet.shape[1], Idet.shape[0], with_category=True)
+
+                    if roi is not None:
+                        Lcars = roi.to_frame(
+                            Lcars, Iorig.shape[1], Iorig.shape[0])
+
+                    if tracker is not None:
+                        Lcars = tracker.step(Lcars)
+                        n_keyframes += 1
 
-            print('\tScanning %s' % img_path)
+                else:
+                    # Boxes predicted from the tracks
+                    Lcars = tracker.step()
 
-            bname = basename(splitext(img_path)[0])
+                print('\t\t%d vehicles found' % len(Lcars))
 
-            R, _ = detect(
-                vehicle_net, vehicle_meta,
-                bytes(img_path, encoding='utf-8'),
-                thresh=vehicle_threshold)
+                if len(Lcars):
 
-            R = [r for r in R if r[0] in [
-                b'car', b'bus', b'truck']]
-                # b'car', b'bus', b'truck', b'motorbike']]
+                    for i, Icar in enumerate(Lcars.crops(Iorig, copy=False)):
 
-            print('\t\t%d vehicles found' % len(R))
+                        write_crop(
+                            # '%s/%s_%dcar.png' % (output_dir, bname, i), Icar)
+                            '%s/%s_car_%d' % (output_dir, bname, i), Icar,
+                            args.crop_format, args.jpeg_quality)
 
-            if len(R):
+                    Lcars.write(
+                        '%s/%s_cars.txt' % (output_dir, bname),
+                        write_category_names=True)
 
-                Iorig = cv2.imread(img_path)
-                WH = np.array(Iorig.shape[1::-1], dtype=float)
-                Lcars = []
+            except Exception as e:
+                manifest.failed(frame.name, e)
 
-                for i, r in enumerate(R):
+                # A failed frame is a gap for the following one
+                last_R = None
+                if tracker is not None:
+                    tracker.reset()
+                if gate is not None:
+                    gate.reset()
 
-                    cx, cy, w, h = (
-                        np.array(r[2])/np.concatenate((WH, WH))).tolist()
-                    tl = np.array([cx - w/2., cy - h/2.])
-                    br = np.array([cx + w/2., cy + h/2.])
-                    label = Label(0, tl, br, category=r[0].decode("utf-8"))
-                    Icar = crop_region(Iorig, label)
+            else:
+                manifest.done(frame.name)
 
-                    Lcars.append(label)
+        if gate is not None:
+            print(gate.summary())
 
-                    cv2.imwrite(
-                        # '%s/%s_%dcar.png' % (output_dir, bname, i), Icar)
-                        '%s/%s_car_%d.png' % (output_dir, bname, i), Icar)
+        if tracker is not None:
+            print('Tracker: vehicles detected in %d of %d frames' % (
+                n_keyframes, len(decoded)))
 
-                lwrite(
-                    '%s/%s_cars.txt' % (output_dir, bname),
-                    Lcars, write_category_names=True)
+        # Frames which could not be decoded
+        for name in set(pending) - decoded:
+            manifest.failed(name, "could not decode the image")
+
+        print(manifest.summary())
+        manifest.close()
+
+        if cache is not None:
+            print(cache.summary())
 
     except:
         traceback.print_exc()